@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""
+Process every Novatel, Javad and NMEA file under a directory tree.
+
+Each file's format is found from its contents (compressed files are
+read directly), and the files are processed in a process pool into nav
+tracks (one nav message per line, as the server sends them) or, for
+Novatel, xds breakouts. Results are cached in the output directory for
+each mode: a file is skipped when its content hash and the tool version
+(a hash of the decoder sources) match those of its cached result. The
+content is only hashed again when the file's size or mtime has changed,
+and the format found for each file is cached the same way. Files in a
+format the mode can't process are reported as unsupported without being
+hashed or sent to the pool.
+
+Usage:
+
+./batch.py /disk/kea/WAIS/targ/xped/ICP9 -o /tmp/ICP9_nav
+./batch.py /disk/kea/WAIS/targ/xped/ICP9 -o /tmp/ICP9_bo --mode breakout -j 8
+./batch.py tests/data -o /tmp/batch --summary /tmp/batch.json
+
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import time
+import types
+
+from bognss import fileio
+import bognss.NVT.nvt as nvt
+import bognss.JVD.greis as greis
+import nav_jvd
+import nav_nmea
+import nav
+import nav_nvt
+import replay
+
+BATCH_MODES = ('nav', 'breakout')
+# Formats each mode can process
+MODE_FORMATS = {'nav': ('nvt', 'jvd', 'nmea'), 'breakout': ('nvt',)}
+CACHE_NAME = 'batch_cache.json'
+SNIFF_BYTES = 1 << 16
+HASH_BLOCK = 1 << 20
+# Files that are never inputs
+SKIP_SUFFIXES = (nvt.IDX_SUFFIX, '.json', '.npy', '.tmp')
+
+RE_NVT = re.compile(rb'\xaa\x44[\x12\x13]')
+RE_GREIS = re.compile(rb'(~~|RT)005[\s\S]{5}\s*GT007')
+RE_NMEA = re.compile(rb'^[$!][A-Z]{5},', re.M)
+
+REPO_DIR = os.path.dirname(os.path.realpath(__file__))
+
+def repo_modules(roots):
+    """ roots, and the modules of this repository that they import at the
+    top level (as modules or names from them), directly or not, in order
+    of their source paths """
+    found = {}
+    todo = list(roots)
+    while todo:
+        module = todo.pop()
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.realpath(path)
+        if path in found or not path.startswith(REPO_DIR + os.sep):
+            continue
+        found[path] = module
+        for value in vars(module).values():
+            if isinstance(value, types.ModuleType):
+                todo.append(value)
+            elif isinstance(getattr(value, '__module__', None), str) and value.__module__ in sys.modules:
+                todo.append(sys.modules[value.__module__])
+    return [found[path] for path in sorted(found)]
+
+def source_version(modules):
+    """ Hash of the modules' source files """
+    h = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, 'rb') as fin:
+            h.update(fin.read())
+    return h.hexdigest()[:16]
+
+# Cached results are redone when any of the code that made them changes: the
+# modules a worker uses (some imported inside functions, so listed here) and
+# everything of this repository they import
+TOOL_VERSION = source_version(repo_modules([sys.modules[__name__], fileio, nvt, greis, nav,
+                                            nav_nvt, nav_jvd, nav_nmea, replay]))
+
+
+def sniff_format(path):
+    """ 'nvt', 'jvd' or 'nmea' from the start of the file, or None """
+    try:
+        with nvt.open_input(path) as fin:
+            head = fin.read(SNIFF_BYTES)
+    except (OSError, EOFError, ValueError):
+        return None
+    # Novatel sync bytes at least twice, as they may occur by chance
+    if len(RE_NVT.findall(head)) >= 2:
+        return 'nvt'
+    if RE_GREIS.search(head):
+        return 'jvd'
+    if len(RE_NMEA.findall(head)) >= 2:
+        return 'nmea'
+    return None
+
+def find_inputs(topdir, outdir=None, formats=None):
+    """ (relative path, format, stamp) of each input file under topdir,
+    skipping outdir if it is inside topdir. formats caches the format of
+    each file by relative path (None if it isn't an input), so that only
+    new and changed files are read. """
+    if formats is None:
+        formats = {}
+    inputs = []
+    skipdir = None if outdir is None else os.path.realpath(outdir)
+    for dirpath, dirnames, filenames in os.walk(topdir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.') and
+                             os.path.realpath(os.path.join(dirpath, d)) != skipdir)
+        for name in sorted(filenames):
+            if name.startswith('.') or name.endswith(SKIP_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, name)
+            relpath = os.path.relpath(path, topdir)
+            try:
+                stamp = file_stamp(path)
+            except OSError: # removed since it was listed
+                continue
+            entry = formats.get(relpath)
+            if entry is not None and entry['tool'] == TOOL_VERSION and entry['stamp'] == stamp:
+                fmt = entry['format']
+            else:
+                fmt = sniff_format(path)
+                formats[relpath] = {'tool': TOOL_VERSION, 'stamp': stamp, 'format': fmt}
+            if fmt is not None:
+                inputs.append((relpath, fmt, stamp))
+    return inputs
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def output_path(outdir, relpath, mode):
+    return os.path.join(outdir, relpath + ('.nav' if mode == 'nav' else '.bo'))
+
+def process_file(path, fmt, mode, outpath, known_hash=None, utcoffset=18., weekoffset=1024):
+    """ Process one file into outpath, in a worker process. If the file's
+    content hash is known_hash, it is unchanged and isn't processed.
+    Returns a result dict. """
+    t0 = time.perf_counter()
+    result = {'format': fmt}
+    messages, parser_stats = {}, {}
+    tmppath = outpath + '.tmp'
+    try:
+        # The file may have gone or become unreadable since it was found
+        result.update(sha256=file_hash(path), stamp=file_stamp(path))
+        if known_hash is not None and result['sha256'] == known_hash:
+            result['status'] = 'unchanged'
+            return result
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        if mode == 'nav':
+            snapshots = 0
+            with open(tmppath, 'wt') as fout:
+                for ns2 in replay.nav_file_gen(fmt, path, utcoffset, weekoffset, messages, parser_stats):
+                    fout.write(ns2.nav_message())
+                    snapshots += 1
+            result['snapshots'] = snapshots
+            os.replace(tmppath, outpath)
+        elif fmt == 'nvt':
+            shutil.rmtree(tmppath, ignore_errors=True)
+            messages = nvt.bo_avnnp(path, tmppath, None, True, parser_stats=parser_stats)
+            shutil.rmtree(outpath, ignore_errors=True)
+            os.replace(tmppath, outpath)
+        else:
+            result['status'] = 'unsupported'
+            return result
+    except Exception as e:
+        logging.exception("Failed to process %s", path)
+        result.update(status='failed', error=repr(e))
+        return result
+
+    result.update(status='done', messages=sum(messages.values()),
+                  message_ids={str(k if not isinstance(k, bytes) else k.decode('ascii', 'replace')): v
+                               for k, v in messages.items()},
+                  errors=parser_stats, seconds=time.perf_counter() - t0)
+    return result
+
+
+def load_cache(outdir):
+    try:
+        with open(os.path.join(outdir, CACHE_NAME)) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(outdir, cache):
+    os.makedirs(outdir, exist_ok=True)
+    name = os.path.join(outdir, CACHE_NAME)
+    with open(name + '.tmp', 'w') as fout:
+        json.dump(cache, fout, indent=1, sort_keys=True)
+    os.replace(name + '.tmp', name)
+
+def run_batch(topdir, outdir, mode='nav', jobs=None, force=False, utcoffset=18., weekoffset=1024):
+    """ Process the inputs under topdir into outdir; returns the result for
+    each file by relative path, with status 'done', 'cached', 'failed' or
+    'unsupported' """
+    allcache = load_cache(outdir)
+    cache = allcache.setdefault(mode, {})
+    inputs = find_inputs(topdir, outdir, allcache.setdefault('formats', {}))
+    results = {}
+    todo = []
+    for relpath, fmt, stamp in inputs:
+        if fmt not in MODE_FORMATS[mode]:
+            results[relpath] = {'format': fmt, 'status': 'unsupported'}
+            continue
+        path = os.path.join(topdir, relpath)
+        outpath = output_path(outdir, relpath, mode)
+        entry = cache.get(relpath)
+        usable = (not force and entry is not None and entry['tool'] == TOOL_VERSION and
+                  entry['result']['status'] == 'done' and os.path.exists(outpath))
+        if usable and entry['result']['stamp'] == stamp:
+            results[relpath] = dict(entry['result'], status='cached')
+            continue
+        todo.append((stamp[0], relpath, path, fmt, outpath, entry['result']['sha256'] if usable else None))
+    # Biggest first, to keep the pool busy to the end
+    todo.sort(key=lambda t: -t[0])
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(process_file, path, fmt, mode, outpath, known, utcoffset, weekoffset): relpath
+                       for _, relpath, path, fmt, outpath, known in todo}
+            for future in concurrent.futures.as_completed(futures):
+                relpath = futures[future]
+                result = future.result()
+                if result['status'] == 'unchanged':
+                    result = dict(cache[relpath]['result'], stamp=result['stamp'])
+                    cache[relpath]['result'] = result
+                    result = dict(result, status='cached')
+                elif result['status'] == 'done':
+                    cache[relpath] = {'tool': TOOL_VERSION, 'result': result}
+                results[relpath] = result
+                logging.info("%s: %s", relpath, result['status'])
+    finally:
+        save_cache(outdir, allcache)
+    return results
+
+def summary(results, wall):
+    """ Print a table of the results; returns the number that failed """
+    print("%-60s %-5s %-11s %9s %7s %8s %9s %8s" %
+          ('file', 'fmt', 'status', 'messages', 'errors', 'resync', 'snapshots', 'seconds'))
+    total_time = 0.
+    nfailed = 0
+    for relpath in sorted(results):
+        r = results[relpath]
+        errors = r.get('errors', {})
+        nerrors = sum(v for k, v in errors.items() if k != 'resync_bytes')
+        if r['status'] == 'done':
+            total_time += r['seconds']
+        nfailed += r['status'] == 'failed'
+        print("%-60s %-5s %-11s %9s %7s %8s %9s %8s" %
+              (relpath[-60:], r['format'], r['status'], r.get('messages', '-'),
+               nerrors if 'errors' in r else '-', errors.get('resync_bytes', '-'), r.get('snapshots', '-'),
+               '%.2f' % r['seconds'] if r['status'] == 'done' else '-'))
+    counts = {}
+    for r in results.values():
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    print("%d files (%s) in %.2f s; %.2f s of processing" %
+          (len(results), ', '.join('%d %s' % (v, k) for k, v in sorted(counts.items())), wall, total_time))
+    return nfailed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process a directory tree of navigation data files")
+    parser.add_argument('topdir', help="Directory to search for input files")
+    parser.add_argument('-o', '--outdir', required=True, help="Output (and cache) directory")
+    parser.add_argument('--mode', default='nav', choices=BATCH_MODES,
+                        help="nav tracks, or xds breakouts (Novatel only) (default %(default)s)")
+    parser.add_argument('-j', '--jobs', default=None, type=int, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--force', action='store_true', help="Process every file, ignoring the cache")
+    parser.add_argument('--gpsutcoffset', default=18., type=float)
+    parser.add_argument('--gpsweekoffset', default=1024, type=int)
+    parser.add_argument('--summary', metavar='JSON', help="Also save the results to this JSON file")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stdout)
+
+    if not os.path.isdir(args.topdir):
+        parser.error("%s is not a directory" % args.topdir)
+    t0 = time.time()
+    results = run_batch(args.topdir, args.outdir, args.mode, args.jobs, args.force,
+                        args.gpsutcoffset, args.gpsweekoffset)
+    nfailed = summary(results, time.time() - t0)
+    if args.summary:
+        with open(args.summary, 'w') as fout:
+            json.dump({'tool': TOOL_VERSION, 'mode': args.mode, 'results': results}, fout, indent=1, sort_keys=True)
+    if nfailed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the parsers, navigation state and server, over the sample
+data in tests/data.
+
+Each benchmark reports one number: a rate (higher is better) or a
+latency (lower is better). Results can be saved as JSON and compared
+against an earlier run, which flags anything that got slower by more
+than the threshold.
+
+Usage:
+
+./bench.py -o baseline.json
+./bench.py -o new.json --compare baseline.json
+./bench.py --compare baseline.json new.json --threshold 0.2
+./bench.py -k nvt --min-time 0.5
+
+"""
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+import bognss.NVT.nvt as nvt
+import bognss.JVD.greis as greis
+import nav
+import nav_jvd
+import nav_nmea
+import nav_nvt
+
+DATADIR = os.path.join(os.path.dirname(__file__), 'tests/data')
+NVT_FILES = ('ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds', 'KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds')
+JVD_FILE = 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds'
+
+# Slowdown (fraction) beyond which --compare flags a benchmark
+COMPARE_THRESHOLD = 0.2
+
+# name -> (function, unit, higher_is_better)
+BENCHMARKS = {}
+
+def benchmark(name, unit, higher_is_better=True):
+    """ Register a benchmark. For rates, the function does one pass and
+    returns how many units it processed; for latencies, it returns the
+    latency itself. """
+    def register(fn):
+        BENCHMARKS[name] = (fn, unit, higher_is_better)
+        return fn
+    return register
+
+def read_sample(name):
+    with open(os.path.join(DATADIR, name), 'rb') as fin:
+        return fin.read()
+
+def count(gen):
+    return sum(1 for _ in gen)
+
+
+def nmea_sentence(body):
+    return '$%s*%02X\r\n' % (body, nav_nmea.nmea_checksum(body))
+
+def sample_nmea():
+    """ GGA, RMC and ZDA sentences for the epochs of the Novatel sample """
+    lines = []
+    with nvt.open_mmap(os.path.join(DATADIR, NVT_FILES[0])) as fin:
+        for ns in nav_nvt.nvt_nav_gen(fin, 18.):
+            hhmmss = '%02d%02d%06.3f' % (ns.utc_hour, ns.utc_min, ns.utc_ms / 1000.)
+            lat = '%02d%07.4f,%s' % (abs(ns.latitude), abs(ns.latitude) % 1 * 60, 'NS'[ns.latitude < 0])
+            lon = '%03d%07.4f,%s' % (abs(ns.longitude), abs(ns.longitude) % 1 * 60, 'EW'[ns.longitude < 0])
+            date = '%02d%02d%02d' % (ns.utc_day, ns.utc_month, ns.utc_year % 100)
+            lines.append(nmea_sentence('GPGGA,%s,%s,%s,1,12,0.8,%.2f,M,0.0,M,,' % (hhmmss, lat, lon, ns.height)))
+            lines.append(nmea_sentence('GPRMC,%s,A,%s,%s,%.2f,%.2f,%s,,,A' %
+                                       (hhmmss, lat, lon, ns.hor_spd * 1.94384, ns.trk_gnd, date)))
+            lines.append(nmea_sentence('GPZDA,%s,%02d,%02d,%04d,00,00' %
+                                       (hhmmss, ns.utc_day, ns.utc_month, ns.utc_year)))
+    return lines
+
+
+#-------------------------------------------------------------------------
+# Parsers
+
+def register_parsers():
+    for name in NVT_FILES:
+        data = read_sample(name)
+        short = name.split('_')[-2]
+        benchmark('nvt.NovatelReader[file,%s]' % short, 'msgs/s')(
+            lambda data=data: count(nvt.NovatelReader(io.BytesIO(data))))
+        benchmark('nvt.NovatelReader[buffer,%s]' % short, 'msgs/s')(
+            lambda data=data: count(nvt.make_reader(data)))
+        benchmark('nvt.NovatelParser[file,%s]' % short, 'msgs/s')(
+            lambda data=data: count(nvt.NovatelParser(io.BytesIO(data))))
+        benchmark('nvt.NovatelParser[buffer,%s]' % short, 'msgs/s')(
+            lambda data=data: count(nvt.NovatelParser(data)))
+        benchmark('nvt.NovatelParser[crc,%s]' % short, 'msgs/s')(
+            lambda data=data: count(nvt.NovatelParser(data, b_calc_crc=True)))
+        benchmark('nav_nvt.nvt_nav_gen[%s]' % short, 'snapshots/s')(
+            lambda data=data: count(nav_nvt.nvt_nav_gen(data, 18.)))
+
+    data = read_sample(JVD_FILE)
+    benchmark('greis.GREISReader[file]', 'msgs/s')(
+        lambda: count(greis.GREISReader(io.BytesIO(data), True)))
+    benchmark('greis.GREISReader[buffer]', 'msgs/s')(
+        lambda: count(greis.make_reader(data, True)))
+    benchmark('greis.GREISParser[file]', 'msgs/s')(
+        lambda: count(greis.GREISParser(io.BytesIO(data), True, False)))
+    benchmark('greis.GREISParser[buffer]', 'msgs/s')(
+        lambda: count(greis.GREISParser(data, True, False)))
+    benchmark('nav_jvd.greis_nav_gen', 'snapshots/s')(
+        lambda: count(nav_jvd.greis_nav_gen(data, 18., 1024)))
+
+    lines = sample_nmea()
+    def update_nmea(fast=True):
+        ns = nav_nmea.NmeaNavState()
+        for line in lines:
+            ns.update_nmea(line, fast=fast)
+        return len(lines)
+    benchmark('nav_nmea.update_nmea', 'lines/s')(update_nmea)
+    benchmark('nav_nmea.update_nmea[pynmea2]', 'lines/s')(lambda: update_nmea(False))
+    nmea_data = ''.join(lines).encode('ascii') * 20
+    benchmark('nav_nmea.read_nmea_track', 'epochs/s')(
+        lambda: len(nav_nmea.read_nmea_track(nmea_data)))
+
+
+#-------------------------------------------------------------------------
+# CRCs
+
+def register_crcs():
+    body = read_sample(NVT_FILES[0])[:65536]
+    def crc(fn):
+        fn(body)
+        return len(body) / 1e6
+    benchmark('nvt.CalculateBlockCRC32', 'MB/s')(lambda: crc(nvt.CalculateBlockCRC32))
+    benchmark('greis.crc8', 'MB/s')(lambda: crc(greis.crc8))
+
+
+#-------------------------------------------------------------------------
+# Navigation state
+
+def register_navstate():
+    with nvt.open_mmap(os.path.join(DATADIR, NVT_FILES[0])) as fin:
+        snapshots = list(nav_nvt.nvt_nav_gen(fin, 18.))
+    dicts = [s._asdict() for s in snapshots]
+    def update(others):
+        ns = nav.NavState()
+        for other in others:
+            ns.update(other)
+        return len(others)
+    benchmark('nav.NavState.update[snapshot]', 'updates/s')(lambda: update(snapshots))
+    benchmark('nav.NavState.update[dict]', 'updates/s')(lambda: update(dicts))
+    ns = nav.NavState()
+    ns.update(snapshots[-1])
+    benchmark('nav.NavState.nav_message', 'msgs/s')(
+        lambda: count(ns.nav_message() for _ in range(1000)))
+    benchmark('nav.NavSnapshot.nav_message', 'msgs/s')(
+        lambda: count(s.nav_message() for s in snapshots))
+    benchmark('nav.NavState.snapshot', 'snapshots/s')(
+        lambda: count(ns.snapshot() for _ in range(1000)))
+
+
+#-------------------------------------------------------------------------
+# Server
+
+def free_port(host='localhost'):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+def server_latency(duration=2., interval=0.01, update_rate=100.):
+    """ Update-to-receive latency through server.server() over loopback.
+    A thread updates the state at update_rate, tagging each update in
+    the latitude; a client records when each tag arrives. Returns the
+    latencies in seconds (these include the wait for the next send, and
+    updates overwritten before they were sent are not counted). """
+    import server
+    ns = nav.NavState()
+    port = free_port()
+    t_update = {}
+    stop = threading.Event()
+
+    def updater():
+        tag = 0
+        while not stop.is_set():
+            tag += 1
+            t_update[tag] = time.perf_counter()
+            ns.update({'latitude': float(tag)})
+            time.sleep(1. / update_rate)
+
+    threading.Thread(target=server.server, args=(ns, 'localhost', port, interval, duration + 3.),
+                     daemon=True).start()
+    threading.Thread(target=updater, daemon=True).start()
+    latencies = []
+    t0 = time.perf_counter()
+    while True:
+        try:
+            conn = socket.create_connection(('localhost', port), timeout=1.)
+            break
+        except ConnectionRefusedError:
+            if time.perf_counter() - t0 > 5.:
+                raise
+            time.sleep(0.05)
+    with conn:
+        buf = b''
+        while time.perf_counter() - t0 < duration:
+            try:
+                data = conn.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            now = time.perf_counter()
+            buf += data
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                # Only the first send of each update
+                t = t_update.pop(int(float(line.split(b',')[3])), None)
+                if t is not None:
+                    latencies.append(now - t)
+    stop.set()
+    return np.array(latencies)
+
+def register_server(duration):
+    cache = {}
+    def latency(p):
+        if 'latency' not in cache:
+            cache['latency'] = server_latency(duration) * 1000.
+        lat = cache['latency']
+        return float(np.percentile(lat, p)) if len(lat) else float('nan')
+    benchmark('server.latency_median', 'ms', False)(lambda: latency(50))
+    benchmark('server.latency_p99', 'ms', False)(lambda: latency(99))
+
+
+#-------------------------------------------------------------------------
+
+def run_benchmark(fn, unit, higher_is_better, min_time=0.2, repeat=3):
+    """ The best rate over repeat runs of at least min_time each, or
+    for latencies, the result of one call """
+    if not higher_is_better:
+        return fn()
+    best = 0.
+    for _ in range(repeat):
+        n = 0
+        t0 = time.perf_counter()
+        while True:
+            n += fn()
+            dt = time.perf_counter() - t0
+            if dt >= min_time:
+                break
+        best = max(best, n / dt)
+    return best
+
+def run_all(pattern=None, min_time=0.2, repeat=3, server_duration=2.):
+    register_parsers()
+    register_crcs()
+    register_navstate()
+    register_server(server_duration)
+    results = {}
+    for name, (fn, unit, higher_is_better) in BENCHMARKS.items():
+        if pattern and pattern not in name:
+            continue
+        value = run_benchmark(fn, unit, higher_is_better, min_time, repeat)
+        results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+        print("%-40s %14.3f %s" % (name, value, unit))
+    return {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+def compare(baseline, current, threshold=COMPARE_THRESHOLD):
+    """ Print the change in each benchmark in both runs; return the names
+    of those that got slower by more than threshold """
+    slower = []
+    print("%-40s %14s %14s %8s" % ('benchmark', 'baseline', 'current', 'change'))
+    for name, cur in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or not base['value'] or not cur['value']:
+            continue
+        if cur['higher_is_better']:
+            change = cur['value'] / base['value'] - 1.
+        else:
+            change = base['value'] / cur['value'] - 1.
+        flag = ''
+        if change < -threshold:
+            flag = 'SLOWER'
+            slower.append(name)
+        print("%-40s %14.3f %14.3f %+7.1f%% %s" % (name, base['value'], cur['value'], 100. * change, flag))
+    print("%d of %d benchmarks slower by more than %.0f%%: %s" %
+          (len(slower), len(current['results']), 100. * threshold, 'FAILED' if slower else 'ok'))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks over the sample data")
+    parser.add_argument('-o', '--output', help="Save results to this JSON file")
+    parser.add_argument('--compare', nargs='+', metavar='JSON',
+                        help="Compare against a baseline JSON file (with a second file, "
+                        "compare the two without running the benchmarks)")
+    parser.add_argument('--threshold', default=COMPARE_THRESHOLD, type=float,
+                        help="Flag slowdowns by more than this fraction (default %(default)g)")
+    parser.add_argument('-k', '--filter', help="Only run benchmarks whose name contains this")
+    parser.add_argument('--min-time', default=0.2, type=float, help="Minimum seconds per repetition")
+    parser.add_argument('--repeat', default=3, type=int, help="Repetitions; the best is kept")
+    parser.add_argument('--server-duration', default=2., type=float, help="Seconds of server latency test")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes a baseline file, and optionally a second file")
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f1, open(args.compare[1]) as f2:
+            current = json.load(f2)
+            slower = compare(json.load(f1), current, args.threshold)
+        sys.exit(1 if slower else 0)
+
+    current = run_all(args.filter, args.min_time, args.repeat, args.server_duration)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(current, fout, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare[0]) as fin:
+            slower = compare(json.load(fin), current, args.threshold)
+        sys.exit(1 if slower else 0)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,9 @@
 # GNG 2-17-01-06
 
 from collections import namedtuple
+import contextlib
+import os
+import re
 import struct
 import logging
 # Mostly for test
@@ -12,9 +15,21 @@ import argparse
 import binascii
 import sys
 
+import numpy as np
+
+try:
+    from bognss import fileio
+    from bognss.fileio import compression_type, open_input, open_mmap, bench_throughput
+except ImportError: # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from bognss import fileio
+    from bognss.fileio import compression_type, open_input, open_mmap, bench_throughput
+
 
 GREISMsg = namedtuple('GREISMsg', 'id len body')
 GREISMsgParsed = namedtuple('GREISMsgParsed', 'id len body parsed')
+# An epoch of messages (see GREISEpochAssembler)
+GREISEpoch = namedtuple('GREISEpoch', 'tod msgs obs')
 
 # GREIS message definitions
 GMsgDef = namedtuple('GMsgDef', 'struct dtype fmt')
@@ -66,6 +81,8 @@ for id in b'rc r1 r2 r3 r5 pc p1 p2 p3 p5 DC D1 D2 D3 D5 cp 1p 2p 3p 5p'.split()
     vmessages[id] = VMsg(struct.Struct('<i'), 4, '{:d}'.format)
 for id in b'pc p1 p2 p3 p5'.split():
     vmessages[id] = VMsg(struct.Struct('<I'), 4, '{:d}'.format)
+# numpy element types of the variable-length messages
+vmessage_dtypes = {k: np.dtype(v.type.format) for k, v in vmessages.items()}
 #for id in 'CC C1 C2 C3 C5 cc c1 c2 c3 c5'.split():
 #    vmessages[id] = ('H',6,'{:012x}')
 
@@ -95,9 +112,13 @@ def make_xds_str(fmtstruct, translator = {
     parts[-1] = '{:02x}'
     return ' '.join(parts)
 
-for k in messages:
-    if messages[k].fmt == '':
-        messages[k] = GMsgDef(messages[k].struct, messages[k].dtype, make_xds_str(messages[k].struct) )
+def xds_str(id):
+    """ The xds format string of fixed-length message id, made from its
+    struct on first use """
+    msgdef = messages[id]
+    if msgdef.fmt == '':
+        msgdef = messages[id] = msgdef._replace(fmt=make_xds_str(msgdef.struct))
+    return msgdef.fmt
 
 # End module variable definitions
 ##############################################################################
@@ -106,11 +127,13 @@ def GREISParser(fp, skip_crlf=False, b_print=True):
     Parse out fields within known GREIS messages
     skip_crlf will have the GREIS parser not yield garbage data that consists only of \n or \r\n
     b_print - if true, will print messages if data is unparseable
+    fp may be a file object or an in-memory buffer such as one returned by
+    open_mmap(), in which case message bodies are memoryviews of it.
     """
 
     s_crc8 = struct.Struct('<B')
 
-    for data in GREISReader(fp, skip_crlf):
+    for data in make_reader(fp, skip_crlf):
         # TODO: validate checksums here
         if data.id in messages:
             # known fixed-length messages
@@ -145,6 +168,63 @@ def GREISParser(fp, skip_crlf=False, b_print=True):
             yield data
 
 
+def GREISEpochAssembler(fp, skip_crlf=True, stats=None):
+    """
+    Group the messages in a GREIS stream into epochs, and yield a GREISEpoch for each.
+    An epoch begins with a receiver time message (RT or ~~) and ends with
+    an epoch end message (||) or the next receiver time message.
+
+    tod - receiver time of day in ms from the RT message, or None for
+          any messages preceding the first RT.
+    msgs - dict of the epoch's fixed-length messages by id.  Values are
+           the parsed namedtuples, or the raw GREISMsg for messages that are
+           unknown or unparseable.
+    obs - dict of the epoch's variable-length messages by id (such as SI,
+          EL or CP), each as a numpy array with one element per satellite
+          and the checksum removed.
+    Garbage data is discarded.
+    If stats is a dict, the counts of unparseable messages and bytes
+    skipped to resynchronise are added to it (keys 'unparseable' and
+    'resync_bytes').
+    """
+    if stats is None:
+        stats = {}
+    for k in ('unparseable', 'resync_bytes'):
+        stats.setdefault(k, 0)
+    tod, msgs, obs = None, {}, {}
+    for data in make_reader(fp, skip_crlf):
+        if data.id in (b'~~', b'RT'):
+            if msgs or obs or tod is not None:
+                yield GREISEpoch(tod, msgs, obs)
+            msgs, obs = {}, {}
+            try:
+                tod = messages[data.id].struct.unpack(data.body)[0]
+            except struct.error:
+                tod = None
+            continue
+
+        if data.id in vmessage_dtypes:
+            dtype = vmessage_dtypes[data.id]
+            obs[data.id] = np.frombuffer(data.body, dtype=dtype, count=max(0, len(data.body) - 1) // dtype.itemsize)
+        elif data.id in messages:
+            msgdef = messages[data.id]
+            try:
+                msgs[data.id] = msgdef.dtype._make(msgdef.struct.unpack(data.body))
+            except struct.error:
+                msgs[data.id] = data
+                stats['unparseable'] += 1
+        elif data.id == b'||':
+            yield GREISEpoch(tod, msgs, obs)
+            tod, msgs, obs = None, {}, {}
+        elif data.id != b'??':
+            msgs[data.id] = data
+        else:
+            stats['resync_bytes'] += len(data.body)
+
+    if msgs or obs or tod is not None:
+        yield GREISEpoch(tod, msgs, obs)
+
+
 def GREISReader(fp, skip_crlf=False):
     '''
     Reads a GREIS standard message stream as defined in Javad GREIS Reference Guide
@@ -205,6 +285,40 @@ def GREISReader(fp, skip_crlf=False):
         yield GREISMsg(b'??',b'???', baddata)
     baddata = b''
 
+# Valid message header (see is_header_valid)
+RE_HEADER = re.compile(rb'[0-~]{2}[0-9A-F]{3}')
+
+
+def make_reader(fp, skip_crlf=False):
+    """ Return the appropriate message reader for a file object or buffer """
+    return fileio.make_reader(fp, GREISReader, GREISBufferReader, skip_crlf)
+
+
+def GREISBufferReader(buf, skip_crlf=False):
+    '''
+    Reads a GREIS standard message stream from a buffer (bytes, bytearray or mmap).
+    Yields the same records as GREISReader, but message bodies and garbage
+    data are memoryview slices of buf rather than copies.
+    '''
+    mv = memoryview(buf)
+    buflen = len(buf)
+    search = RE_HEADER.search
+    pos = 0
+    while True:
+        m = search(buf, pos)
+        start = buflen if m is None else m.start()
+        # if there isn't any bad data, or it is just a line ending and we
+        # are skipping bad data, then don't emit it.
+        if start > pos:
+            baddata = mv[pos:start]
+            if not (skip_crlf and (baddata == b"\n" or baddata == b"\r\n")):
+                yield GREISMsg(b'??', b'???', baddata)
+        if m is None:
+            break
+        msglen = int(buf[start + 2:start + 5], 16)
+        pos = min(start + 5 + msglen, buflen)
+        yield GREISMsg(bytes(mv[start:start + 2]), bytes(mv[start + 2:start + 5]), mv[start + 5:pos])
+
 # Pre-calculate rotation left by 2 for crc8
 ROTL2 = tuple([((c << 2) | (c >> 6)) & 0xff for c in range(256)])
 
@@ -219,6 +333,13 @@ def crc8(data):
         res = ROTL2[res] ^ c
     return ROTL2[res]
 
+def encode_message(msgid, fields):
+    """ Encode the fields of a known fixed-length message (all but the
+    checksum) as a standard message, with its checksum """
+    body = messages[msgid].struct.pack(*fields, 0)[:-1]
+    head = msgid + b'%03X' % (len(body) + 1)
+    return head + body + bytes((crc8(head + body),))
+
 def is_header_valid(h):
     # Inline these comparisons for faster performance
     #b_msg_valid = is_headerchar(buffer[0]) and is_headerchar(buffer[1]) and \
@@ -237,10 +358,68 @@ def is_hexdigit(c):
     return (0x30 <= c <= 0x39) or (0x41 <= c <= 0x46)
 
 
+##############################################################################
+# Sidecar time index (see bognss/fileio.py)
+#
+# Every message in an epoch (from one RT/~~ to the next) is stamped with the
+# epoch's GT time, as receiver GPS seconds (wn * 604800 + tow / 1000).
+# The receiver week number may need a rollover offset applied; see seek_time.
+
+gps_week_secs = 604800
+
+IDX_SUFFIX = fileio.IDX_SUFFIX
+IDX_MAGIC = b'JPSX'
+# Message ids are stored as 16-bit integers
+S_IDX_MSGID = struct.Struct('<H')
+S_GT = messages[b'GT'].struct
+
+
+def index_packet(data):
+    """ (msgid, length, gpstime, new_epoch) of a GREISReader message, for fileio.build_index """
+    if data.id == b'??':
+        return None, len(data.body), None, False
+    gpstime = None
+    if data.id == b'GT' and len(data.body) == S_GT.size:
+        tow, wn, _ = S_GT.unpack(data.body)
+        gpstime = wn * gps_week_secs + tow / 1000.
+    return S_IDX_MSGID.unpack(data.id)[0], 5 + len(data.body), gpstime, data.id in (b'~~', b'RT')
+
+
+def build_index(fp):
+    """ Scan a GREIS stream (from its current position) or buffer and return a fileio.Index
+    of all messages.  Messages before the first GT are given its time. """
+    return fileio.build_index(fp, make_reader, index_packet)
+
+
+def load_index(infile, rebuild=False):
+    """ Load the sidecar index for infile, building and saving it if it is
+    missing or out of date """
+    return fileio.load_index(infile, IDX_MAGIC, build_index, rebuild)
+
+
+def seek_time(fp, gpstime, index=None, gps_weeknum_offset=0):
+    """ Position fp at the start of the first epoch at or after gpstime
+    (GPS seconds) and return the new file offset.
+    gps_weeknum_offset is added to the receiver week numbers in the index,
+    as in nav_jvd.greis_nav_gen.  If index is None, the sidecar index for fp
+    is loaded (or built). """
+    if index is None:
+        index = load_index(fp.name)
+    return fileio.seek_time(fp, gpstime - gps_weeknum_offset * gps_week_secs, index)
+
+
+def iter_range(fp, t0, t1, index=None, gps_weeknum_offset=0, **kwargs):
+    """ Parse the epochs with GPS time t0 <= t < t1 from file fp.
+    Extra keyword arguments are passed to GREISParser """
+    if index is None:
+        index = load_index(fp.name)
+    offset = gps_weeknum_offset * gps_week_secs
+    return fileio.iter_range(fp, t0 - offset, t1 - offset, index, GREISParser, **kwargs)
+
+
 def make_xds( id, data ):
     if id in messages:
-        fmtstr = messages[id][2]
-        return fmtstr.format(*data)
+        return xds_str(id).format(*data)
     elif id in vmessages:
         formatter = vmessages[id].fmt
         fields = [formatter(x) for x in data[0:-1]]
@@ -249,6 +428,7 @@ def make_xds( id, data ):
     else: # pragma: no cover
         return ''
 
+
 def test(args):
     LOGLEVEL=logging.DEBUG if args.verbose else logging.INFO
     logging.basicConfig(level=LOGLEVEL, stream=sys.stdout)
@@ -259,8 +439,18 @@ def test(args):
     is_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
     is_info = logging.getLogger().isEnabledFor(logging.INFO)
 
-    with open(input_bxds, "rb") as fh:
-        for ii, data in enumerate(GREISParser(fh, True)):
+    mapped = open_mmap(input_bxds) if args.mmap else contextlib.nullcontext()
+    with open_input(input_bxds) as fh, mapped as mm:
+        if args.index or args.start is not None or args.end is not None:
+            index = load_index(input_bxds, rebuild=args.index)
+            logging.info("Index: %d messages", len(index.offsets))
+            # Times on the command line are seconds of the first week in the file
+            tstart, tend = fileio.week_range(index, args.start, args.end)
+            records = iter_range(fh, tstart, tend, index, skip_crlf=True)
+        else:
+            records = GREISParser(mm if args.mmap else fh, True)
+
+        for ii, data in enumerate(records):
             if is_debug:
                 logging.debug("greis: %r", (data[0], data[1], binascii.b2a_hex(data[2])))
 
@@ -271,13 +461,13 @@ def test(args):
                 xds = make_xds( data[0], data[3] )
                 print("greis: ", data[0:2], xds)
             else:
-                print("greis: {!r}".format(data))
+                print("greis: {!r}".format(data._replace(body=bytes(data.body))))
 
             if data[0] == b'??':
                 pass
             elif data[0] == b'PM' or data[0] == b'SY': # ascii message
                 cs = crc8(data[0] + data[1] + data[2][0:-2])
-                csdata = int(data[2][-2:], 16)
+                csdata = int(bytes(data[2][-2:]), 16)
                 if cs != csdata:
                     logging.warning("Bad CRC asc (should be 0x%02x)", cs)
             else:
@@ -305,9 +495,33 @@ def main():
     parser.add_argument('--nmax', type=int, default=None, required=False, help='Max number of packets to process')
     parser.add_argument('-v', '--verbose', action="store_true", help='verbose output',
                         required=False)
+    parser.add_argument('--mmap', action="store_true", help='Read the input file through a memory map',
+                        required=False)
+    parser.add_argument('--index', action="store_true", help='Rebuild the sidecar time index for the input file',
+                        required=False)
+    parser.add_argument('--start', type=float, default=None, required=False,
+                        help='Start time (GPS seconds of week) to read from, using the sidecar index')
+    parser.add_argument('--end', type=float, default=None, required=False,
+                        help='End time (GPS seconds of week) to read to, using the sidecar index')
+    parser.add_argument('--throughput', action="store_true", required=False,
+                        help='Report parsing throughput, with and without decompression')
+    parser.add_argument('--profile', action="store_true", required=False,
+                        help='Profile with cProfile, printing the top functions to stderr')
     args = parser.parse_args()
 
-    test(args)
+    if not os.path.isfile(args.input):
+        parser.error("No input file %r" % args.input)
+    if compression_type(args.input) is not None:
+        if args.index or args.start is not None or args.end is not None:
+            parser.error("--index, --start and --end need an uncompressed input file")
+        # Compressed files are streamed rather than mapped
+        args.mmap = False
+
+    with fileio.profiled(args.profile):
+        if args.throughput:
+            bench_throughput(args.input, lambda fin: GREISParser(fin, True, False))
+        else:
+            test(args)
 
 
 
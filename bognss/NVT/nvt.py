@@ -26,8 +26,19 @@ import logging
 import binascii
 import itertools
 from array import array
+import contextlib
 import os
-import subprocess
+import sys
+
+import numpy as np
+
+try:
+    from bognss import fileio
+    from bognss.fileio import compression_type, open_input, open_mmap, bench_throughput
+except ImportError: # run as a script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from bognss import fileio
+    from bognss.fileio import compression_type, open_input, open_mmap, bench_throughput
 
 ####################################
 # Logging severity configuration
@@ -96,7 +107,7 @@ messages = {
     '{:d} {:0.4f} {:f} {:f} {:f} {:08x} {:08x}')),
 
 268 : MsgDef._make((
-    struct.Struct('<LdllllllllL'), 
+    struct.Struct('<LdlllllllL'), 
     namedtuple('RAWIMU','gnssweek gnsssec imustatus ' + \
                         'z_acc_raw y_acc_raw x_acc_raw ' + \
                         'z_spin_raw y_spin_raw x_spin_raw crc'),'')),
@@ -227,10 +238,17 @@ def make_xds_str(fmtstr,translator = {
     return ' '.join(parts)
     
 
+def xds_str(id):
+    """ The xds format string of message id, made from its struct on
+    first use """
+    msgdef = messages[id]
+    if msgdef.fmtstr == '' and msgdef.struct is not None:
+        msgdef = messages[id] = msgdef._replace(fmtstr=make_xds_str(msgdef.struct.format))
+    return msgdef.fmtstr
+
 def make_xds( id, data ):
     if id in messages:
-        fmtstr = messages[id][2]
-        return fmtstr.format(*data)
+        return xds_str(id).format(*data)
     else:
         return ''
 
@@ -290,6 +308,20 @@ def CalculatePacketCRC32(sBuffer):
     crc_calc = CalculateBlockCRC32( sBuffer[0:-4] )
     return (crc_calc, crc_msg, crc_calc == crc_msg)
 
+def encode_packet(msgid, gnssweek, gnssmsec, body, crctable=GetCRCTable()):
+    """ Build a Novatel binary packet with a long header around body (the message
+    fields without the CRC), and append its CRC32 """
+    header = b'\xaa\x44\x12' + MsgDef_NVT0x12.struct.pack(
+        3 + MsgDef_NVT0x12.struct.size, msgid, 0, 0, len(body), 0, 0, 0, gnssweek, gnssmsec, 0, 0, 0)
+    crc = CalculateBlockCRC32(body, CalculateBlockCRC32(header, 0, crctable), crctable)
+    return header + body + struct.pack('<L', crc)
+
+def encode_message(msgid, gnssweek, gnssmsec, fields, crctable=GetCRCTable()):
+    """ Encode the fields of a known message (all but the CRC, in the order
+    of its definition in messages) as a packet for encode_packet """
+    body = messages[msgid].struct.pack(*fields, 0)[:-4]
+    return encode_packet(msgid, gnssweek, gnssmsec, body, crctable)
+
 def hamming_dist(s1, s2):
     len_s1 = len(s1)
     if len_s1 != len(s2):
@@ -303,29 +335,39 @@ def hamming_dist(s1, s2):
 
 
 
-def NovatelParser(fp, msgids=None, b_calc_crc=False, b_correct_crc=False):
+def NovatelParser(fp, msgids=None, b_calc_crc=False, b_correct_crc=False, stats=None):
+    """ Parse the messages in a Novatel stream.  fp may be a file object,
+    or an in-memory buffer such as one returned by open_mmap(), in which case
+    the header and message bytes of each record are memoryviews of it.
+    If stats is a dict, the counts of bad CRCs, unparseable messages and
+    bytes skipped to resynchronise are added to it (keys 'badcrc',
+    'unparseable' and 'resync_bytes'). """
     global G_LOGLEVEL_UNKNOWN_MSG
 
     # If there is a CRC error, make the first occurrence an info, and the subsequent
     # ones a warning.
     num_badcrc = 0
     num_unparseable = 0
-
-    stats = {}
+    # Unknown message ids are logged on their first occurrence and then
+    # each time their count reaches a power of two
+    num_unknown = {}
+
+    if stats is None:
+        stats = {}
+    for k in ('badcrc', 'unparseable', 'resync_bytes'):
+        stats.setdefault(k, 0)
     crctab = GetCRCTable()
 
     # Max size of packet to perform ECC on
     ecc_msg_max_size = 3000
+    is_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-    # Pre-load the xds format strings for any that are not defined.
-    for k,v in messages.items():
-        if v.fmtstr == '' and v[0] is not None:
-            messages[k] = v._replace( fmtstr=make_xds_str(v[0].format ) )
-
-    for data in NovatelReader(fp):
+    for data in make_reader(fp):
         (msglen, header, headerbytes, msgbytes) = data
         if msglen == 0:
-            logging.debug("Trash (%d): %s", len(msgbytes), msgbytes.hex() )
+            if is_debug:
+                logging.debug("Trash (%d): %s", len(msgbytes), msgbytes.hex())
+            stats['resync_bytes'] += len(msgbytes)
             continue
 
         # If we've been provided with a whitelist, use it.
@@ -355,11 +397,13 @@ def NovatelParser(fp, msgids=None, b_calc_crc=False, b_correct_crc=False):
                 if crc_msg != crc_calc:
                     b_badcrc=True
                     loglevel = logging.INFO if num_badcrc == 0 else logging.WARNING
-                    logging.log(loglevel, "msg={0.msgid:04d} week={0.gnssweek:d} msec={0.gnssmsec:d}: "
-                                "CRC mismatch, crc={1:08x} calc={2:08x} len={3:d}. "
-                                "{4:d} previous occurrences".format( 
-                                header, crc_msg, crc_calc, len(headerbytes) + len(msgbytes), num_badcrc ))
+                    logging.log(loglevel, "msg=%04d week=%d msec=%d: "
+                                "CRC mismatch, crc=%08x calc=%08x len=%d. "
+                                "%d previous occurrences",
+                                header.msgid, header.gnssweek, header.gnssmsec,
+                                crc_msg, crc_calc, len(headerbytes) + len(msgbytes), num_badcrc)
                     num_badcrc += 1
+                    stats['badcrc'] += 1
 
 
             if msgspec[0] is not None and msgspec[1] is not None:
@@ -368,22 +412,26 @@ def NovatelParser(fp, msgids=None, b_calc_crc=False, b_correct_crc=False):
                     parsed = msgspec[1]._make( msgspec[0].unpack(msgbytes) )
                 except struct.error:
                     loglevel = logging.INFO if num_unparseable == 0 else logging.WARNING
-                    logging.log(loglevel, "unparseable: id={:04d}; input data length={:d}; "
-                                "expected length={:d}; {:d} previous occurrences".format(
-                    header.msgid, len(msgbytes), msgspec[0].size, num_unparseable ))
+                    logging.log(loglevel, "unparseable: id=%04d; input data length=%d; "
+                                "expected length=%d; %d previous occurrences",
+                                header.msgid, len(msgbytes), msgspec[0].size, num_unparseable)
                     yield NVTMsg._make(data + (None,))
                     num_unparseable += 1
+                    stats['unparseable'] += 1
                     continue
             else:
                 # This message type is known, but not parsed.
-                logging.debug("msg={0.msgid:04d} week={0.gnssweek:d} msec={0.gnssmsec:d}: ignored".format(header))
+                logging.debug("msg=%04d week=%d msec=%d: ignored", header.msgid, header.gnssweek, header.gnssmsec)
 
 
             if not b_badcrc:
                 yield NVTMsg._make(data + (parsed,))
         else:
             # everything else just pass it through.
-            logging.log(G_LOGLEVEL_UNKNOWN_MSG, "Unknown message id {:d}".format(header.msgid))
+            n = num_unknown.get(header.msgid, 0) + 1
+            num_unknown[header.msgid] = n
+            if n & (n - 1) == 0:
+                logging.log(G_LOGLEVEL_UNKNOWN_MSG, "Unknown message id %d (%d occurrences)", header.msgid, n)
             yield NVTMsg._make(data + (None,))
 
 
@@ -447,7 +495,7 @@ def NovatelReader(fp):
             try:
                 header  = MsgDef_NVT0x13.nt._make(MsgDef_NVT0x13.struct.unpack(buffer[3:]))
             except struct.error as e:
-                logging.warning("hbuffer length: {:d}, expected {:d}".format(len(buffer[3:]), MsgDef_NVT0x13.struct.size) )
+                logging.warning("hbuffer length: %d, expected %d", len(buffer[3:]), MsgDef_NVT0x13.struct.size)
                 #buffer += hbuffer[1:]
                 b_msg_valid = False
         elif b_allow_ascii and (buffer[0] == b'#' or buffer[0] == b'%'): # ascii long/short string (relatively untested)
@@ -494,6 +542,112 @@ def NovatelReader(fp):
 
 
 
+def make_reader(fp):
+    """ Return the appropriate packet reader for a file object or buffer """
+    return fileio.make_reader(fp, NovatelReader, NovatelBufferReader)
+
+
+def NovatelBufferReader(buf):
+    '''
+    Reads a Novatel standard message stream from a buffer (bytes, bytearray
+    or mmap).  Yields the same records as NovatelReader, but the header bytes,
+    message bytes and garbage data are memoryview slices of buf rather than copies.
+
+    Instead of discarding one byte at a time, the scan for a valid header jumps
+    to the next sync pattern.
+    '''
+    mv = memoryview(buf)
+    buflen = len(buf)
+    s_long, s_short = MsgDef_NVT0x12.struct, MsgDef_NVT0x13.struct
+    nt_long, nt_short = MsgDef_NVT0x12.nt, MsgDef_NVT0x13.nt
+    # The long header length byte is counted in the struct, the sync bytes are not
+    hlen_long = 3 + s_long.size
+    hlen_short = 3 + s_short.size
+
+    pos = 0 # start of the current candidate packet
+    badstart = 0 # start of any garbage preceding it
+    while True:
+        # Packets are usually back to back, so check before searching
+        if pos + 4 > buflen or buf[pos] != 0xaa or buf[pos + 1] != 0x44:
+            pos = buf.find(b'\xaa\x44', pos)
+            if pos < 0 or pos + 4 > buflen:
+                break
+
+        sync = buf[pos + 2]
+        if sync == 0x12 and buf[pos + 3] == hlen_long and pos + hlen_long <= buflen:
+            header = nt_long._make(s_long.unpack_from(buf, pos + 3))
+            hend = pos + hlen_long
+        elif sync == 0x13 and pos + hlen_short <= buflen:
+            header = nt_short._make(s_short.unpack_from(buf, pos + 3))
+            hend = pos + hlen_short
+        else:
+            pos += 1
+            continue
+
+        if badstart < pos:
+            # Garbage data has 0 as value for the msglen, and None for the header
+            yield (0, None, None, mv[badstart:pos])
+
+        # Add 4 bytes for the CRC
+        mend = hend + header.msglen + 4
+        if mend > buflen:
+            mend = buflen
+        yield (header.msglen, header, mv[pos:hend], mv[hend:mend])
+        pos = badstart = mend
+
+    # yield bad data at the end
+    if badstart < buflen:
+        yield (0, None, None, mv[badstart:])
+
+
+##############################################################################
+# Sidecar time index (see bognss/fileio.py)
+#
+# Every packet with a valid time (week > 0) is stamped with its own time.
+
+IDX_SUFFIX = fileio.IDX_SUFFIX
+IDX_MAGIC = b'NVTX'
+
+
+def index_packet(record):
+    """ (msgid, length, gpstime, new_epoch) of a NovatelReader record, for fileio.build_index """
+    _, header, headerbytes, msgbytes = record
+    if header is None:
+        return None, len(msgbytes), None, False
+    gpstime = header.gnssweek * gps_week_secs + header.gnssmsec / 1000. if header.gnssweek > 0 else None
+    return header.msgid, len(headerbytes) + len(msgbytes), gpstime, True
+
+
+def build_index(fp):
+    """ Scan a Novatel stream (from its current position) or buffer and return a fileio.Index
+    of all packets.  Packets without a valid time (week 0) are given the time of
+    the preceding packet, or of the first packet with a time. """
+    return fileio.build_index(fp, make_reader, index_packet)
+
+
+def load_index(infile, rebuild=False):
+    """ Load the sidecar index for infile, building and saving it if it is
+    missing or out of date """
+    return fileio.load_index(infile, IDX_MAGIC, build_index, rebuild)
+
+
+def seek_time(fp, gpstime, index=None):
+    """ Position fp at the first packet at or after gpstime (GPS seconds)
+    and return the new file offset.  If index is None, the sidecar index for
+    fp is loaded (or built). """
+    if index is None:
+        index = load_index(fp.name)
+    return fileio.seek_time(fp, gpstime, index)
+
+
+def iter_range(fp, t0, t1, index=None, **kwargs):
+    """ Parse the packets with GPS time t0 <= t < t1 from file fp.
+    Extra keyword arguments are passed to NovatelParser """
+    if index is None:
+        index = load_index(fp.name)
+    return fileio.iter_range(fp, t0, t1, index, NovatelParser, **kwargs)
+
+
 def parse_nvt_msg140(buffer):
     # Parse Novatel message 140 (RANGECMP)
     # Number of observations is usually < 128, so zero out nobs high order bits.
@@ -527,82 +681,204 @@ def parse_nvt_msg140(buffer):
     msgbytes    = buffer[(3+MsgDef_NVT0x12.struct.size):]
     header = MsgDef_NVT0x12.nt._make(MsgDef_NVT0x12.struct.unpack(headerbytes))
 
-    logging.debug("msg140: header   %s", str(header))
-    logging.debug("msg140: msgbytes (%d) %s", len(msgbytes),  msgbytes.hex())
+    is_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    logging.debug("msg140: header   %s", header)
+    if is_debug:
+        logging.debug("msg140: msgbytes (%d) %s", len(msgbytes),  msgbytes.hex())
     s_int = struct.Struct('<L')
     
     (nobs,) = s_int.unpack(msgbytes[0:4])
-    logging.debug("msg140: nobs={:d}".format(nobs) )
+    logging.debug("msg140: nobs=%d", nobs)
     # TODO: figure out nobs from message length
     if nobs > 100:
         nobs0=nobs
-        nobs = (len(msgbytes)-4)/24
-        logging.info("Suspiciously high nobs value ({0:d}/0x{0:08x}). Using {1:d}".format(nobs0, nobs ) )
+        nobs = (len(msgbytes)-4)//24
+        logging.info("Suspiciously high nobs value (%d/0x%08x). Using %d", nobs0, nobs0, nobs)
         #assert(nobs < 100) # usually less than this.
 
 
+    records = []
     for (i,j) in enumerate(range(4, len(msgbytes)-4, 24) ):
         rangelog_data = msgbytes[j:(j+24)]
 
-        logging.debug("msg140: rangelog %2d bin %s", i, rangelog_data.hex())
+        if is_debug:
+            logging.debug("msg140: rangelog %2d bin %s", i, rangelog_data.hex())
 
         if len(rangelog_data) != 24:
             logging.debug("msg140: rangelog %2d too short (len=%d)", i, len(rangelog_data))
             break
 
-        
-        # Channel tracking status (bits 0-31, 32 bits)
-        cts   = s_int.unpack(rangelog_data[0:4] )[0]
-        # Doppler frequency (bits 32-59, 28 bits)
-        dfreq = float(s_int.unpack( rangelog_data[4:8] )[0] & 0x0fffffff ) / 256.0
-        # Pseudorange (PSR) (bits 60-95, 36 bits)
-        psr_low  = int(rangelog_data[7])
-        psr_high = s_int.unpack( rangelog_data[8:12] )[0] & 0x0fffffff
-        psr      = (float(psr_low) + float(psr_high) * 256.0) / 128.0
-        # ADR (bits 96-127, 32 bits)
-        adr   = float(s_int.unpack( rangelog_data[12:16])[0] ) / 256.0
-        # StdDev-PSR (128-131, 4 bits) TODO: fully decode and confirm high/low order
-        stddev_psr = rangelog_data[16] & 0x0f
-        # StdDev-ADR (132-135, 4 bits) # TODO: confirm high/low order
-        stddev_adr = float((( rangelog_data[16] & 0xf0) >> 4) + 1) / 512.0
-        # PRN/Slot (136-143, 8 bits)
-        prnslot    = rangelog_data[17]
-        # Lock Time (144-164, 21 bits)
-        locktime   = float(s_int.unpack(rangelog_data[18:22])[0] & 0x001fffff) / 32.0
-        # C/No (bits 165-169, 5 bits) # TODO: finish decoding
-        cno        = struct.unpack('<H', rangelog_data[20:22])[0]
-        # GLONASS Frequency number (bits 170-175, n+7 bits?)
-        glofreqnum = rangelog_data[21] # & mask
-        #
-        resvd1     = struct.unpack('<H', rangelog_data[22:])[0]
-
-
-        data = NVT_Msg140._make( (cts, dfreq, psr, adr, stddev_psr, stddev_adr, prnslot, locktime, cno, glofreqnum, resvd1) )
-        fmtstr = "cts={0.cts:08x} dfreq={0.dfreq:0.7f} psr={0.psr:0.3f} adr={0.adr:0.8f} std_psr=0x{0.stddev_psr:x} std_adr={0.stddev_adr:f} prnslot={0.prnslot:d} locktime={0.locktime:f} C/No={0.cno:04x} glofreqnum={0.glofreqnum:d} resvd={0.resvd1:04x}"
-        logging.debug("msg140: rangelog {:2d} dat {:s}".format(i, fmtstr.format(data)) )
-    
+        data = decode_rangecmp_record(rangelog_data)
+        records.append(data)
+        if is_debug:
+            fmtstr = "cts={0.cts:08x} dfreq={0.dfreq:0.7f} psr={0.psr:0.3f} adr={0.adr:0.8f} std_psr={0.stddev_psr:0.3f} std_adr={0.stddev_adr:f} prnslot={0.prnslot:d} locktime={0.locktime:f} C/No={0.cno:d} glofreqnum={0.glofreqnum:d} resvd={0.resvd1:04x}"
+            logging.debug("msg140: rangelog %2d dat %s", i, fmtstr.format(data))
+    return records
+
+
+# RANGECMP pseudorange standard deviations (m), indexed by the 4-bit StdDev-PSR field
+RANGECMP_STDDEV_PSR = (0.050, 0.075, 0.113, 0.169, 0.253, 0.380, 0.570, 0.854,
+                       1.281, 2.375, 4.750, 9.500, 19.000, 38.000, 76.000, 152.000)
+
+def decode_rangecmp_record(rangelog_data):
+    """ Decode one 24-byte RANGECMP observation record into an NVT_Msg140.
+    Bit layout is from the OEM6 firmware reference (RANGECMP) """
+    (w0, w1, w2, w3, w4, w5) = struct.unpack('<6L', rangelog_data)
+    # Channel tracking status (bits 0-31, 32 bits)
+    cts   = w0
+    # Doppler frequency (bits 32-59, 28 bits, signed) in 1/256 Hz
+    dfreq = w1 & 0x0fffffff
+    if dfreq & 0x08000000:
+        dfreq -= 0x10000000
+    dfreq = dfreq / 256.0
+    # Pseudorange (PSR) (bits 60-95, 36 bits) in 1/128 m
+    psr   = ((w2 << 4) | (w1 >> 28)) / 128.0
+    # ADR (bits 96-127, 32 bits, signed) in 1/256 cycles
+    adr   = (w3 - 0x100000000 if w3 & 0x80000000 else w3) / 256.0
+    # StdDev-PSR (128-131, 4 bits), as a lookup
+    stddev_psr = RANGECMP_STDDEV_PSR[w4 & 0x0f]
+    # StdDev-ADR (132-135, 4 bits), in 1/512 cycles
+    stddev_adr = (((w4 >> 4) & 0x0f) + 1) / 512.0
+    # PRN/Slot (136-143, 8 bits)
+    prnslot    = (w4 >> 8) & 0xff
+    # Lock Time (144-164, 21 bits) in 1/32 s
+    w = (w4 >> 16) | ((w5 & 0xffff) << 16)
+    locktime   = (w & 0x001fffff) / 32.0
+    # C/No (bits 165-169, 5 bits), offset by 20 dB-Hz
+    cno        = ((w >> 21) & 0x1f) + 20
+    # GLONASS Frequency number (bits 170-175, 6 bits, n+7)
+    glofreqnum = (w >> 26) & 0x3f
+    # Reserved (bits 176-191)
+    resvd1     = w5 >> 16
+
+    return NVT_Msg140._make( (cts, dfreq, psr, adr, stddev_psr, stddev_adr, prnslot, locktime, cno, glofreqnum, resvd1) )
+
+
+# Array form of NVT_Msg140, plus the time of the containing message
+RANGECMP_DTYPE = np.dtype([
+    ('gnssweek', '<u2'), ('gnsssec', '<f8'),
+    ('cts', '<u4'), ('dfreq', '<f8'), ('psr', '<f8'), ('adr', '<f8'),
+    ('stddev_psr', '<f8'), ('stddev_adr', '<f8'), ('prnslot', 'u1'),
+    ('locktime', '<f8'), ('cno', 'u1'), ('glofreqnum', 'u1'), ('resvd1', '<u2'),
+])
+
+def rangecmp_count(msgbytes):
+    """ Number of complete observation records in a RANGECMP message body """
+    navail = max(0, (len(msgbytes) - 8) // 24) # less nobs and crc
+    (nobs,) = struct.unpack_from('<L', msgbytes) if len(msgbytes) >= 4 else (0,)
+    return min(nobs, navail)
+
+def decode_rangecmp(records, gnssweek=0, gnsssec=0.):
+    """ Decode a buffer of concatenated 24-byte RANGECMP observation records
+    into an array of RANGECMP_DTYPE, with the same values as decode_rangecmp_record.
+    gnssweek and gnsssec may be scalars or per-record arrays """
+    nrec = len(records) // 24
+    w = np.frombuffer(records, dtype='<u4', count=nrec * 6).reshape(nrec, 6)
+    w1, w4, w5 = w[:, 1], w[:, 4], w[:, 5]
+    out = np.empty(nrec, dtype=RANGECMP_DTYPE)
+    out['gnssweek'] = gnssweek
+    out['gnsssec'] = gnsssec
+    out['cts'] = w[:, 0]
+    # Sign-extend the 28-bit doppler by shifting it to the top of an int32
+    out['dfreq'] = ((w1 << 4).view('<i4') >> 4) / 256.0
+    out['psr'] = ((w[:, 2].astype('<u8') << 4) | (w1 >> 28)) / 128.0
+    out['adr'] = w[:, 3].view('<i4') / 256.0
+    out['stddev_psr'] = np.take(RANGECMP_STDDEV_PSR, w4 & 0x0f)
+    out['stddev_adr'] = (((w4 >> 4) & 0x0f) + 1) / 512.0
+    out['prnslot'] = (w4 >> 8) & 0xff
+    w = (w4 >> 16) | ((w5 & 0xffff) << 16)
+    out['locktime'] = (w & 0x001fffff) / 32.0
+    out['cno'] = ((w >> 21) & 0x1f) + 20
+    out['glofreqnum'] = (w >> 26) & 0x3f
+    out['resvd1'] = w5 >> 16
+    return out
+
+def decode_msg140(header, msgbytes):
+    """ Decode all observations in a RANGECMP message into an array of RANGECMP_DTYPE """
+    nobs = rangecmp_count(msgbytes)
+    return decode_rangecmp(msgbytes[4:4 + 24 * nobs], header.gnssweek, header.gnssmsec / 1000.)
+
+def read_rangecmp(fp):
+    """ Read all RANGECMP observations in a Novatel file or buffer into one
+    array of RANGECMP_DTYPE, decoded in a single pass """
+    records = bytearray()
+    weeks, secs, counts = [], [], []
+    for rec in NovatelParser(fp, msgids=(140,)):
+        nobs = rangecmp_count(rec.msgbytes)
+        records += rec.msgbytes[4:4 + 24 * nobs]
+        weeks.append(rec.header.gnssweek)
+        secs.append(rec.header.gnssmsec / 1000.)
+        counts.append(nobs)
+    return decode_rangecmp(records, np.repeat(weeks, counts), np.repeat(secs, counts))
+
+
+def bench_rangecmp(infile, repeat=1000):
+    """ Compare the scalar and vectorized RANGECMP decoders on the messages in
+    infile, check that they agree, and log their speed in records per second """
+    import time
+    with open_input(infile) as fin:
+        msgs = [(rec.header, bytes(rec.msgbytes)) for rec in NovatelParser(fin, msgids=(140,))]
+    nrec = sum(rangecmp_count(msgbytes) for _, msgbytes in msgs)
+    if nrec == 0:
+        logging.warning("No RANGECMP records in %s", infile)
+        return
 
-def bo_avnnp(input_bxds, outdir,messages, overwrite, b_calc_crc=False,b_correct_crc=False):
+    t0 = time.time()
+    for _ in range(repeat):
+        scalar = [decode_rangecmp_record(msgbytes[j:j+24]) for _, msgbytes in msgs
+                  for j in range(4, 4 + 24 * rangecmp_count(msgbytes), 24)]
+    dt_scalar = max(time.time() - t0, 1e-6)
+    t0 = time.time()
+    for _ in range(repeat):
+        vector = [decode_msg140(header, msgbytes) for header, msgbytes in msgs]
+    dt_vector = max(time.time() - t0, 1e-6)
+    # All records of all messages (and repetitions) at once, as read_rangecmp does
+    records = b''.join(msgbytes[4:4 + 24 * rangecmp_count(msgbytes)] for _, msgbytes in msgs) * repeat
+    t0 = time.time()
+    decode_rangecmp(records)
+    dt_bulk = max(time.time() - t0, 1e-6)
+
+    vector = np.concatenate(vector)
+    for field in NVT_Msg140._fields:
+        if not np.array_equal(vector[field], [getattr(r, field) for r in scalar]):
+            raise ValueError("RANGECMP decoders disagree on field " + field)
+
+    print("RANGECMP: {:d} records in {:d} messages, {:d} repetitions".format(nrec, len(msgs), repeat))
+    print("RANGECMP: scalar {:0.0f} records/s".format(nrec * repeat / dt_scalar))
+    print("RANGECMP: vectorized per message {:0.0f} records/s ({:0.1f}x)".format(
+          nrec * repeat / dt_vector, dt_scalar / dt_vector))
+    print("RANGECMP: vectorized whole file {:0.0f} records/s ({:0.1f}x)".format(
+          nrec * repeat / dt_bulk, dt_scalar / dt_bulk))
+
+
+
+def bo_avnnp(input_bxds, outdir,messages, overwrite, b_calc_crc=False,b_correct_crc=False,
+             parser_stats=None):
     """ Write a series of xds files into outdir, from data in input_bxds
     Optionally, choose a subset of messages to write xds files for.  messages
     is a sequence (list or tuple) of message IDs to be included.  To write
     all messages, set messages = None.  To write no message, set messages = []
+    Returns the count of each message id read.  The parser's error counts
+    are kept in parser_stats (see NovatelParser) if it is a dict.
     """
     dict_ofh={}
+    msgcount = {}
     # if messages is not set, then just write all messages.
     # (if messages is the empty set, write no messages)
     set_msgs = None if messages is None else frozenset(messages)
 
     fpos1=0
-    with open(input_bxds,"rb") as fh:
+    with open_input(input_bxds) as fh:
         #msgids=None, b_calc_crc=False, b_correct_crc=False):
-        for data in NovatelParser(fh, msgids=None, b_calc_crc=b_calc_crc, b_correct_crc=b_correct_crc):
+        for data in NovatelParser(fh, msgids=None, b_calc_crc=b_calc_crc, b_correct_crc=b_correct_crc,
+                                  stats=parser_stats):
             id = data.header.msgid
+            msgcount[id] = msgcount.get(id, 0) + 1
 
             if data.msglen > 0 and data.parsed is not None:
                 xhead = make_xds_header(data.header)
                 xds = make_xds( id, data.parsed )
-                logging.debug("msg: %s %s", str(data.header), xds)
+                logging.debug("msg: %s %s", data.header, xds)
 
                 if set_msgs is None or id in set_msgs:
                     if id not in dict_ofh:
@@ -618,11 +894,12 @@ def bo_avnnp(input_bxds, outdir,messages, overwrite, b_calc_crc=False,b_correct_
                         logging.info("Writing breakout %s", ofn)
                     dict_ofh[id].write(xhead + ' ' + xds + "\n")
             else:
-                logging.debug(str(data))
+                logging.debug("%s", data)
 
     # Close in a repeatable order
     for id in sorted(dict_ofh):
         dict_ofh[id].close()
+    return msgcount
 
 
 
@@ -631,8 +908,19 @@ def test(args):
     t0 = time.time()
     stats = {}
     # TODO: make rec a namedtuple in NovatelParser
-    with open(args.input,'rb') as f:
-        for i,rec in enumerate(NovatelParser(f, args.message, args.crc, args.correct)):
+    mapped = open_mmap(args.input) if args.mmap else contextlib.nullcontext()
+    with open_input(args.input) as f, mapped as mm:
+        if args.index or args.start is not None or args.end is not None:
+            index = load_index(args.input, rebuild=args.index)
+            logging.info("Index: %d packets", len(index.offsets))
+            # Times on the command line are seconds of the first week in the file
+            tstart, tend = fileio.week_range(index, args.start, args.end)
+            records = iter_range(f, tstart, tend, index, msgids=args.message,
+                                 b_calc_crc=args.crc, b_correct_crc=args.correct)
+        else:
+            records = NovatelParser(mm if args.mmap else f, args.message, args.crc, args.correct)
+
+        for i,rec in enumerate(records):
             if rec.parsed is not None:
                 xds = make_xds( rec.header.msgid , rec.parsed )
             else:
@@ -644,7 +932,7 @@ def test(args):
             print('#' + xhead, xds)
 
             if rec.header.msgid == 140:
-                parse_nvt_msg140( rec.headerbytes + rec.msgbytes )
+                parse_nvt_msg140( bytes(rec.headerbytes) + rec.msgbytes )
 
             # Increment stats counter
             stats[rec.header.msgid] = stats.get(rec.header.msgid,0) + 1
@@ -652,7 +940,7 @@ def test(args):
             if args.limit is not None and i >= args.limit:
                 break
 
-        filesize = f.tell()
+        filesize = f.tell() if not args.mmap else len(mm)
 
     logging.info('Message count:')
     logging.info(repr(stats))
@@ -676,8 +964,8 @@ if __name__ == "__main__":
                         required=False)
     parser.add_argument('--maxbiterrors', type=int, default=1, help='Max number of bit errors to correct',
                         required=False)
-    parser.add_argument('--profile',  action="store_true", help='Profile code',
-                        required=False, default="")
+    parser.add_argument('--profile',  action="store_true", help='Profile with cProfile, printing the top functions to stderr',
+                        required=False)
     parser.add_argument('-v','--verbose',  action="store_true", help='Verbose output',
                         required=False)
     parser.add_argument('--limit', type=int, help='Max number of records to process.',
@@ -687,6 +975,18 @@ if __name__ == "__main__":
                         required=False, default="")
     parser.add_argument('-o','--output', help='Output directory or file',
                         required=False)
+    parser.add_argument('--mmap', action="store_true", help='Read the input file through a memory map',
+                        required=False)
+    parser.add_argument('--index', action="store_true", help='Rebuild the sidecar time index for the input file',
+                        required=False)
+    parser.add_argument('--start', type=float, help='Start time (GPS seconds of week) to read from, using the sidecar index',
+                        required=False, default=None)
+    parser.add_argument('--end', type=float, help='End time (GPS seconds of week) to read to, using the sidecar index',
+                        required=False, default=None)
+    parser.add_argument('--bench140', action="store_true", help='Benchmark and cross-check the RANGECMP decoders',
+                        required=False)
+    parser.add_argument('--throughput', action="store_true", help='Report parsing throughput, with and without decompression',
+                        required=False)
     args = parser.parse_args()
 
     loglevel = logging.DEBUG if args.verbose else logging.WARNING
@@ -695,15 +995,22 @@ if __name__ == "__main__":
 
     args.message = frozenset(args.message) if len(args.message) > 0 else None
 
-
-
-
-
-
-
-
-
-    test(args)
+    if not os.path.isfile(args.input):
+        parser.error("No input file %r" % args.input)
+    if compression_type(args.input) is not None:
+        if args.index or args.start is not None or args.end is not None:
+            parser.error("--index, --start and --end need an uncompressed input file")
+        if args.mmap:
+            logging.warning("%s is compressed, so it will be streamed rather than mapped", args.input)
+            args.mmap = False
+
+    with fileio.profiled(args.profile):
+        if args.bench140:
+            bench_rangecmp(args.input)
+        elif args.throughput:
+            bench_throughput(args.input, NovatelParser)
+        else:
+            test(args)
 
 
 
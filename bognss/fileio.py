@@ -0,0 +1,430 @@
+"""
+File input shared by the Novatel and GREIS decoders: memory-mapped
+files, compressed files read through a helper thread, and the sidecar
+time index.
+"""
+
+from array import array
+from collections import namedtuple
+import bisect
+import contextlib
+import io
+import logging
+import mmap
+import os
+import queue
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+
+# In-memory inputs, read by a decoder's buffer reader instead of its stream reader
+BUFFER_TYPES = (bytes, bytearray, mmap.mmap)
+
+
+def make_reader(fp, stream_reader, buffer_reader, *args):
+    """ Return buffer_reader(fp, *args) if fp is a buffer, otherwise
+    stream_reader(fp, *args) """
+    if isinstance(fp, BUFFER_TYPES):
+        return buffer_reader(fp, *args)
+    return stream_reader(fp, *args)
+
+
+@contextlib.contextmanager
+def open_mmap(infile):
+    """ Map infile read-only into memory, for reading with a decoder's
+    buffer reader.  Compressed files can't be mapped, so they are
+    streamed instead. """
+    if compression_type(infile) is not None: # can't map it, so stream it
+        with open_input(infile) as fin:
+            yield fin
+        return
+    with open(infile, 'rb') as fin:
+        try:
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty files can't be mapped
+            yield b''
+            return
+        try:
+            yield mm
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                # Slices of the map are still referenced, so it will be
+                # unmapped when they are released.
+                pass
+
+
+# Compressed inputs, by their magic numbers
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+DECOMPRESS_BLOCK = 1 << 20
+
+def compression_type(infile):
+    """ Return 'gzip', 'xz' or 'zstd' if infile is compressed, else None """
+    with open(infile, 'rb') as fin:
+        magic = fin.read(6)
+    for prefix, kind in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return kind
+    return None
+
+def open_decompressed(infile, kind):
+    """ Open a compressed file as a stream of decompressed bytes. zstd uses
+    the zstandard module if it is installed, otherwise the zstd command. """
+    if kind == 'gzip':
+        import gzip
+        return gzip.open(infile, 'rb')
+    if kind == 'xz':
+        import lzma
+        return lzma.open(infile, 'rb')
+    try:
+        import zstandard
+    except ImportError:
+        return io.BufferedReader(CommandReader(['zstd', '-dcq', infile]), DECOMPRESS_BLOCK)
+    return zstandard.ZstdDecompressor().stream_reader(open(infile, 'rb'), closefd=True)
+
+class CommandReader(io.RawIOBase):
+    """ Raw stream over the output of a command.  Its exit status is
+    checked at the end of the output, or when the stream is closed if
+    the command has exited by then, so that a command that fails (such as
+    zstd on a corrupt file) raises OSError rather than ending the data
+    early.  A command still running when the stream is closed is killed. """
+    def __init__(self, args):
+        super().__init__()
+        self.args = args
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.checked = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if n == 0 and len(b) > 0:
+            self._check()
+        return n
+
+    def _check(self):
+        self.checked = True
+        status = self.proc.wait()
+        if status != 0:
+            raise OSError("%s exited with status %d" % (' '.join(self.args), status))
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.proc.stdout.close()
+                if self.proc.poll() is None: # stopped reading before the end
+                    self.proc.kill()
+                    self.proc.wait()
+                elif not self.checked:
+                    self._check()
+            finally:
+                super().close()
+
+class ThreadedDecompressor(io.RawIOBase):
+    """ Raw stream over a compressed file.  A helper thread decompresses
+    it a block at a time into a short queue, so that decompression
+    overlaps with parsing.  Wrap it in an io.BufferedReader (as
+    open_input does) so that small reads don't each cost a method call. """
+    def __init__(self, infile, kind=None, blocksize=DECOMPRESS_BLOCK, depth=4):
+        super().__init__()
+        self.name = infile
+        self.stream = open_decompressed(infile, kind or compression_type(infile))
+        self.blocksize = blocksize
+        self.queue = queue.Queue(depth)
+        self.stopping = False
+        self.eof = False
+        self.block = memoryview(b'')
+        self.pos = 0 # offset in the decompressed data
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopping:
+                block = self.stream.read(self.blocksize)
+                self._put(block)
+                if not block:
+                    break
+        except Exception as e: # handed to the reader
+            self._put(e)
+
+    def _put(self, item):
+        """ Queue a block or an exception for the reader, unless it stops """
+        while not self.stopping:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.block:
+            if self.eof:
+                return 0
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                self.eof = True
+                raise block
+            if not block:
+                self.eof = True
+                return 0
+            self.block = memoryview(block)
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.stopping = True
+            self.thread.join()
+            self.stream.close()
+        super().close()
+
+@contextlib.contextmanager
+def open_input(infile):
+    """ Open infile for reading, decompressing it on a helper thread if
+    it is gzip, xz or zstd compressed """
+    kind = compression_type(infile)
+    if kind is None:
+        with open(infile, 'rb') as fin:
+            yield fin
+    else:
+        with io.BufferedReader(ThreadedDecompressor(infile, kind), DECOMPRESS_BLOCK) as fin:
+            yield fin
+
+
+def bench_throughput(infile, parse, repeat=10):
+    """ Parse infile repeat times with parse (a function of a file object
+    or buffer that yields its messages) and print the throughput in
+    decompressed MB/s and messages/s: from memory, from the file, and if
+    it is compressed, decompressing inline and on a helper thread """
+    kind = compression_type(infile)
+    with open_input(infile) as fin:
+        data = fin.read()
+    modes = [('memory', lambda: data)]
+    if kind is None:
+        modes.append(('file', lambda: open(infile, 'rb')))
+    else:
+        modes.append((kind + ' inline', lambda: open_decompressed(infile, kind)))
+        modes.append((kind + ' threaded', lambda: io.BufferedReader(ThreadedDecompressor(infile, kind), DECOMPRESS_BLOCK)))
+    for name, opener in modes:
+        nmsgs = 0
+        t0 = time.time()
+        for _ in range(repeat):
+            fin = opener()
+            nmsgs += sum(1 for _ in parse(fin))
+            if fin is not data:
+                fin.close()
+        dt = max(time.time() - t0, 1e-6)
+        print("throughput: {:s} {:s}: {:0.2f} MB/s, {:0.0f} msgs/s".format(
+              os.path.basename(infile), name, len(data) * repeat / dt / 1e6, nmsgs / dt))
+
+
+# Functions listed by --profile
+PROFILE_TOP = 25
+
+@contextlib.contextmanager
+def profiled(enabled, top=PROFILE_TOP):
+    """ Run the body under cProfile if enabled, then print its top
+    functions by cumulative time to stderr (the decoders' --profile) """
+    if not enabled:
+        yield
+        return
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(top)
+
+
+##############################################################################
+# Sidecar time index
+#
+# The index records the file offset, message ID and GPS time of every packet
+# in a file, so that the file can be entered at any time without scanning it
+# from the start.  It is built in one pass and saved next to the input file
+# (input + IDX_SUFFIX), and rebuilt when the input file's size or mtime changes.
+# Each decoder supplies the reader, the time of each packet and its own magic
+# number for the index file.
+#
+# Times are GPS seconds since the GPS epoch (week * 604800 + seconds of week).
+
+GPS_WEEK_SECS = 604800
+
+IDX_SUFFIX = '.idx'
+# 2: times clamped to nondecreasing
+IDX_VERSION = 2
+# magic, version, number of records, source file size, source file mtime (ns)
+S_IDX_HEADER = struct.Struct('<4sHxxQQQ')
+
+# Columns of the index, as arrays of type Q, H and d
+Index = namedtuple('Index', 'offsets msgids times')
+
+
+def new_index():
+    return Index(array('Q'), array('H'), array('d'))
+
+
+def build_index(fp, reader, packet_info):
+    """ Scan a stream (from its current position) or buffer with reader and
+    return an Index of its packets.  packet_info(record) returns the
+    packet's (msgid, length, gpstime, new_epoch) for each record from
+    reader: its message id (None for data between packets), its length in
+    bytes, its GPS time (None if it has none), and whether it starts an
+    epoch.  A packet without a time is given the time of the one before it,
+    and when a packet has a time, the packets earlier in its epoch (and
+    those before the first time in the file) are given it too.  Times are
+    then made nondecreasing, for seek_time's bisection: packets logged at a
+    high rate (such as Novatel RAWIMU) can carry times a little before
+    those of the packets around them, and are given the latest time so far. """
+    index = new_index()
+    offset = 0 if isinstance(fp, BUFFER_TYPES) else fp.tell()
+    gpstime = None
+    epoch_start = 0 # index of the first packet in the current epoch
+    for record in reader(fp):
+        msgid, length, t, new_epoch = packet_info(record)
+        if msgid is not None:
+            if new_epoch:
+                epoch_start = len(index.times)
+            if t is not None:
+                first = 0 if gpstime is None else epoch_start
+                gpstime = t
+                for i in range(first, len(index.times)):
+                    index.times[i] = gpstime
+            index.offsets.append(offset)
+            index.msgids.append(msgid)
+            index.times.append(0. if gpstime is None else gpstime)
+        offset += length
+    tmax = 0.
+    for i, t in enumerate(index.times):
+        if t < tmax:
+            index.times[i] = tmax
+        else:
+            tmax = t
+    return index
+
+
+def index_stamp(infile):
+    """ Return the values that identify the version of infile that an index was built from """
+    st = os.stat(infile)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def write_index(idxfile, index, stamp, magic):
+    """ Write an index to idxfile.  Columns are stored little-endian """
+    with open(idxfile, 'wb') as fout:
+        fout.write(S_IDX_HEADER.pack(magic, IDX_VERSION, len(index.offsets), *stamp))
+        for col in index:
+            if sys.byteorder == 'big': # pragma: no cover
+                col = array(col.typecode, col)
+                col.byteswap()
+            col.tofile(fout)
+
+
+def read_index(idxfile, magic, stamp=None):
+    """ Read an index from idxfile.  Returns None if the file is missing or
+    unreadable, if it isn't an index with this magic number, or if it
+    doesn't match stamp """
+    try:
+        with open(idxfile, 'rb') as fin:
+            fmagic, version, nrec, size, mtime = S_IDX_HEADER.unpack(fin.read(S_IDX_HEADER.size))
+            if fmagic != magic or version != IDX_VERSION:
+                return None
+            if stamp is not None and (size, mtime) != tuple(stamp):
+                return None
+            index = new_index()
+            for col in index:
+                col.fromfile(fin, nrec)
+                if sys.byteorder == 'big': # pragma: no cover
+                    col.byteswap()
+    except (OSError, EOFError, struct.error):
+        return None
+    return index
+
+
+def load_index(infile, magic, build, rebuild=False):
+    """ Load the sidecar index for infile, building it with build(buffer)
+    and saving it if it is missing or out of date """
+    idxfile = infile + IDX_SUFFIX
+    stamp = index_stamp(infile)
+    index = None if rebuild else read_index(idxfile, magic, stamp)
+    if index is None:
+        logging.info("Building index %s", idxfile)
+        with open_mmap(infile) as mm:
+            index = build(mm)
+        try:
+            write_index(idxfile, index, stamp, magic)
+        except OSError as e:
+            logging.warning("Could not write index %s: %s", idxfile, e)
+    return index
+
+
+def seek_time(fp, gpstime, index):
+    """ Position fp at the first packet at or after gpstime (GPS seconds)
+    and return the new file offset.  build_index makes the packet times
+    nondecreasing through the file. """
+    i = bisect.bisect_left(index.times, gpstime)
+    if i < len(index.offsets):
+        return fp.seek(index.offsets[i])
+    return fp.seek(0, os.SEEK_END)
+
+
+def iter_range(fp, t0, t1, index, parser, **kwargs):
+    """ Parse the packets with GPS time t0 <= t < t1 from file fp with
+    parser.  Extra keyword arguments are passed to parser """
+    start = seek_time(fp, t0, index)
+    i1 = bisect.bisect_left(index.times, t1)
+    if i1 < len(index.offsets):
+        fp = BoundedReader(fp, index.offsets[i1] - start)
+    yield from parser(fp, **kwargs)
+
+
+def first_time(index):
+    """ GPS time of the first packet in index with a time, or 0 if none has one """
+    return next((t for t in index.times if t > 0), 0.)
+
+
+def week_range(index, start=None, end=None):
+    """ The GPS times of start and end, given in seconds of the week of the
+    first packet in index with a time.  None is the start or end of the file. """
+    week0 = int(first_time(index) // GPS_WEEK_SECS) * GPS_WEEK_SECS
+    return (-float('inf') if start is None else week0 + start,
+            float('inf') if end is None else week0 + end)
+
+
+class BoundedReader:
+    """ File-like wrapper that reads at most nbytes from fp """
+    def __init__(self, fp, nbytes):
+        self.fp = fp
+        self.remain = max(0, nbytes)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remain:
+            size = self.remain
+        data = self.fp.read(size)
+        self.remain -= len(data)
+        return data
+
+    def tell(self):
+        return self.fp.tell()
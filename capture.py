@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+"""
+Serial capture: a thread that does nothing but move bytes from a serial
+port into a preallocated ring buffer, so that a slow decoder (or a GC
+pause) doesn't let the UART overrun.
+
+The decoder reads from the ring through a RingReader, which looks like
+a blocking file to NovatelReader, GREISReader and NmeaSerialReader.
+The capture thread can also tee the raw bytes to a RawRecorder, which
+writes them to disk on a thread of its own.
+
+Usage:
+
+./capture.py --pty tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --format nvt
+./capture.py --pty tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds --format jvd --baud 115200
+./capture.py --pty tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --record /tmp/raw --bench
+
+"""
+
+import argparse
+import collections
+from array import array
+import logging
+import os
+import sys
+import threading
+import time
+
+# Default ring size, about 27 s of 38400 baud
+RING_SIZE = 1 << 20
+
+# RawRecorder defaults: rotate segments at this size or age, and drop
+# input rather than queue more than RECORD_MAX_QUEUE bytes for the disk
+RECORD_MAX_BYTES = 100 << 20
+RECORD_MAX_SECONDS = 3600.
+RECORD_MAX_QUEUE = 64 << 20
+RECORD_BUFSIZE = 1 << 20
+
+class ByteRing:
+    """ Single-producer, single-consumer ring buffer of bytes.
+
+    The producer only ever advances `written` and the consumer only
+    `consumed` (both are running totals, not positions in the buffer),
+    so the two sides don't need a lock between them. When the ring is
+    full, incoming bytes are dropped and counted in `overrun`.
+    Each write is timestamped so that the consumer can tell when the
+    bytes it is decoding arrived (see arrival_time). """
+    def __init__(self, size=RING_SIZE, ntimes=4096):
+        self.buf = bytearray(size)
+        self.size = size
+        self.written = 0
+        self.consumed = 0
+        self.overrun = 0      # bytes dropped because the ring was full
+        self.max_backlog = 0
+        self.nwrites = 0
+        self.closed = False
+        # Running offset just past each of the last ntimes writes, and its
+        # time.monotonic(), in slot nstamps % ntimes
+        self.ntimes = ntimes
+        self.stamp_ends = array('Q', bytes(8 * ntimes))
+        self.stamp_times = array('d', bytes(8 * ntimes))
+        self.nstamps = 0
+        self.data_ready = threading.Event()
+
+    def backlog(self):
+        return self.written - self.consumed
+
+    def write(self, data, t=None):
+        """ Producer: copy data in, dropping what doesn't fit """
+        free = self.size - (self.written - self.consumed)
+        if len(data) > free:
+            self.overrun += len(data) - free
+            data = data[:free]
+        n = len(data)
+        if n:
+            pos = self.written % self.size
+            first = min(n, self.size - pos)
+            self.buf[pos:pos + first] = data[:first]
+            self.buf[:n - first] = data[first:]
+            self.written += n
+            slot = self.nstamps % self.ntimes
+            self.stamp_ends[slot] = self.written
+            self.stamp_times[slot] = time.monotonic() if t is None else t
+            self.nstamps += 1
+            self.max_backlog = max(self.max_backlog, self.written - self.consumed)
+        self.nwrites += 1
+        self.data_ready.set()
+
+    def read(self, n):
+        """ Consumer: take up to n bytes without waiting """
+        n = min(n, self.written - self.consumed)
+        pos = self.consumed % self.size
+        first = min(n, self.size - pos)
+        data = bytes(self.buf[pos:pos + first]) + bytes(self.buf[:n - first])
+        self.consumed += n
+        return data
+
+    def wait(self, timeout=None):
+        """ Consumer: wait until there is something to read, or the ring
+        is closed. Returns the backlog. """
+        while self.written == self.consumed and not self.closed:
+            self.data_ready.clear()
+            if self.written != self.consumed or self.closed:
+                break
+            if not self.data_ready.wait(timeout):
+                break
+        return self.written - self.consumed
+
+    def close(self):
+        """ Producer: no more data is coming """
+        self.closed = True
+        self.data_ready.set()
+
+    def arrival_time(self, offset):
+        """ time.monotonic() at which the byte at running offset arrived,
+        found by bisecting the end offsets of the writes kept. None if it
+        hasn't arrived, or arrived before the writes kept. The oldest write
+        kept is left out, as the producer may be overwriting it. """
+        n, ntimes = self.nstamps, self.ntimes
+        first = max(0, n - ntimes + 1)
+        lo, hi = first, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.stamp_ends[mid % ntimes] > offset:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == n or (lo == first and first > 0):
+            return None
+        return self.stamp_times[lo % ntimes]
+
+    def stats(self):
+        return {
+            'received': self.written + self.overrun,
+            'overrun': self.overrun,
+            'backlog': self.backlog(),
+            'max_backlog': self.max_backlog,
+            'reads': self.nwrites,
+        }
+
+
+class RingReader:
+    """ Blocking file-like view of a ByteRing's consumer side.
+    read(n) waits for n bytes, returning fewer only once the ring has
+    been closed and drained, like a file at EOF. """
+    def __init__(self, ring):
+        self.ring = ring
+
+    @property
+    def in_waiting(self):
+        return self.ring.backlog()
+
+    @property
+    def closed(self):
+        return self.ring.closed and self.ring.backlog() == 0
+
+    def tell(self):
+        return self.ring.consumed
+
+    def arrival_time(self):
+        """ time.monotonic() at which the last byte read arrived, or None """
+        consumed = self.ring.consumed
+        return self.ring.arrival_time(consumed - 1) if consumed else None
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.ring.size
+        out = b''
+        while len(out) < n:
+            if not self.ring.wait():
+                break
+            out += self.ring.read(n - len(out))
+        return out
+
+
+class RawRecorder(threading.Thread):
+    """ Writes raw input bytes to disk on its own thread.
+
+    write() only appends to a queue, so the caller never waits on the
+    disk. Output goes to segments named PREFIX_YYYYmmddTHHMMSSZ.SUFFIX
+    (UTC of the first byte), starting a new one when a segment reaches
+    max_bytes or max_seconds. If the disk falls more than max_queue
+    bytes behind, input is dropped and counted rather than queued. """
+    def __init__(self, outdir, prefix='raw', suffix='.bxds', max_bytes=RECORD_MAX_BYTES,
+                 max_seconds=RECORD_MAX_SECONDS, max_queue=RECORD_MAX_QUEUE,
+                 bufsize=RECORD_BUFSIZE):
+        super().__init__(daemon=True)
+        self.outdir = outdir
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_queue = max_queue
+        self.bufsize = bufsize
+        self.queue = collections.deque() # (time, bytes)
+        self.data_ready = threading.Event()
+        self.stop_ = threading.Event()
+        # queued and dropped are only changed by write(), written by run()
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.segments = []
+        self.fp = None
+        os.makedirs(outdir, exist_ok=True)
+
+    def write(self, data, t=None):
+        """ Queue data for the disk. Never blocks. """
+        if self.queued - self.written + len(data) > self.max_queue:
+            self.dropped += len(data)
+            return
+        self.queue.append((time.time() if t is None else t, data))
+        self.queued += len(data)
+        self.data_ready.set()
+
+    def segment_name(self, t):
+        stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(t))
+        name = os.path.join(self.outdir, '%s_%s%s' % (self.prefix, stamp, self.suffix))
+        n = 1
+        while os.path.exists(name) or name in self.segments:
+            name = os.path.join(self.outdir, '%s_%s_%d%s' % (self.prefix, stamp, n, self.suffix))
+            n += 1
+        return name
+
+    def open_segment(self, t):
+        self.close_segment()
+        name = self.segment_name(t)
+        self.fp = open(name, 'wb', buffering=self.bufsize)
+        self.segments.append(name)
+        self.seg_bytes = 0
+        self.seg_start = t
+        logging.info("Recording to %s", name)
+
+    def close_segment(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def run(self):
+        try:
+            while True:
+                stopping = self.stop_.is_set()
+                self.data_ready.wait(0.5)
+                self.data_ready.clear()
+                while self.queue:
+                    t, data = self.queue.popleft()
+                    if self.fp is None or self.seg_bytes >= self.max_bytes or \
+                            t - self.seg_start >= self.max_seconds:
+                        self.open_segment(t)
+                    self.fp.write(data)
+                    self.seg_bytes += len(data)
+                    self.written += len(data)
+                if self.fp is not None:
+                    self.fp.flush()
+                if stopping:
+                    break
+        except OSError as e:
+            logging.error('Recorder error: %r', e)
+        finally:
+            self.close_segment()
+
+    def stop(self):
+        """ Write out what is queued, then finish """
+        self.stop_.set()
+        self.data_ready.set()
+
+    def stats(self):
+        return {
+            'recorded': self.written,
+            'record_dropped': self.dropped,
+            'segments': len(self.segments),
+        }
+
+
+class SerialCapture(threading.Thread):
+    """ Thread that reads whatever a serial port has buffered and
+    writes it into a ring (and a recorder, if given), and nothing else """
+    def __init__(self, ser, ring=None, recorder=None):
+        super().__init__(daemon=True)
+        self.ser = ser
+        self.ring = ByteRing() if ring is None else ring
+        self.recorder = recorder
+        self.stop_ = threading.Event()
+
+    def run(self):
+        if self.recorder is not None:
+            self.recorder.start()
+        try:
+            while not self.stop_.is_set():
+                data = self.ser.read(self.ser.in_waiting or 1)
+                if data:
+                    self.ring.write(data)
+                    if self.recorder is not None:
+                        self.recorder.write(data)
+        except OSError as e: # includes serial.SerialException
+            logging.error('Device error: %r', e)
+        finally:
+            self.ring.close()
+            if self.recorder is not None:
+                self.recorder.stop()
+                self.recorder.join()
+
+    def stop(self):
+        self.stop_.set()
+
+    def reader(self):
+        return RingReader(self.ring)
+
+    def stats(self):
+        stats = self.ring.stats()
+        if self.recorder is not None:
+            stats.update(self.recorder.stats())
+        return stats
+
+
+def count_messages(fp, fmt):
+    """ Number of good messages the decoder for fmt finds in fp """
+    if fmt == 'nvt':
+        import bognss.NVT.nvt as nvt
+        return sum(1 for msglen, header, _, _ in nvt.NovatelReader(fp) if header is not None)
+    import bognss.JVD.greis as greis
+    return sum(1 for msg in greis.GREISReader(fp, skip_crlf=True) if msg[0] != b'??')
+
+def pty_check(infile, fmt, baud=115200, stall=0.5, chunk_ms=10., record=None,
+              record_bytes=16384):
+    """ Feed infile through a pseudo-terminal at the line rate for baud,
+    capture it with SerialCapture, and decode it on this thread after
+    stalling for a while once the first bytes arrive. Checks that the
+    decoder sees the same messages as it does reading the file
+    directly, without overruns, and that it can tell when the last byte
+    it read arrived. If record is a directory, also record
+    the input there in record_bytes segments and check them. """
+    import serial
+    with open(infile, 'rb') as fin:
+        data = fin.read()
+        fin.seek(0)
+        expected = count_messages(fin, fmt)
+
+    master, slave = os.openpty()
+    ser = serial.Serial(os.ttyname(slave), baud, timeout=0.1)
+    recorder = None
+    if record is not None:
+        recorder = RawRecorder(record, prefix=fmt, max_bytes=record_bytes)
+    cap = SerialCapture(ser, recorder=recorder)
+    bytes_per_sec = baud / 10. # 8N1
+    chunk = max(1, int(bytes_per_sec * chunk_ms / 1000.))
+
+    def writer():
+        t0 = time.time()
+        for i in range(0, len(data), chunk):
+            os.write(master, data[i:i + chunk])
+            dt = t0 + (i + chunk) / bytes_per_sec - time.time()
+            if dt > 0:
+                time.sleep(dt)
+        # Let the capture drain what's in the pty, then stop it
+        while cap.ring.written < len(data) and time.time() - t0 < len(data) / bytes_per_sec + 5:
+            time.sleep(0.05)
+        cap.stop()
+
+    t0 = time.time()
+    cap.start()
+    wt = threading.Thread(target=writer)
+    wt.start()
+
+    reader = cap.reader()
+    if stall:
+        reader.ring.wait()
+        time.sleep(stall) # as if the decoder had stalled
+    n = count_messages(reader, fmt)
+    dt = time.time() - t0
+    arrival = reader.arrival_time()
+    latency = time.monotonic() - arrival if arrival is not None else float('nan')
+    wt.join()
+    cap.join()
+    ser.close()
+    os.close(master)
+    os.close(slave)
+
+    stats = cap.stats()
+    ok = n == expected and stats['overrun'] == 0 and stats['received'] == len(data) and latency >= 0
+    if recorder is not None:
+        recorded = b''
+        for name in recorder.segments:
+            with open(name, 'rb') as fin:
+                recorded += fin.read()
+        ok = ok and recorded == data and (len(recorder.segments) > 1 or len(data) <= record_bytes)
+    print("pty %s: %d/%d messages, %d bytes in %.2f s at %d baud, last byte read %.3f s after arrival, %s: %s" %
+          (fmt, n, expected, stats['received'], dt, baud, latency,
+           ' '.join('%s=%d' % kv for kv in stats.items()), 'ok' if ok else 'FAILED'))
+    return ok
+
+def bench_record(infile, outdir, total=64 << 20, chunk=4096):
+    """ Cost of the capture thread's work per read (ring write, plus the
+    recorder's queue append when recording) with a consumer draining
+    the ring and the recorder writing to disk at the same time """
+    import numpy as np
+    with open(infile, 'rb') as fin:
+        data = fin.read()
+    data = (data * (chunk // len(data) + 1))[:chunk]
+    benchdir = os.path.join(outdir, 'bench')
+    result = {}
+    for record in (False, True):
+        ring = ByteRing()
+        recorder = RawRecorder(benchdir, prefix='bench', max_bytes=16 << 20) if record else None
+        if recorder is not None:
+            recorder.start()
+        consumer = threading.Thread(target=lambda: [None for _ in iter(lambda: RingReader(ring).read(65536), b'')])
+        consumer.start()
+        lat = np.empty(total // chunk)
+        t0 = time.perf_counter()
+        for i in range(len(lat)):
+            t1 = time.perf_counter()
+            ring.write(data)
+            if recorder is not None:
+                recorder.write(data)
+            lat[i] = time.perf_counter() - t1
+        dt = time.perf_counter() - t0
+        ring.close()
+        consumer.join()
+        if recorder is not None:
+            recorder.stop()
+            recorder.join()
+            for name in recorder.segments:
+                os.remove(name)
+        name = 'record' if record else 'no record'
+        print("%-9s: %.0f MB/s through the capture path, per read (%d bytes) "
+              "median %.1f us, p99 %.1f us, max %.0f us; %s" %
+              (name, total / dt / 1e6, chunk, 1e6 * np.median(lat), 1e6 * np.percentile(lat, 99),
+               1e6 * lat.max(), ' '.join('%s=%d' % kv for kv in
+                                         (recorder.stats() if recorder else ring.stats()).items())))
+        result[name] = lat
+    os.rmdir(benchdir)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial capture ring buffer test")
+    parser.add_argument('--pty', required=True, metavar='INFILE',
+                        help="Feed this file through a pty and decode it")
+    parser.add_argument('--format', default='nvt', choices=('nvt', 'jvd'))
+    parser.add_argument('--baud', default=115200, type=int)
+    parser.add_argument('--stall', default=0.5, type=float,
+                        help="Seconds to stall the decoder before starting")
+    parser.add_argument('--record', metavar='DIR',
+                        help="Also record the input to this directory, in small segments")
+    parser.add_argument('--bench', action='store_true',
+                        help="Measure the cost of recording on the capture path (needs --record)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    if not pty_check(args.pty, args.format, args.baud, args.stall, record=args.record):
+        sys.exit(1)
+    if args.bench and args.record:
+        bench_record(args.pty, args.record)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+How the Novatel and GREIS readers cope with a damaged serial link.
+
+The sample files in tests/data are repeated to a working size and
+damaged by each corruption profile: bit flips at a bit error rate,
+dropped and duplicated runs of bytes, and packets cut short. Each damaged
+copy is then read back, and the report gives the fraction of the
+original messages recovered, the false positives (messages whose
+checksum passes but which weren't in the original), the messages framed
+with a bad checksum, the bytes skipped to resynchronise, and the
+throughput of the stream reader (NovatelReader, GREISReader) and the
+buffer reader. The damage depends only on the seed, so the counts are
+reproducible; the throughputs are not.
+
+Usage:
+
+./corrupt.py
+./corrupt.py --seed 7 --size 4 -o corrupt.json
+./corrupt.py --profile ber=1e-5,drop=1e-4,run=32 -k nvt
+
+"""
+
+import argparse
+import collections
+import io
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+
+import numpy as np
+
+import bognss.NVT.nvt as nvt
+import bognss.JVD.greis as greis
+
+DATADIR = os.path.join(os.path.dirname(__file__), 'tests/data')
+SAMPLES = (
+    ('nvt', 'ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds'),
+    ('nvt', 'KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds'),
+    ('jvd', 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds'),
+)
+DEFAULT_SEED = 2023
+DEFAULT_SIZE = 1. # MB of each sample after repeating it
+# Fewest extra resync bytes to estimate their cost from
+MIN_RESYNC_BYTES = 1000
+
+# Corruption profiles: bit error rate, probabilities per byte of starting
+# a dropped or duplicated run, mean run length, and probability per
+# packet of cutting it short
+PROFILE_KEYS = ('ber', 'drop', 'dup', 'run', 'truncate')
+PROFILES = collections.OrderedDict((
+    ('clean', {}),
+    ('ber1e-6', {'ber': 1e-6}),
+    ('ber1e-5', {'ber': 1e-5}),
+    ('ber1e-4', {'ber': 1e-4}),
+    ('drop', {'drop': 1e-4, 'run': 16}),
+    ('dup', {'dup': 1e-4, 'run': 16}),
+    ('truncate', {'truncate': 0.01}),
+    ('mixed', {'ber': 1e-5, 'drop': 5e-5, 'dup': 5e-5, 'run': 16, 'truncate': 0.005}),
+))
+
+
+def parse_profile(spec):
+    """ A profile from 'key=value,...' with keys from PROFILE_KEYS """
+    profile = {}
+    for item in spec.split(','):
+        key, sep, value = item.partition('=')
+        if not sep or key not in PROFILE_KEYS:
+            raise ValueError("Bad profile item %r (expected key=value with key one of %s)" %
+                             (item, ', '.join(PROFILE_KEYS)))
+        profile[key] = float(value)
+    return profile
+
+
+def runs(rng, n, rate, mean_run):
+    """ Start offsets and lengths of runs starting with probability rate
+    at each of n bytes, with geometric lengths of mean mean_run """
+    starts = np.unique(rng.integers(0, n, rng.binomial(n, rate))) if rate else np.empty(0, int)
+    return starts, rng.geometric(1. / max(mean_run, 1.), len(starts))
+
+def corrupt(data, profile, rng, packet_offsets=None):
+    """ Damage data by the profile; returns the damaged bytes and a dict
+    of how much of each kind of damage was done. packet_offsets are the
+    start offsets of the packets in data, for truncation. """
+    done = {}
+    out = bytearray(data)
+    # Cut packets short, from a random point to the end of the packet
+    if profile.get('truncate') and packet_offsets is not None and len(packet_offsets) > 1:
+        ends = np.append(packet_offsets[1:], len(data))
+        cut = rng.random(len(packet_offsets)) < profile['truncate']
+        keep = np.ones(len(data), bool)
+        for start, end in zip(packet_offsets[cut], ends[cut]):
+            keep[rng.integers(start + 1, end) if end - start > 1 else start:end] = False
+        out = bytearray(np.frombuffer(bytes(out), np.uint8)[keep].tobytes())
+        done['truncated'] = int(cut.sum())
+    mean_run = profile.get('run', 1.)
+    if profile.get('drop'):
+        starts, lengths = runs(rng, len(out), profile['drop'], mean_run)
+        keep = np.ones(len(out), bool)
+        for start, length in zip(starts, lengths):
+            keep[start:start + length] = False
+        done['dropped'] = int(len(out) - keep.sum())
+        out = bytearray(np.frombuffer(bytes(out), np.uint8)[keep].tobytes())
+    if profile.get('dup'):
+        starts, lengths = runs(rng, len(out), profile['dup'], mean_run)
+        pieces, pos = [], 0
+        for start, length in zip(starts, lengths):
+            pieces.append(out[pos:start + length])
+            pieces.append(out[start:start + length])
+            pos = start + length
+        pieces.append(out[pos:])
+        done['duplicated'] = sum(len(p) for p in pieces) - len(out)
+        out = bytearray(b''.join(pieces))
+    if profile.get('ber'):
+        nbits = 8 * len(out)
+        bits = rng.integers(0, nbits, rng.binomial(nbits, profile['ber']))
+        arr = np.frombuffer(out, np.uint8)
+        np.bitwise_xor.at(arr, bits // 8, (1 << (bits % 8)).astype(np.uint8))
+        done['flipped'] = len(bits)
+    return bytes(out), done
+
+
+# Format adapters: the readers, and each framed message as (key, checksum ok)
+
+def nvt_crc32(data):
+    """ Novatel CRC32 of data, as nvt.CalculateBlockCRC32 but with zlib """
+    return zlib.crc32(data, 0xffffffff) ^ 0xffffffff
+
+def nvt_messages(records):
+    """ (message bytes, checksum ok) of each packet, and the resync bytes """
+    msgs, resync = [], 0
+    for msglen, header, headerbytes, msgbytes in records:
+        if header is None:
+            resync += len(msgbytes)
+            continue
+        raw = bytes(headerbytes) + bytes(msgbytes)
+        ok = len(msgbytes) >= 4 and nvt_crc32(raw[:-4]) == int.from_bytes(raw[-4:], 'little')
+        msgs.append((raw, ok))
+    return msgs, resync
+
+def jvd_messages(records):
+    msgs, resync = [], 0
+    for msg in records:
+        if msg.id == b'??':
+            resync += len(msg.body)
+            continue
+        raw = msg.id + msg.len + bytes(msg.body)
+        ok = len(msg.body) >= 1 and greis.crc8(raw[:-1]) == raw[-1]
+        msgs.append((raw, ok))
+    return msgs, resync
+
+FORMATS = {
+    'nvt': (lambda data: nvt.NovatelReader(io.BytesIO(data)), nvt.NovatelBufferReader, nvt_messages),
+    'jvd': (lambda data: greis.GREISReader(io.BytesIO(data), skip_crlf=True),
+            lambda data: greis.GREISBufferReader(data, skip_crlf=True), jvd_messages),
+}
+
+def packet_offsets(fmt, data):
+    """ Start offsets of the packets in clean data """
+    index = (nvt if fmt == 'nvt' else greis).build_index(data)
+    return np.frombuffer(index.offsets, np.uint64).astype(np.int64)
+
+def read_rate(reader, data, min_time=0.1):
+    """ MB/s of reader over data """
+    n, t0 = 0, time.perf_counter()
+    while True:
+        for _ in reader(data):
+            pass
+        n += 1
+        dt = time.perf_counter() - t0
+        if dt >= min_time:
+            return n * len(data) / dt / 1e6
+
+
+def run_profile(fmt, data, reference, profile, rng, offsets, min_time=0.1):
+    """ Damage data by the profile and read it back; reference is the
+    Counter of good messages in the clean data """
+    stream_reader, buffer_reader, messages = FORMATS[fmt]
+    damaged, done = corrupt(data, profile, rng, offsets)
+    msgs, resync = messages(buffer_reader(damaged))
+    remaining = collections.Counter(reference)
+    recovered = false_pos = bad = 0
+    for raw, ok in msgs:
+        if not ok:
+            bad += 1
+        elif remaining[raw] > 0:
+            remaining[raw] -= 1
+            recovered += 1
+        else:
+            false_pos += 1
+    total = sum(reference.values())
+    result = {
+        'bytes': len(damaged),
+        'damage': done,
+        'messages': total,
+        'recovered': recovered,
+        'recovered_fraction': recovered / total if total else 0.,
+        'false_positives': false_pos,
+        'bad_checksum': bad,
+        'resync_bytes': resync,
+        'stream_mb_s': read_rate(stream_reader, damaged, min_time),
+        'buffer_mb_s': read_rate(buffer_reader, damaged, min_time),
+    }
+    # The stream reader should frame the same packets as the buffer reader
+    result['readers_agree'] = messages(stream_reader(damaged)) == (msgs, resync)
+    return result
+
+
+def run_all(profiles, seed=DEFAULT_SEED, size=DEFAULT_SIZE, select=None, min_time=0.1):
+    """ Results by sample and profile name """
+    results = collections.OrderedDict()
+    for isample, (fmt, name) in enumerate(SAMPLES):
+        if select and select not in fmt and select not in name:
+            continue
+        with open(os.path.join(DATADIR, name), 'rb') as fin:
+            sample = fin.read()
+        data = sample * max(1, int(round(size * 1e6 / len(sample))))
+        offsets = packet_offsets(fmt, data)
+        clean, clean_resync = FORMATS[fmt][2](FORMATS[fmt][1](data))
+        reference = collections.Counter(raw for raw, ok in clean if ok)
+        # Cost of resynchronising: the stream reader's extra time over the
+        # clean data, per extra byte skipped (when there are enough of them
+        # to measure)
+        clean_time = len(data) / read_rate(FORMATS[fmt][0], data, min_time)
+        results[name] = collections.OrderedDict()
+        for iprofile, (pname, profile) in enumerate(profiles.items()):
+            rng = np.random.default_rng([seed, isample, iprofile])
+            r = run_profile(fmt, data, reference, profile, rng, offsets, min_time)
+            extra = r['resync_bytes'] - clean_resync
+            r['stream_us_per_resync_byte'] = ((r['bytes'] / r['stream_mb_s'] - clean_time) / extra
+                                              if extra >= MIN_RESYNC_BYTES else None)
+            results[name][pname] = r
+    return results
+
+def counts(results):
+    """ The reproducible part of the results """
+    return {name: {pname: {k: v for k, v in r.items() if not k.endswith(('_mb_s', '_byte'))}
+                   for pname, r in byprofile.items()}
+            for name, byprofile in results.items()}
+
+def report(results, profiles):
+    """ Print the results as a table (throughputs in MB/s) """
+    print("%-38s %-9s %9s %8s %6s %6s %8s %8s %8s %9s" %
+          ('sample', 'profile', 'messages', 'recov%', 'false+', 'badcs', 'resync', 'stream', 'buffer',
+           'us/resync'))
+    for name, byprofile in results.items():
+        for pname, r in byprofile.items():
+            cost = r['stream_us_per_resync_byte']
+            print("%-38s %-9s %9d %7.2f%% %6d %6d %8d %8.2f %8.2f %9s%s" %
+                  (name, pname, r['messages'], 100. * r['recovered_fraction'], r['false_positives'],
+                   r['bad_checksum'], r['resync_bytes'], r['stream_mb_s'], r['buffer_mb_s'],
+                   '-' if cost is None else '%.2f' % cost,
+                   '' if r['readers_agree'] else '  readers differ'))
+    for pname, profile in profiles.items():
+        print("%-9s %s" % (pname, ' '.join('%s=%g' % kv for kv in profile.items()) or 'no damage'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reader resilience to corrupted input")
+    parser.add_argument('--seed', default=DEFAULT_SEED, type=int, help="RNG seed (default %(default)d)")
+    parser.add_argument('--size', default=DEFAULT_SIZE, type=float,
+                        help="Repeat each sample to about this many MB (default %(default)g)")
+    parser.add_argument('--profile', action='append', metavar='KEY=VALUE,...',
+                        help="Run this corruption profile instead of the built-in ones (keys: %s); "
+                        "may be repeated" % ', '.join(PROFILE_KEYS))
+    parser.add_argument('-k', '--filter', help="Only samples whose format or name contains this")
+    parser.add_argument('--min-time', default=0.1, type=float, help="Minimum seconds per throughput measurement")
+    parser.add_argument('-o', '--output', help="Save the results to this JSON file")
+    parser.add_argument('--check', action='store_true',
+                        help="Also check that a second run with the same seed gives the same counts")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR, stream=sys.stdout)
+
+    profiles = PROFILES
+    if args.profile:
+        try:
+            profiles = collections.OrderedDict(('custom%d' % i, parse_profile(spec))
+                                               for i, spec in enumerate(args.profile))
+        except ValueError as e:
+            parser.error(str(e))
+    results = run_all(profiles, args.seed, args.size, args.filter, args.min_time)
+    report(results, profiles)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump({'seed': args.seed, 'size_mb': args.size, 'profiles': profiles, 'results': results},
+                      fout, indent=1)
+    if args.check:
+        again = run_all(profiles, args.seed, args.size, args.filter, min_time=0.)
+        ok = (counts(again) == counts(results) and
+              all(r['readers_agree'] for byprofile in results.values() for r in byprofile.values()))
+        print("Same counts from the same seed, readers agree: %s" % ('ok' if ok else 'FAILED'))
+        if not ok:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+"""
+Off-thread, rate-limited logging for the hot paths.
+
+At high message rates, logging every message costs more than decoding
+it: the record is formatted on the decoding thread, and the write to
+stdout blocks when the terminal or pipe is slow. start_logging moves
+the root logger's handlers behind a queue, so the calling thread only
+makes a record and puts it on the queue, and a background thread
+formats and writes it. Because formatting happens later, the arguments
+of a logging call must not change after it is made: log snapshots, not
+live state. Lazy defers an expensive str() the same way.
+
+Each call site may log a burst of records and then a steady rate of
+records per second. The records dropped in between are counted, and the
+count is added to the next record from that call site that gets
+through, or logged when logging stops. If the queue fills because the
+output can't keep up, records are dropped and counted rather than
+blocking the caller.
+
+Usage:
+
+./server.py --format nvtsim --speed 100 --log-rate 5
+./logqueue.py --check
+
+"""
+
+import argparse
+import atexit
+import io
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_RATE = 20.
+LOG_BURST = 50
+QUEUE_SIZE = 10000
+SUPPRESSED_FORMAT = " (%d similar messages suppressed)"
+
+
+class Lazy:
+    """ A logging argument that calls func(*args) only when the record is
+    formatted, for example logging.info("%s", Lazy(nav_line, snapshot)).
+    Bind values with args rather than a closure, as the call happens
+    after the caller has moved on. """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class RateLimitFilter(logging.Filter):
+    """ A token bucket for each call site (or each ratekey given with
+    extra=), refilled at rate per second up to burst. Not locked: a call
+    site normally logs from one thread, and a race between two would only
+    let a record more or less through. """
+    def __init__(self, rate=LOG_RATE, burst=LOG_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # key: [tokens, last time, suppressed count, last suppressed record]
+        self.buckets = {}
+
+    def filter(self, record):
+        key = getattr(record, 'ratekey', None)
+        if key is None:
+            key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0, None]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1.:
+            bucket[0] = tokens
+            bucket[2] += 1
+            bucket[3] = record
+            return False
+        bucket[0] = tokens - 1.
+        if bucket[2]:
+            record.msg = str(record.msg) + SUPPRESSED_FORMAT % bucket[2]
+            bucket[2] = 0
+        return True
+
+    def pending(self):
+        """ (count, last record) for each key with suppressed records
+        not yet reported, and reset their counts """
+        counts = []
+        for bucket in self.buckets.values():
+            if bucket[2]:
+                counts.append((bucket[2], bucket[3]))
+                bucket[2] = 0
+        return counts
+
+
+class QueueListener(threading.Thread):
+    """ Handles queued records with the handlers the root logger had """
+    def __init__(self, handlers, maxsize=QUEUE_SIZE):
+        super().__init__(name='logqueue', daemon=True)
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.queue = queue.SimpleQueue()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handle(record)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+class QueueHandler(logging.Handler):
+    """ Puts records on a QueueListener's queue unformatted, counting the
+    records dropped when it is full. In a forked child (the server's
+    --decoder-process), where the listener thread doesn't run, records
+    are handled directly by the listener's handlers. """
+    def __init__(self, listener):
+        super().__init__()
+        self.listener = listener
+        self.pid = os.getpid()
+        self.dropped = 0
+
+    def handle(self, record):
+        # The queue does its own locking, so skip the handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        listener = self.listener
+        if os.getpid() != self.pid:
+            listener.handle(record)
+        elif listener.queue.qsize() >= listener.maxsize:
+            self.dropped += 1
+        else:
+            listener.queue.put(record)
+
+
+class QueuedLogging:
+    """ Logging set up by start_logging, to be stopped at exit """
+    def __init__(self, target, handler, limiter):
+        self.target = target
+        self.handler = handler
+        self.limiter = limiter
+        self.stopped = False
+
+    def stop(self):
+        """ Write out the queue, put the original handlers back and log
+        the suppressed and dropped counts """
+        if self.stopped:
+            return
+        self.stopped = True
+        target, handler = self.target, self.handler
+        if handler is not None:
+            target.removeHandler(handler)
+            handler.listener.stop()
+            for h in handler.listener.handlers:
+                target.addHandler(h)
+        if self.limiter is not None:
+            for h in target.handlers:
+                h.removeFilter(self.limiter)
+            for count, record in self.limiter.pending():
+                target.info("%d messages suppressed like: %s", count, record.getMessage())
+        if handler is not None and handler.dropped:
+            target.warning("Dropped %d log records with the log queue full", handler.dropped)
+
+
+def start_logging(rate=LOG_RATE, burst=LOG_BURST, queued=True, target=None, maxsize=QUEUE_SIZE):
+    """ Rate limit the target logger's records (the root logger's by
+    default) to burst and then rate per second per call site, unless
+    rate is 0, and if queued, move its handlers to a background thread.
+    Call this after logging.basicConfig. Logging is stopped at exit;
+    returns the QueuedLogging to stop it sooner. """
+    if target is None:
+        target = logging.getLogger()
+    limiter = RateLimitFilter(rate, burst) if rate > 0 else None
+    if queued:
+        listener = QueueListener(target.handlers[:], maxsize)
+        handler = QueueHandler(listener)
+        for h in listener.handlers:
+            target.removeHandler(h)
+        target.addHandler(handler)
+        listener.start()
+    else:
+        handler = None
+    if limiter is not None:
+        for h in target.handlers:
+            h.addFilter(limiter)
+    logs = QueuedLogging(target, handler, limiter)
+    atexit.register(logs.stop)
+    return logs
+
+def add_log_arguments(parser):
+    parser.add_argument('--log-rate', default=LOG_RATE, type=float,
+                        help="Log at most this many messages per second from each place in the code, "
+                        "after a burst of --log-burst, counting the rest (0: no limit; default %(default)g)")
+    parser.add_argument('--log-burst', default=LOG_BURST, type=int,
+                        help="Messages each place in the code can log before --log-rate applies (default %(default)d)")
+    parser.add_argument('--log-sync', action='store_true',
+                        help="Write log messages on the thread that logs them rather than a background thread")
+
+
+def nav_line(ns):
+    return ns.nav_message().strip()
+
+class SlowStream:
+    """ A stream that sleeps on each write, like a slow terminal """
+    def __init__(self, stream, delay=1e-4):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, s):
+        time.sleep(self.delay)
+        return self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+def overhead_check(repeat=50):
+    """ Check that queued logging writes the same lines as direct logging
+    and that the rate limit counts what it drops, then time the replay
+    echo and the parser's debug calls each way. Returns True if the
+    checks pass. """
+    import nav_nvt
+    datadir = os.path.join(os.path.dirname(__file__), 'tests/data')
+    with open(os.path.join(datadir, 'KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds'), 'rb') as fin:
+        snapshots = list(nav_nvt.nvt_nav_gen(fin.read(), 18.)) * repeat
+
+    def make_target(stream):
+        target = logging.getLogger('logqueue.check')
+        target.propagate = False
+        target.setLevel(logging.INFO)
+        target.handlers[:] = [logging.StreamHandler(stream)]
+        return target
+
+    # Same output, in order, queued or not
+    out = [io.StringIO(), io.StringIO()]
+    for i, queued in enumerate((False, True)):
+        target = make_target(out[i])
+        logs = start_logging(rate=0, queued=queued, target=target, maxsize=len(snapshots))
+        for ns in snapshots:
+            target.info("%s", Lazy(nav_line, ns))
+        logs.stop()
+    same = out[0].getvalue() == out[1].getvalue() and out[0].getvalue().count('\n') == len(snapshots)
+
+    # Every record is either written or counted as suppressed, and no
+    # more are written than the burst and what the rate refills meanwhile
+    n = 10000
+    stream = io.StringIO()
+    target = make_target(stream)
+    t0 = time.monotonic()
+    logs = start_logging(rate=LOG_RATE, burst=LOG_BURST, target=target)
+    for i in range(n):
+        target.info("Unknown message id %d", i)
+    elapsed = time.monotonic() - t0
+    logs.stop()
+    lines = stream.getvalue().splitlines()
+    written = sum(1 for line in lines if line.startswith('Unknown'))
+    suppressed = sum(int(line.split('(')[1].split()[0]) for line in lines if '(' in line)
+    suppressed += sum(int(line.split()[0]) for line in lines if 'suppressed like' in line)
+    counted = written + suppressed == n and LOG_BURST <= written <= LOG_BURST + LOG_RATE * elapsed + 1
+
+    # Time per call on the logging thread, and in all, writing to
+    # /dev/null and to a stream that takes 100 us a write
+    results = []
+    with open(os.devnull, 'w') as devnull:
+        echo = lambda target, ns: target.info("%s", Lazy(nav_line, ns))
+        cases = [
+            ("debug off, str.format", devnull, dict(rate=0, queued=False),
+             lambda target, ns: target.debug("msg={0.latitude:f} ignored".format(ns))),
+            ("debug off, lazy", devnull, dict(rate=0, queued=False),
+             lambda target, ns: target.debug("msg=%f ignored", ns.latitude)),
+        ]
+        for out_name, stream in (("", devnull), (", slow", SlowStream(devnull))):
+            cases += [
+                ("echo%s, direct" % out_name, stream, dict(rate=0, queued=False),
+                 lambda target, ns: target.info(ns.nav_message().strip())),
+                ("echo%s, queued" % out_name, stream, dict(rate=0), echo),
+                ("echo%s, queued, rate limited" % out_name, stream, dict(), echo),
+            ]
+        for name, stream, kw, call in cases:
+            target = make_target(stream)
+            logs = start_logging(target=target, maxsize=len(snapshots), **kw)
+            t0 = time.perf_counter()
+            for ns in snapshots:
+                call(target, ns)
+            t1 = time.perf_counter()
+            logs.stop()
+            t2 = time.perf_counter()
+            results.append((name, (t1 - t0) / len(snapshots), (t2 - t0) / len(snapshots)))
+        target.handlers[:] = []
+
+    print("%-30s %12s %12s" % ('', 'caller us', 'total us'))
+    for name, caller, total in results:
+        print("%-30s %12.2f %12.2f" % (name, 1e6 * caller, 1e6 * total))
+    print("%d records each. Queued output matches direct: %s; written + suppressed = %d of %d: %s" %
+          (len(snapshots), 'ok' if same else 'FAILED', written + suppressed, n, 'ok' if counted else 'FAILED'))
+    return same and counted
+
+def main():
+    parser = argparse.ArgumentParser(description="Off-thread, rate-limited logging")
+    parser.add_argument('--check', action='store_true',
+                        help="Check queued and rate limited logging and measure its overhead on the sample data")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    if args.check and not overhead_check():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
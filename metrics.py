@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+Parser and server counters, served over HTTP in the Prometheus text format.
+
+Counting is always on and costs a dict increment per message, so it can
+be left running at high input rates; the text is only formatted when
+the endpoint is scraped. Each input has its message counts by id, the
+parser's bad CRC, unparseable and resync byte counts, the serial
+capture counters, its message rate since the last scrape and, for
+serial inputs, its input latency (from the arrival of the bytes that
+completed an update to the update). The server has its connection
+counts, messages and bytes sent, the update-to-send latency (how old
+the state was when it was sent) and each client's send queue depth.
+
+Usage:
+
+./server.py --format nvt --metrics-port 9463
+curl localhost:9463/metrics
+./metrics.py --check
+
+"""
+
+import argparse
+import bisect
+import fcntl
+import logging
+import socket
+import struct
+import sys
+import termios
+import threading
+import time
+
+METRICS_PORT = 9463
+METRICS_PREFIX = 'navserver_'
+# Update-to-send latency histogram bucket upper bounds (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def label_value(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, label_value(v)) for k, v in labels.items())
+
+
+class Histogram:
+    """ Cumulative-bucket histogram, as Prometheus expects """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels=None):
+        labels = dict(labels or {})
+        lines = []
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            le = '+Inf' if bound == float('inf') else '%g' % bound
+            lines.append('%s_bucket%s %d' % (name, format_labels(dict(labels, le=le)), total))
+        lines.append('%s_sum%s %.9g' % (name, format_labels(labels), self.sum))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), self.count))
+        return lines
+
+
+class InputMetrics:
+    """ Counters for one input. Pass messages and parser as the stats and
+    parser_stats of nvt_nav_gen or greis_nav_gen, and call updated() for
+    each navigation update. extra is None, or a function returning a
+    dict of further counters, such as SerialCapture.stats. arrival is
+    None, or a function returning the time.monotonic() at which the last
+    byte decoded arrived, such as RingReader.arrival_time. """
+    def __init__(self, fmt, port):
+        self.labels = {'input': '%s:%s' % (fmt, port), 'format': fmt}
+        self.messages = {}
+        self.parser = {}
+        self.snapshots = 0
+        self.extra = None
+        self.arrival = None
+        self.latency = Histogram()
+        self.last_rate = (time.monotonic(), 0)
+
+    def updated(self):
+        """ Count a navigation update, and its input latency if known """
+        self.snapshots += 1
+        if self.arrival is not None:
+            t = self.arrival()
+            if t is not None:
+                self.latency.observe(time.monotonic() - t)
+
+    def message_rate(self):
+        """ Messages per second since the last call """
+        now, total = time.monotonic(), sum(self.messages.values())
+        t0, total0 = self.last_rate
+        self.last_rate = (now, total)
+        return (total - total0) / (now - t0) if now > t0 else 0.
+
+
+class ServerMetrics:
+    """ Counters for the TCP server """
+    def __init__(self):
+        self.connections_total = 0
+        self.connections_active = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.latency = Histogram()
+        self.queue_depth = {} # client address -> unsent bytes
+
+    def connected(self, addr):
+        self.connections_total += 1
+        self.connections_active += 1
+        self.queue_depth['%s:%d' % addr[:2]] = 0
+
+    def disconnected(self, addr):
+        self.connections_active -= 1
+        self.queue_depth.pop('%s:%d' % addr[:2], None)
+
+    def sent(self, conn, addr, nbytes, t_update=None):
+        """ Count a message sent on conn; t_update is the monotonic time
+        of the navigation update that was sent, if known """
+        self.messages_sent += 1
+        self.bytes_sent += nbytes
+        if t_update is not None:
+            self.latency.observe(time.monotonic() - t_update)
+        depth = send_queue_depth(conn)
+        if depth is not None:
+            self.queue_depth['%s:%d' % addr[:2]] = depth
+
+
+def send_queue_depth(conn):
+    """ Bytes written to conn that the peer hasn't acknowledged, or None
+    where the platform can't tell """
+    try:
+        return struct.unpack('i', fcntl.ioctl(conn.fileno(), termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+    except (OSError, AttributeError, ValueError):
+        return None
+
+
+class Metrics:
+    """ All the inputs' and the server's counters """
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.inputs = []
+        self.server = ServerMetrics()
+        self.lock = threading.Lock()
+        self.t_start = time.time()
+
+    def input(self, fmt, port):
+        """ Register a new input and return its InputMetrics """
+        m = InputMetrics(fmt, port)
+        with self.lock:
+            self.inputs.append(m)
+        return m
+
+    def exposition(self):
+        """ All metrics in the Prometheus text format """
+        p = self.prefix
+        out = []
+        def family(name, kind, help_text, samples):
+            out.append('# HELP %s%s %s' % (p, name, help_text))
+            out.append('# TYPE %s%s %s' % (p, name, kind))
+            for labels, value in samples:
+                out.append('%s%s%s %.9g' % (p, name, format_labels(labels), value))
+
+        with self.lock:
+            inputs = list(self.inputs)
+        family('start_time_seconds', 'gauge', "Start time of the server since the epoch",
+               [({}, self.t_start)])
+        family('input_messages_total', 'counter', "Messages received, by message id",
+               [(dict(m.labels, msgid=k), v) for m in inputs for k, v in sorted(m.messages.items(), key=str)])
+        family('input_message_rate', 'gauge', "Messages per second since the last scrape",
+               [(m.labels, m.message_rate()) for m in inputs])
+        family('input_parser_errors_total', 'counter', "Parser errors, by kind",
+               [(dict(m.labels, kind=k), v) for m in inputs for k, v in sorted(m.parser.items())
+                if k != 'resync_bytes'])
+        family('input_resync_bytes_total', 'counter', "Bytes skipped to find the next message",
+               [(m.labels, m.parser.get('resync_bytes', 0)) for m in inputs])
+        family('input_snapshots_total', 'counter', "Navigation updates from the input",
+               [(m.labels, m.snapshots) for m in inputs])
+        family('input_capture', 'gauge', "Serial capture counters (see capture.SerialCapture.stats)",
+               [(dict(m.labels, counter=k), v) for m in inputs if m.extra is not None
+                for k, v in sorted(m.extra().items())])
+
+        s = self.server
+        family('connections_total', 'counter', "Client connections accepted", [({}, s.connections_total)])
+        family('connections_active', 'gauge', "Clients connected", [({}, s.connections_active)])
+        family('messages_sent_total', 'counter', "Navigation messages sent", [({}, s.messages_sent)])
+        family('bytes_sent_total', 'counter', "Bytes sent", [({}, s.bytes_sent)])
+        family('client_queue_bytes', 'gauge', "Bytes sent to the client but not yet acknowledged",
+               [({'client': k}, v) for k, v in sorted(s.queue_depth.items())])
+        out.append('# HELP %sinput_latency_seconds Time from the arrival of the last byte of an update to the update' % p)
+        out.append('# TYPE %sinput_latency_seconds histogram' % p)
+        for m in inputs:
+            if m.arrival is not None:
+                out.extend(m.latency.samples(p + 'input_latency_seconds', m.labels))
+        out.append('# HELP %supdate_to_send_seconds Age of the navigation state when it was sent' % p)
+        out.append('# TYPE %supdate_to_send_seconds histogram' % p)
+        out.extend(s.latency.samples(p + 'update_to_send_seconds'))
+        return '\n'.join(out) + '\n'
+
+
+# Metrics of this process
+METRICS = Metrics()
+
+
+def start_metrics_server(host='localhost', port=METRICS_PORT, metrics=METRICS):
+    """ Serve metrics at http://host:port/metrics from a daemon thread """
+    # Only imported when serving, as http.server is slow to import
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            logging.debug("metrics: " + fmt, *args)
+
+    httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on http://%s:%d/metrics", host, httpd.server_address[1])
+    return httpd
+
+
+def collection_cost(repeat=20):
+    """ nvt_nav_gen and greis_nav_gen throughput on the sample files with
+    and without counting; returns the fractional slowdown """
+    import os
+    import nav_jvd
+    import nav_nvt
+    datadir = os.path.join(os.path.dirname(__file__), 'tests/data')
+    with open(os.path.join(datadir, 'KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds'), 'rb') as fin:
+        nvtdata = fin.read()
+    with open(os.path.join(datadir, 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds'), 'rb') as fin:
+        jvddata = fin.read()
+
+    def run(m):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            kw = {} if m is None else {'stats': m.messages, 'parser_stats': m.parser}
+            for _ in nav_nvt.nvt_nav_gen(nvtdata, 18., **kw):
+                pass
+            for _ in nav_jvd.greis_nav_gen(jvddata, 18., 1024, **kw):
+                pass
+        return time.perf_counter() - t0
+
+    run(None)
+    dt_off = min(run(None) for _ in range(3))
+    dt_on = min(run(InputMetrics('bench', '-')) for _ in range(3))
+    return dt_on / dt_off - 1.
+
+def metrics_check(duration=2.):
+    """ Run the server on replayed sample data with a client connected,
+    scrape the endpoint and check that the counters moved """
+    import urllib.request
+    import nav
+    import server
+    import replay
+    ns = nav.NavState()
+    metrics = Metrics()
+    httpd = start_metrics_server('localhost', 0, metrics)
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+
+    def feed(fmt, infile):
+        m = metrics.input(fmt, infile)
+        for ns2 in replay.Replayer(fmt, infile, speed=20., loop=True, metrics=m):
+            ns.update(ns2)
+            m.updated()
+
+    import os
+    datadir = os.path.join(os.path.dirname(__file__), 'tests/data')
+    for fmt, name in (('nvt', 'ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds'), ('jvd', 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds')):
+        threading.Thread(target=feed, args=(fmt, os.path.join(datadir, name)), daemon=True).start()
+    try:
+        threading.Thread(target=server.server, args=(ns, 'localhost', port, 0.05, duration + 3., metrics),
+                         daemon=True).start()
+        time.sleep(0.3)
+        with socket.create_connection(('localhost', port)) as conn:
+            t0 = time.time()
+            while time.time() - t0 < duration:
+                conn.recv(4096)
+            url = 'http://localhost:%d/metrics' % httpd.server_address[1]
+            with urllib.request.urlopen(url) as resp:
+                text = resp.read().decode('utf-8')
+                content_type = resp.headers['Content-Type']
+    finally:
+        httpd.shutdown()
+
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    def total(prefix):
+        return sum(v for k, v in values.items() if k.startswith(METRICS_PREFIX + prefix))
+    checks = {
+        'content type': content_type == CONTENT_TYPE,
+        'messages': total('input_messages_total{') > 0,
+        'snapshots': total('input_snapshots_total{') > 0,
+        'rate': total('input_message_rate{') > 0,
+        'connections': values.get(METRICS_PREFIX + 'connections_total', 0) == 1 and
+                       values.get(METRICS_PREFIX + 'connections_active', 0) == 1,
+        'sent': values.get(METRICS_PREFIX + 'messages_sent_total', 0) > 0,
+        'latency': values.get(METRICS_PREFIX + 'update_to_send_seconds_count', 0) > 0,
+        'queue depth': any(k.startswith(METRICS_PREFIX + 'client_queue_bytes{') for k in values),
+    }
+    print(text)
+    cost = collection_cost()
+    print("Counting cost in nvt_nav_gen/greis_nav_gen: %+.1f%%" % (100. * cost))
+    failed = [k for k, ok in checks.items() if not ok]
+    print("%d metrics checks: %s" % (len(checks), 'FAILED ' + ', '.join(failed) if failed else 'ok'))
+    return not failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Prometheus metrics for the server")
+    parser.add_argument('--check', action='store_true',
+                        help="Serve replayed sample data, scrape the metrics and check them")
+    parser.add_argument('--duration', default=2., type=float)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    if args.check and not metrics_check(args.duration):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
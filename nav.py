@@ -1,6 +1,21 @@
 from dataclasses import dataclass
+from collections import namedtuple
+import dataclasses
+import operator
 import threading
 import datetime
+import time
+
+NAV_MESSAGE_FORMAT = "11,%04d%02d%02d,%02d%02d%02d.%01d,%f,%f,%f,%f,%f,%f\n"
+
+def message_fields(s):
+    """ Values for NAV_MESSAGE_FORMAT from a NavState or NavSnapshot """
+    return (
+    s.utc_year, s.utc_month, s.utc_day,
+    s.utc_hour, s.utc_min, s.utc_ms/1000, s.utc_ms/100%10,
+    s.latitude, s.longitude, s.height*3.28083989501, #// 3.28... to convert metres->feet
+    s.trk_gnd, s.hor_spd*1.94384449, s.vert_spd*196.850393701 #//1.94... to convert m/s->knots, 196.85... to convert m/s->fpm
+    )
 
 @dataclass
 class NavState:
@@ -24,33 +39,48 @@ class NavState:
 
     def __post_init__(self):
         self.lock_ = threading.Lock()
-        self.formatstr_ = "11,%04d%02d%02d,%02d%02d%02d.%01d,%f,%f,%f,%f,%f,%f\n"
+        self.formatstr_ = NAV_MESSAGE_FORMAT
+        self.t_update_ = None
 
 
     def nav_message(self):
         """ Construct a navigation message based on the current state """
         self.lock_.acquire()
         try:
-            fields = (
-            self.utc_year, self.utc_month, self.utc_day,
-            self.utc_hour, self.utc_min, self.utc_ms/1000, self.utc_ms/100%10,
-            self.latitude, self.longitude, self.height*3.28083989501, #// 3.28... to convert metres->feet
-            self.trk_gnd, self.hor_spd*1.94384449, self.vert_spd*196.850393701 #//1.94... to convert m/s->knots, 196.85... to convert m/s->fpm
-            )
+            fields = message_fields(self)
         finally:
             self.lock_.release()
 
         return self.formatstr_ % fields
 
     def update(self, other):
-        """ Update the public member variables of this variable from other """
+        """ Update the public member variables of this variable from other,
+        which may be a dict, a NavState or a NavSnapshot """
         self.lock_.acquire()
         try:
-            obj = other if isinstance(other, dict) else other.__dict__
+            if isinstance(other, dict):
+                items = other.items()
+            elif isinstance(other, NavSnapshot):
+                items = zip(other._fields, other)
+            else:
+                items = other.__dict__.items()
 
-            for k, v in obj.items():
+            for k, v in items:
                 if not k.endswith('_'): # skip private members
                     setattr(self, k, v)
+            self.t_update_ = time.monotonic()
+        finally:
+            self.lock_.release()
+
+    def update_time(self):
+        """ time.monotonic() of the last update, or None """
+        return self.t_update_
+
+    def snapshot(self):
+        """ Return an immutable copy of the current state """
+        self.lock_.acquire()
+        try:
+            return NavSnapshot._make([getattr(self, k) for k in NavSnapshot._fields])
         finally:
             self.lock_.release()
 
@@ -61,3 +91,22 @@ class NavState:
         dtobj = datetime.datetime(self.utc_year, self.utc_month, self.utc_day,
                                   self.utc_hour, self.utc_min, sec, ms * 1000)
         return dtobj
+
+
+# Fields that make up a navigation solution, as opposed to its time
+SOLUTION_FIELDS = ('latitude', 'longitude', 'height', 'trk_gnd', 'hor_spd', 'vert_spd')
+
+class NavSnapshot(namedtuple('NavSnapshot', [f.name for f in dataclasses.fields(NavState)],
+                             defaults=[f.default for f in dataclasses.fields(NavState)])):
+    """ Immutable navigation state, as emitted by the nav adapters.
+    Has the same fields and methods as NavState, without the lock. """
+    __slots__ = ()
+
+    # The position and velocity fields, for comparing solutions
+    solution = property(operator.attrgetter(*SOLUTION_FIELDS))
+
+    def nav_message(self):
+        """ Construct a navigation message based on this state """
+        return NAV_MESSAGE_FORMAT % message_fields(self)
+
+    datetime = NavState.datetime
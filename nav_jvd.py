@@ -11,68 +11,91 @@ import math
 import os
 
 import bognss.JVD.greis as greis
-from nav_nvt import sec_from_weeksec, gm_from_gps, utc_time
+from nav_nvt import sec_from_weeksec, gm_from_gps, utc_time, learn_gps_utc_offset
 import nav
 
 
 
-def greis_nav_gen(stream, gps_utc_offset=0, gps_weeknum_offset=1024, nmax=None):
-    """ Generate NavState values from a stream of Javad GREIS messages """
-    stats = defaultdict(int)
-    ns = nav.NavState()
+def greis_nav_gen(stream, gps_utc_offset=0, gps_weeknum_offset=1024, nmax=None, stats=None, parser_stats=None):
+    """ Generate nav.NavSnapshot values from a stream of Javad GREIS messages.
+    A snapshot is emitted for each receiver epoch with both position (PG) and
+    velocity (VG), or with only one of them if it changed the solution.
+    Epochs that only update the time are not emitted.
+    gps_utc_offset (seconds) is used until the stream reports the current
+    leap seconds in a UO message.
+    nmax is the maximum number of epochs
+    Message counts by id are kept in stats, and the epoch assembler's
+    error counts in parser_stats, if they are given as dicts. """
+    if stats is None:
+        stats = defaultdict(int)
+    state = {} # current navigation fields
+    last = None # last emitted snapshot
 
     has_gt = False
 
-    for i, rec in enumerate(greis.GREISParser(stream, skip_crlf=True)):
+    for i, epoch in enumerate(greis.GREISEpochAssembler(stream, stats=parser_stats)):
         # Increment stats counter
-        stats[rec[0]] += 1
+        for msgid in epoch.msgs:
+            stats[msgid] = stats.get(msgid, 0) + 1
 
-        if rec.id in (b'AR', b'mR'):
-            continue
-        try:
-            rec.parsed
-        except AttributeError:
-            pass
+        uo = parsed_msg(epoch, b'UO')
+        if uo is not None:
+            gps_utc_offset = learn_gps_utc_offset(gps_utc_offset, uo.dtls, 'UO')
 
         data = {}
-        if rec.id in (b'~~', b'RT') and not has_gt:
+        gt = parsed_msg(epoch, b'GT')
+        if gt is not None:
+            has_gt = True
+            data = utc_time(gt.wn + gps_weeknum_offset, gt.tow / 1000, gps_utc_offset)
+        elif epoch.tod is not None and not has_gt:
             # TODO: for now ignore the ST messages
             # TODO: doesn't do the right thing around the top of the day.
             # ignore this time if GT is present.
 
-            tod = rec.parsed.tod - int(gps_utc_offset*1000) # Time of day in milliseconds
+            tod = epoch.tod - int(gps_utc_offset*1000) # Time of day in milliseconds
             data['utc_ms'] = tod % 60000
             tod = (tod - data['utc_ms']) // 60000
             data['utc_min'] = tod % 60
             tod = (tod - data['utc_min']) // 60
             data['utc_hour'] = tod
-        elif rec.id in (b'GT',):
-            has_gt = True
-            data = utc_time(rec.parsed.wn + gps_weeknum_offset, rec.parsed.tow / 1000, gps_utc_offset)
-        elif rec.id == b'PG':
-            data['latitude'] = rec.parsed.lat
-            data['longitude'] = rec.parsed.lon
-            data['height'] = rec.parsed.alt
-        elif rec.id == b'VG':
-            ve, vn, vu = rec.parsed.lon, rec.parsed.lat, rec.parsed.alt
+
+        pg = parsed_msg(epoch, b'PG')
+        if pg is not None:
+            # GREIS geodetic position is in radians
+            data['latitude'] = math.degrees(pg.lat)
+            data['longitude'] = math.degrees(pg.lon)
+            data['height'] = pg.alt
+        vg = parsed_msg(epoch, b'VG')
+        if vg is not None:
+            ve, vn, vu = vg.lon, vg.lat, vg.alt
             # for bearing, north = x and east = y
             data['trk_gnd'] = math.degrees(math.atan2(ve, vn))
             data['hor_spd'] = math.sqrt(ve*ve + vn*vn)
             data['vert_spd'] = vu
 
-        #print(repr(rec))
-        ns.update(data)
+        state.update(data)
 
-        yield ns
+        if pg is not None or vg is not None:
+            snapshot = nav.NavSnapshot(**state)
+            if (pg is not None and vg is not None) or last is None or snapshot.solution != last.solution:
+                yield snapshot
+                last = snapshot
         if nmax is not None and i >= nmax:
             break
 
 
+def parsed_msg(epoch, msgid):
+    """ Return the parsed message msgid from a GREISEpoch, or None if
+    it is missing or couldn't be parsed """
+    msg = epoch.msgs.get(msgid)
+    return None if msg is None or isinstance(msg, greis.GREISMsg) else msg
+
+
 def main():
     #infile = "/disk/kea/WAIS/targ/xped/ICP9/breakout/ELSA/F03/TOT3/JKB2s/X07a/AVNjp1/bxds"
     infile = os.path.join(os.path.dirname(__file__), 'tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds')
 
-    with open(infile, "rb") as fin:
+    with greis.open_input(infile) as fin:
         for mynav in greis_nav_gen(fin, nmax=1000):
             print(mynav.nav_message().strip())
 
@@ -4,11 +4,22 @@
 Usage:
 
 ./utils/gen_nmea.py | ./parsenmea.py
+./utils/gen_nmea.py | ./nav_nmea.py --check
+./utils/gen_nmea.py | ./nav_nmea.py --bench
+./utils/gen_nmea.py | ./nav_nmea.py --pty
+./nav_nmea.py --track nmea.log -o track.npy
 
 """
 
+import argparse
+import logging
+import os
 import sys
+import threading
+import time
+from collections import namedtuple
 
+import numpy as np
 import pynmea2
 
 import nav
@@ -24,9 +35,180 @@ def convert_len(mylen, units_in='M', units_out='M'):
     return mylen
 
 
+# Longest sentence the checksum fold handles; NMEA 0183 limits them to 82
+NMEA_MAX_LEN = 128
+
+def nmea_checksum(data):
+    """ XOR of the characters of data (up to NMEA_MAX_LEN long), folded
+    as a single integer instead of character by character """
+    x = int.from_bytes(data.encode('ascii'), 'little')
+    x ^= x >> 512
+    x ^= x >> 256
+    x ^= x >> 128
+    x ^= x >> 64
+    x ^= x >> 32
+    x ^= x >> 16
+    x ^= x >> 8
+    return x & 0xff
+
+def dm_to_deg(dm, hemi, pos, neg):
+    """ Convert a DDDMM.mmmm coordinate and hemisphere (pos or neg, e.g.
+    'N' or 'S') to signed degrees, the same way pynmea2's latitude and
+    longitude properties do """
+    dot = dm.index('.') - 2
+    if dot < 1 or not (dm[:dot+2].isdigit() and dm[dot+3:].isdigit()):
+        raise ValueError(dm)
+    deg = float(dm[:dot]) + float(dm[dot:]) / 60
+    if hemi == pos:
+        return deg
+    if hemi == neg:
+        return -deg
+    return 0.
+
+def utc_time_fields(hhmmss):
+    """ Same as NmeaNavState.get_utc_time, straight from the text field """
+    if not hhmmss[:6].isdigit():
+        raise ValueError(hhmmss)
+    hour, second = divmod(int(hhmmss[:6]), 10000)
+    minute, second = divmod(second, 100)
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError(hhmmss)
+    frac = hhmmss[6:]
+    if frac and not (frac[0] == '.' and frac[1:].isdigit()) \
+            and not 0. <= float(frac) < 1.:
+        raise ValueError(hhmmss)
+    return {
+        'utc_hour': hour,
+        'utc_min': minute,
+        'utc_ms': second*1000
+    }
+
+def fast_GGA(f):
+    if f[9] != 'M' or not f[8]:
+        raise ValueError('altitude')
+    fields = utc_time_fields(f[0])
+    fields['latitude'] = dm_to_deg(f[1], f[2], 'N', 'S')
+    fields['longitude'] = dm_to_deg(f[3], f[4], 'E', 'W')
+    fields['height'] = float(f[8])
+    return fields
+
+def fast_RMC(f):
+    fields = utc_time_fields(f[0])
+    fields['latitude'] = dm_to_deg(f[2], f[3], 'N', 'S')
+    fields['longitude'] = dm_to_deg(f[4], f[5], 'E', 'W')
+    fields['hor_spd'] = convert_speed(float(f[6]), units_in='N', units_out='M')
+    fields['trk_gnd'] = float(f[7])
+    return fields
+
+def fast_ZDA(f):
+    return {
+        'utc_year': int(f[3]),
+        'utc_month': int(f[2]),
+        'utc_day': int(f[1]),
+    }
+
+FAST_PARSERS = {
+    'GGA': fast_GGA,
+    'RMC': fast_RMC,
+    'ZDA': fast_ZDA,
+}
+
+def parse_nmea_fast(line, check=False):
+    """ Parse a GGA, RMC or ZDA sentence straight into NavState fields.
+    Returns None for anything it doesn't handle (other sentences, bad
+    checksums, empty or odd fields), so that the caller can let pynmea2
+    deal with it and raise the same errors it always did """
+    s = line.strip()
+    if len(s) < 7 or s[0] != '$' or s[1] == 'P' or s[6] != ',' \
+            or not s[1:6].isalnum():
+        return None
+    parser = FAST_PARSERS.get(s[3:6])
+    if parser is None:
+        return None
+    star = s.find('*')
+    if star < 0:
+        if check:
+            return None
+        data = s[1:]
+    else:
+        if star != len(s) - 3 or star > NMEA_MAX_LEN:
+            return None
+        data = s[1:star]
+        try:
+            if int(s[-2:], 16) != nmea_checksum(data):
+                return None
+        except ValueError:
+            return None
+    try:
+        return parser(data[6:].split(','))
+    except (ValueError, IndexError):
+        return None
+
+
+def count_sentence(stats, line):
+    """ Count a sentence in the dict stats by its type: the three letters
+    after the talker ID of a '$' or '!' sentence, or 'other' """
+    key = line[3:6] if line[:1] in ('$', '!') else 'other'
+    stats[key] = stats.get(key, 0) + 1
+
+
+# Give up on a buffer that has gone this long without a newline
+NMEA_MAX_BUFFER = 4096
+
+def nmea_sentences(lines, maxlen=NMEA_MAX_LEN):
+    """ Pick valid-looking sentences out of raw byte lines, dropping
+    anything that is not ASCII, has no '$', or fails its checksum.
+    If a sentence was cut short by another, keep the last one. """
+    for line in lines:
+        start = line.rfind(b'$')
+        if start < 0:
+            continue
+        line = line[start:].rstrip()
+        if len(line) > maxlen or not line.isascii():
+            continue
+        line = line.decode('ascii')
+        star = line.find('*')
+        if star >= 0:
+            try:
+                if int(line[star+1:star+3], 16) != nmea_checksum(line[1:star]):
+                    continue
+            except ValueError:
+                continue
+        yield line
+
+def NmeaSerialReader(ser, timeout=None):
+    """ Generate NMEA sentences from a serial port, reading whatever the
+    port has buffered in one go rather than a line at a time.
+    Partial sentences (e.g. at startup) and line noise are discarded
+    quietly. Stops after timeout seconds, if given, or once the port
+    (or capture.RingReader) is closed. """
+    t0 = time.time()
+    buf = b''
+    while timeout is None or time.time() - t0 < timeout:
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            if ser.closed:
+                return
+            continue
+        buf += data
+        if b'\n' not in data:
+            if len(buf) > NMEA_MAX_BUFFER:
+                logging.debug("Dropping %d bytes without a newline", len(buf))
+                buf = b''
+            continue
+        lines = buf.split(b'\n')
+        buf = lines.pop()
+        yield from nmea_sentences(lines)
+
+
 class NmeaNavState(nav.NavState):
-    def update_nmea(self, line, check=False):
+    def update_nmea(self, line, check=False, fast=True):
         """ Update the navigation state from a nmea message """
+        if fast:
+            fields = parse_nmea_fast(line, check)
+            if fields is not None:
+                self.update(fields)
+                return
         msg = pynmea2.parse(line, check=check)
         # we need time, lat, lon, alt, ground track, h speed and v speed
         # use duck typing to figure out nav state
@@ -80,7 +262,395 @@ class NmeaNavState(nav.NavState):
 
 
 
+#-------------------------------------------------------------------------
+# Batch conversion of NMEA logs
+
+NMEA_TRACK_DTYPE = np.dtype([
+    ('time', 'M8[ms]'),  # UTC
+    ('lat', 'f8'),       # degrees
+    ('lon', 'f8'),       # degrees
+    ('alt', 'f8'),       # meters
+    ('speed', 'f8'),     # m/s over ground
+    ('course', 'f8'),    # degrees true
+])
+
+# Widest numeric field read_nmea_track converts
+NMEA_FIELD_WIDTH = 16
+
+HEX_VALUES = np.full(256, 256, np.int16)
+for i, c in enumerate(b'0123456789ABCDEF'):
+    HEX_VALUES[c] = HEX_VALUES[bytes([c]).lower()[0]] = i
+NUMERIC_CHARS = np.zeros(256, bool)
+NUMERIC_CHARS[list(b'\0' b'0123456789.-+')] = True # \0 is padding
+
+def sentence_code(name):
+    """ 24-bit code for a three letter sentence type, as used by nmea_index """
+    a, b, c = name.encode('ascii')
+    return a << 16 | b << 8 | c
+
+class NmeaIndex(namedtuple('NmeaIndex', 'start end code commas first')):
+    """ Offsets of the sentences in a buffer: start ('$'), end of data
+    ('*' or end of line), sentence type code, the offsets of all the
+    commas in the buffer (with a sentinel at the end), and for each
+    sentence the position in commas of its first comma (None until
+    select() fills it in) """
+    def select(self, name):
+        """ Index restricted to one sentence type """
+        keep = self.code == sentence_code(name)
+        start = self.start[keep]
+        return self._replace(start=start, end=self.end[keep], code=self.code[keep],
+                             first=np.searchsorted(self.commas, start))
+
+def nmea_index(arr):
+    """ Find the sentences in a uint8 array of NMEA text that ends in a
+    newline. Lines that don't start with '$' or fail their checksum are
+    dropped; lines without a checksum are kept. """
+    ends = np.flatnonzero(arr == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    keep = ends - starts >= 8
+    starts, ends = starts[keep], ends[keep]
+    keep = (arr[starts] == ord('$')) & (arr[starts + 6] == ord(','))
+    starts, ends = starts[keep], ends[keep]
+    ends -= arr[ends - 1] == ord('\r')
+
+    stars = np.flatnonzero(arr == ord('*'))
+    stars = np.append(stars, len(arr))[np.searchsorted(stars, starts)]
+    has_cs = stars + 3 <= ends
+    dataend = np.where(stars < ends, stars, ends)
+    checksum = HEX_VALUES[arr[np.minimum(stars + 1, ends)]] * 16 + \
+               HEX_VALUES[arr[np.minimum(stars + 2, ends)]]
+    xor = np.bitwise_xor.reduceat(arr, np.stack((starts + 1, dataend), 1).ravel())[::2]
+    keep = np.where(has_cs, xor == checksum, stars >= ends)
+    starts, dataend = starts[keep], dataend[keep]
+
+    code = arr[starts + 3].astype(np.int32) << 16 | \
+           arr[starts + 4].astype(np.int32) << 8 | arr[starts + 5]
+    commas = np.append(np.flatnonzero(arr == ord(',')), len(arr))
+    return NmeaIndex(starts, dataend, code, commas, None)
+
+def field_span(idx, k):
+    """ Start and end offsets of field k (0 is the first after the
+    sentence type) of each sentence. Missing fields are empty. """
+    first = idx.first + k
+    last = len(idx.commas) - 1
+    fs = idx.commas[np.minimum(first, last)] + 1
+    fe = np.minimum(idx.commas[np.minimum(first + 1, last)], idx.end)
+    return fs, np.maximum(fe, fs)
+
+def field_floats(arr, idx, k):
+    """ Field k of each sentence as a float (NaN where empty or bad) """
+    fs, fe = field_span(idx, k)
+    width = fe - fs
+    pos = np.arange(NMEA_FIELD_WIDTH)
+    chars = arr[np.minimum(fs[:, None] + pos, len(arr) - 1)]
+    chars[pos >= width[:, None]] = 0
+    ok = (width > 0) & (width <= NMEA_FIELD_WIDTH) & \
+         np.all(NUMERIC_CHARS[chars], axis=1)
+    text = chars.view('S%d' % NMEA_FIELD_WIDTH).ravel()
+    text[~ok] = b'nan'
+    try:
+        return text.astype(np.float64)
+    except ValueError: # something like '1.2.3' got through
+        return np.array([float_or_nan(t) for t in text])
+
+def float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return np.nan
+
+def field_chars(arr, idx, k):
+    """ Single-character field k of each sentence (0 if not one character) """
+    fs, fe = field_span(idx, k)
+    return np.where(fe - fs == 1, arr[np.minimum(fs, len(arr) - 1)], 0)
+
+def field_tod(arr, idx, k):
+    """ hhmmss.sss field k as seconds of day """
+    v = field_floats(arr, idx, k)
+    hour = v // 10000
+    minute = v // 100 % 100
+    second = v - hour * 10000 - minute * 100
+    ok = (hour < 24) & (minute < 60) & (second < 60)
+    return np.where(ok, hour * 3600 + minute * 60 + second, np.nan)
+
+def field_degrees(arr, idx, k, pos, neg):
+    """ DDDMM.mmmm field k and hemisphere field k+1 as signed degrees """
+    v = field_floats(arr, idx, k)
+    hemi = field_chars(arr, idx, k + 1)
+    deg = v // 100
+    deg += (v - deg * 100) / 60
+    sign = np.where(hemi == ord(pos), 1., np.where(hemi == ord(neg), -1., np.nan))
+    return deg * sign
+
+def days_since_epoch(year, month, day):
+    """ Days since 1970-01-01 (float, NaN where invalid) """
+    ok = (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) & (year >= 1970)
+    months = np.where(ok, (year - 1970) * 12 + month - 1, 0).astype(np.int64)
+    days = months.astype('M8[M]').astype('M8[D]').astype(np.int64) + day - 1
+    return np.where(ok, days, np.nan)
+
+def read_nmea_track(fp):
+    """ Read NMEA text from a file object (or bytes) and return a track
+    array of NMEA_TRACK_DTYPE with one row per epoch of GGA/RMC
+    sentences. Dates come from the most recent ZDA or RMC, rolled over
+    at midnight. Values a sentence doesn't provide are NaN (NaT). """
+    data = fp if isinstance(fp, (bytes, bytearray)) else fp.read()
+    if not data.endswith(b'\n'):
+        data = data + b'\n'
+    arr = np.frombuffer(data, np.uint8)
+    index = nmea_index(arr)
+
+    gga = index.select('GGA')
+    rmc = index.select('RMC')
+    zda = index.select('ZDA')
+
+    # GGA and RMC rows in file order, grouped into epochs by time of day
+    pos = np.concatenate((gga.start, rmc.start))
+    tod = np.concatenate((field_tod(arr, gga, 0), field_tod(arr, rmc, 0)))
+    order = np.argsort(pos, kind='stable')
+    order = order[~np.isnan(tod[order])]
+    newepoch = np.ones(len(order), bool)
+    newepoch[1:] = tod[order[1:]] != tod[order[:-1]]
+    epoch = np.empty(len(pos), np.int64)
+    epoch[order] = np.cumsum(newepoch) - 1
+    nepoch = int(newepoch.sum())
+    epoch_tod = tod[order[newepoch]]
+    epoch_pos = np.full(nepoch, -1, np.int64)
+    np.maximum.at(epoch_pos, epoch[order], pos[order])
+    epoch_gga, epoch_rmc = epoch[:len(gga.start)], epoch[len(gga.start):]
+    valid_gga = ~np.isnan(tod[:len(gga.start)])
+    valid_rmc = ~np.isnan(tod[len(gga.start):])
+
+    track = np.empty(nepoch, NMEA_TRACK_DTYPE)
+    for name in NMEA_TRACK_DTYPE.names[1:]:
+        track[name] = np.nan
+
+    def assign(name, ep, valid, values):
+        valid = valid & ~np.isnan(values)
+        track[name][ep[valid]] = values[valid]
+
+    # RMC first so that GGA positions take precedence
+    assign('lat', epoch_rmc, valid_rmc, field_degrees(arr, rmc, 2, 'N', 'S'))
+    assign('lon', epoch_rmc, valid_rmc, field_degrees(arr, rmc, 4, 'E', 'W'))
+    assign('speed', epoch_rmc, valid_rmc,
+           convert_speed(field_floats(arr, rmc, 6), units_in='N', units_out='M'))
+    assign('course', epoch_rmc, valid_rmc, field_floats(arr, rmc, 7))
+    assign('lat', epoch_gga, valid_gga, field_degrees(arr, gga, 1, 'N', 'S'))
+    assign('lon', epoch_gga, valid_gga, field_degrees(arr, gga, 3, 'E', 'W'))
+    alt = np.where(field_chars(arr, gga, 9) == ord('M'), field_floats(arr, gga, 8), np.nan)
+    assign('alt', epoch_gga, valid_gga, alt)
+
+    # Date sources: ZDA (day, month, year) and RMC (ddmmyy)
+    ddmmyy = field_floats(arr, rmc, 8)
+    yy = ddmmyy % 100
+    rmc_days = days_since_epoch(np.where(yy < 69, 2000, 1900) + yy,
+                                ddmmyy // 100 % 100, ddmmyy // 10000)
+    zda_days = days_since_epoch(field_floats(arr, zda, 3), field_floats(arr, zda, 2),
+                                field_floats(arr, zda, 1))
+    src_pos = np.concatenate((zda.start, rmc.start))
+    src_days = np.concatenate((zda_days, rmc_days))
+    src_tod = np.concatenate((field_tod(arr, zda, 0), tod[len(gga.start):]))
+    keep = ~np.isnan(src_days) & ~np.isnan(src_tod)
+    src_pos, src_days, src_tod = src_pos[keep], src_days[keep], src_tod[keep]
+    order = np.argsort(src_pos, kind='stable')
+    src_pos, src_days, src_tod = src_pos[order], src_days[order], src_tod[order]
+
+    msec = np.full(nepoch, np.nan)
+    if len(src_pos):
+        # Latest date at or before each epoch (or the first one, for
+        # epochs before it), corrected if midnight lies between them
+        src = np.maximum(np.searchsorted(src_pos, epoch_pos, side='right') - 1, 0)
+        delta = epoch_tod - src_tod[src]
+        days = src_days[src] + (delta < -43200.) - (delta > 43200.)
+        msec = np.round((days * 86400. + epoch_tod) * 1000.)
+    track['time'] = np.where(np.isnan(msec), np.iinfo(np.int64).min,
+                             np.nan_to_num(msec)).astype(np.int64).view('M8[ms]')
+    return track
+
+TRACK_NAV_FIELDS = (
+    ('lat', 'latitude'),
+    ('lon', 'longitude'),
+    ('alt', 'height'),
+    ('speed', 'hor_spd'),
+    ('course', 'trk_gnd'),
+)
+
+def check_track(lines):
+    """ Check read_nmea_track against parse_nmea_fast on the same lines.
+    Every value parse_nmea_fast finds for an epoch must be in the track
+    (the track may have more, as it doesn't give up on a whole sentence
+    over one bad field). """
+    track = read_nmea_track(''.join(lines).encode('ascii', 'replace'))
+    epochs = {}
+    dates = {}
+    for line in lines:
+        fields = parse_nmea_fast(line)
+        if fields is None:
+            continue
+        key = line[7:line.index(',', 7)]
+        if 'utc_year' in fields:
+            dates[key] = (fields['utc_year'], fields['utc_month'], fields['utc_day'])
+            continue
+        epoch = epochs.setdefault(key, {})
+        for k, v in fields.items():
+            if line[3:6] == 'GGA' or k not in epoch: # GGA positions first
+                epoch[k] = v
+    nok = 0
+    for row in track:
+        t = row['time'].item()
+        if t is None:
+            continue
+        key = t.strftime('%H%M%S.%f')[:10]
+        if key not in epochs:
+            continue
+        epoch = epochs[key]
+        ok = all(abs(row[name] - epoch[k]) < 1e-9
+                 for name, k in TRACK_NAV_FIELDS if k in epoch)
+        if key in dates:
+            ok = ok and dates[key] == (t.year, t.month, t.day)
+        if not ok:
+            print("Track mismatch at %s: %s %s" % (key, row, epoch))
+            return False
+        nok += 1
+    print("%d track epochs match parse_nmea_fast" % nok)
+    return True
+
+def bench_track(lines, hours=1.):
+    """ Time read_nmea_track on the lines repeated to make up the given
+    number of hours of 10 Hz data """
+    data = ''.join(lines).encode('ascii', 'replace')
+    nepoch = max(1, len(read_nmea_track(data)))
+    data *= max(1, int(hours * 36000 / nepoch))
+    t0 = time.perf_counter()
+    track = read_nmea_track(data)
+    dt = time.perf_counter() - t0
+    print("read_nmea_track: %d epochs (%.1f MB) in %.2f s, %.0f epochs/s; "
+          "a day at 10 Hz would take %.1f s" %
+          (len(track), len(data) / 1e6, dt, len(track) / dt, 864000 * dt / len(track)))
+    return len(track) / dt
+
+def check_equivalence(lines):
+    """ Feed lines to a fast and a pynmea2-only NmeaNavState and check
+    that they end up in the same state (or raise the same error) """
+    ns_fast, ns_ref = NmeaNavState(), NmeaNavState()
+    nfast = 0
+    for line in lines:
+        err_fast = err_ref = None
+        try:
+            ns_fast.update_nmea(line)
+        except Exception as e:
+            err_fast = type(e)
+        try:
+            ns_ref.update_nmea(line, fast=False)
+        except Exception as e:
+            err_ref = type(e)
+        if parse_nmea_fast(line) is not None:
+            nfast += 1
+        if err_fast != err_ref or ns_fast.snapshot() != ns_ref.snapshot():
+            print("Mismatch on %r: %s %s" % (line, err_fast, err_ref))
+            return False
+    print("%d lines equivalent (%d on the fast path)" % (len(lines), nfast))
+    return True
+
+def bench_update(lines, repeat=20):
+    """ Lines per second through update_nmea, fast path vs pynmea2, for
+    all lines and for just the sentences on the fast path """
+    fastlines = [line for line in lines if line[3:6] in FAST_PARSERS]
+    result = {}
+    for name, subset in (('all', lines), (','.join(FAST_PARSERS), fastlines)):
+        rates = []
+        for fast in (True, False):
+            ns = NmeaNavState()
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                for line in subset:
+                    try:
+                        ns.update_nmea(line, fast=fast)
+                    except (pynmea2.ParseError, ValueError, AttributeError):
+                        pass
+            rates.append(len(subset) * repeat / (time.perf_counter() - t0))
+        print("%s: update_nmea %.0f lines/s, pynmea2 %.0f lines/s (%.1fx)" %
+              (name, rates[0], rates[1], rates[0] / rates[1]))
+        result[name] = rates
+    return result
+
+def pty_check(lines, rate=10., baud=115200):
+    """ Play lines through a pseudo-terminal at rate epochs per second
+    (an epoch starting at each GGA), with line noise and partial
+    sentences mixed in, and check that NmeaSerialReader delivers every
+    sentence. """
+    import serial
+    master, slave = os.openpty()
+    ser = serial.Serial(os.ttyname(slave), baud, timeout=0.1)
+    expected = [line.strip() for line in lines if line.startswith('$')]
+    epochs = []
+    for line in lines:
+        if not epochs or line[3:6] == 'GGA':
+            epochs.append([])
+        epochs[-1].append(line.strip() + '\r\n')
+
+    def writer():
+        os.write(master, b'A,,,A*72\r\n\xff\xfe\x00junk$GPGGA,12')
+        for i, epoch in enumerate(epochs):
+            data = ''.join(epoch).encode('ascii')
+            if i % 7 == 3: # a burst of noise between epochs
+                data = b'\x9c\xa5\x00\x10' * 8 + b'\r\n' + data
+            os.write(master, data)
+            time.sleep(1. / rate)
+
+    t = threading.Thread(target=writer)
+    t0 = time.time()
+    t.start()
+    received = []
+    for line in NmeaSerialReader(ser, timeout=len(epochs) / rate + 1.):
+        received.append(line)
+        if len(received) == len(expected):
+            break
+    dt = time.time() - t0
+    t.join()
+    ser.close()
+    os.close(master)
+    os.close(slave)
+    ok = received == expected
+    print("pty: %d/%d sentences in %.2f s at %g epochs/s: %s" %
+          (len(received), len(expected), dt, rate, 'ok' if ok else 'FAILED'))
+    return ok
+
 def main():
+    parser = argparse.ArgumentParser(description="Parse NMEA from stdin")
+    parser.add_argument('--check', action='store_true',
+                        help="Check the fast parser against pynmea2")
+    parser.add_argument('--bench', action='store_true',
+                        help="Benchmark the fast parser against pynmea2")
+    parser.add_argument('--pty', action='store_true',
+                        help="Check the serial reader with stdin played through a pty")
+    parser.add_argument('--track', metavar='INFILE',
+                        help="Convert an NMEA log to a track array")
+    parser.add_argument('-o', '--output', help="Save the track to this .npy file")
+    args = parser.parse_args()
+
+    if args.track:
+        t0 = time.perf_counter()
+        with open(args.track, 'rb') as fin:
+            track = read_nmea_track(fin)
+        print("%s: %d epochs in %.2f s" % (args.track, len(track), time.perf_counter() - t0))
+        if len(track):
+            print("%s to %s" % (track['time'][0], track['time'][-1]))
+        if args.output:
+            np.save(args.output, track)
+        return
+
+    if args.check or args.bench or args.pty:
+        lines = sys.stdin.readlines()
+        if args.check and not (check_equivalence(lines) and check_track(lines)):
+            sys.exit(1)
+        if args.bench:
+            bench_update(lines)
+            bench_track(lines)
+        if args.pty and not pty_check(lines):
+            sys.exit(1)
+        return
+
     print("Starting parsenmea")
     mynav = NmeaNavState()
 
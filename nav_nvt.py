@@ -2,9 +2,10 @@
 
 """
 Navigation adapter for Novatel binary message stream
-TODO: convert GPS time to UTC time
 """
 
+import argparse
+import io
 import time
 import sys
 import os
@@ -12,6 +13,8 @@ from collections import defaultdict
 import math
 import logging
 
+import numpy as np
+
 import bognss.NVT.nvt as nvt
 import nav
 
@@ -20,61 +23,188 @@ import nav
 def sec_from_weeksec(weeks, secs):
     return weeks*7*24*60*60 + secs
 
+# Unix time of the GPS epoch
+GPS_EPOCH = 315964800
+MS_PER_DAY = 86400000
+
 def gm_from_gps(gps_secs):
     '''
-    GPS epoch is Jan 6, 1980, which corresponds to time.gmtime(329097600)
+    GPS epoch is Jan 6, 1980, which corresponds to time.gmtime(315964800)
     '''
-    gm_time = time.gmtime(gps_secs + 329097600)
+    gm_time = time.gmtime(gps_secs + GPS_EPOCH)
     return gm_time
 
-def nvt_nav_gen(stream, gps_utc_offset, nmax=None):
-    """ Generate NavState values from a stream of novatel messages """
-    stats = defaultdict(int)
-    ns = nav.NavState()
+# Message ids by the parts of a solution they provide
+POS_MSGIDS = (42, 423) # BESTPOS, BESTGPSPOS
+VEL_MSGIDS = (99, 506) # BESTVEL, BESTGPSVEL
+PVA_MSGIDS = (507, 508) # INSPVA, INSPVAS
+
+def nvt_nav_gen(stream, gps_utc_offset, nmax=None, stats=None, parser_stats=None):
+    """ Generate nav.NavSnapshot values from a stream of novatel messages.
+
+    Position and velocity messages are grouped by their GNSS time.  A snapshot
+    is emitted as soon as an epoch has both position and velocity (such as from
+    INSPVA, or from BESTPOS and BESTVEL with the same time).  An epoch with
+    only one of them is emitted when the next epoch begins, if it changed the
+    solution.  Messages that only update the time are not emitted.
+
+    gps_utc_offset (seconds) is used until the stream reports the current
+    leap seconds in an IONUTC message.
+    Message counts by id are kept in stats, and the parser's error counts
+    in parser_stats (see NovatelParser), if they are given as dicts. """
+    if stats is None:
+        stats = defaultdict(int)
+    state = {} # current navigation fields
+    last = None # last emitted snapshot
+    epoch = None # GNSS time of the messages in state
+    has_pos = has_vel = False
 
-    for i, rec in enumerate(nvt.NovatelParser(stream, msgids=None, b_calc_crc=False, b_correct_crc=False)):
+    for i, rec in enumerate(nvt.NovatelParser(stream, msgids=None, b_calc_crc=False, b_correct_crc=False,
+                                              stats=parser_stats)):
         # Increment stats counter
-        stats[rec.header.msgid] += 1
+        msgid = rec.header.msgid
+        stats[msgid] = stats.get(msgid, 0) + 1
 
-        if rec.header.msgid in (140, 320, 325): #  skip these outright.
+        # skip these outright. Observations (140) are available from nvt_obs_gen
+        if msgid in (140, 320, 325):
             continue
 
-        data = {}
-
         if rec.parsed is None:
             logging.debug("Unparseable novatel message")
             continue # if it didn't parse right, skip it
-        if rec.header.msgid == 263: # INSATT
-            data = utc_time(rec.parsed.gnssweek, rec.parsed.gnsssec, gps_utc_offset)
-        elif rec.header.msgid in (42, 423): # BESTPOS, BESTGPSPOS
-            data = utc_time(rec.parsed.gnssweek, rec.parsed.gnsssec, gps_utc_offset)
+
+        if msgid == 8: # IONUTC
+            gps_utc_offset = learn_gps_utc_offset(gps_utc_offset, rec.parsed.deltat_ls, 'IONUTC')
+            continue
+
+        if msgid not in POS_MSGIDS and msgid not in VEL_MSGIDS and msgid not in PVA_MSGIDS:
+            continue
+
+        msgtime = (rec.header.gnssweek, rec.header.gnssmsec)
+        if msgtime != epoch:
+            if has_pos or has_vel:
+                snapshot = nav.NavSnapshot(**state)
+                if last is None or snapshot.solution != last.solution:
+                    yield snapshot
+                    last = snapshot
+            epoch = msgtime
+            has_pos = has_vel = False
+
+        if msgid in POS_MSGIDS:
+            state.update(utc_time(rec.header.gnssweek, rec.header.gnssmsec / 1000., gps_utc_offset))
             for k1, k2 in (('lat', 'latitude'), ('lon', 'longitude'), ('hgt', 'height')):
-                data[k2] = getattr(rec.parsed, k1)
-        elif rec.header.msgid in (99, 506): # BESTVEL, BESTGPSVEL
-            data = utc_time(rec.parsed.gnssweek, rec.parsed.gnsssec, gps_utc_offset)
+                state[k2] = getattr(rec.parsed, k1)
+            has_pos = True
+        elif msgid in VEL_MSGIDS:
+            state.update(utc_time(rec.header.gnssweek, rec.header.gnssmsec / 1000., gps_utc_offset))
             # vel_type latency age hor_spd trk_gnd vert_spd resvd1 crc
             for k1 in 'hor_spd trk_gnd vert_spd'.split():
-                data[k1] = getattr(rec.parsed, k1)
-        elif rec.header.msgid in (507, 508): # INSPVA, INSPVAS
-            data = utc_time(rec.parsed.gnssweek, rec.parsed.gnsssec, gps_utc_offset)
+                state[k1] = getattr(rec.parsed, k1)
+            has_vel = True
+        else: # INSPVA, INSPVAS
+            state.update(utc_time(rec.parsed.gnssweek, rec.parsed.gnsssec, gps_utc_offset))
             for k1, k2 in (('lat', 'latitude'), ('lon', 'longitude'), ('hgt', 'height'),
                 ('vu', 'vert_spd') ):
-                data[k2] = getattr(rec.parsed, k1)
+                state[k2] = getattr(rec.parsed, k1)
             ve, vn = rec.parsed.ve, rec.parsed.vn
 
             # for bearing, north = x and east = y
-            data['trk_gnd'] = math.degrees(math.atan2(ve, vn))
-            data['hor_spd'] = math.sqrt(ve*ve + vn*vn)
+            state['trk_gnd'] = math.degrees(math.atan2(ve, vn))
+            state['hor_spd'] = math.sqrt(ve*ve + vn*vn)
+            has_pos = has_vel = True
 
-        ns.update(data)
+        if has_pos and has_vel:
+            last = nav.NavSnapshot(**state)
+            yield last
+            has_pos = has_vel = False
 
-        yield ns
         if nmax is not None and i >= nmax:
             break
 
-def utc_time(gnssweek, gnsssec, gps_utc_offset_sec=0.):
+    # Emit a final partial solution
+    if has_pos or has_vel:
+        snapshot = nav.NavSnapshot(**state)
+        if last is None or snapshot.solution != last.solution:
+            yield snapshot
+
+def learn_gps_utc_offset(gps_utc_offset, leap_seconds, source):
+    """ Return the GPS-UTC offset to use after the stream reports leap_seconds.
+    Receivers report 0 before they have decoded the UTC parameters, so that
+    is ignored. """
+    if leap_seconds > 0 and leap_seconds != gps_utc_offset:
+        logging.info("GPS-UTC offset from %s: %d s (was %g s)", source, leap_seconds, gps_utc_offset)
+        return leap_seconds
+    return gps_utc_offset
+
+def check_leap_seconds(infile, gps_utc_offset=17):
+    """ Check that nvt_nav_gen uses gps_utc_offset for infile, and the
+    leap seconds from an IONUTC message when one is added to the start of it """
+    with open(infile, 'rb') as fin:
+        data = fin.read()
+    fallback = list(nvt_nav_gen(io.BytesIO(data), gps_utc_offset))
+    first = next(nvt.NovatelParser(io.BytesIO(data))).header
+    # IONUTC with deltat_ls of 18 s
+    ionutc = nvt.messages[8].struct.pack(*([0.] * 8 + [first.gnssweek, 0, 0., 0., 0, 0, 18, 18, 0, 0]))[:-4]
+    learned = list(nvt_nav_gen(io.BytesIO(nvt.encode_packet(8, first.gnssweek, first.gnssmsec, ionutc) + data),
+                               gps_utc_offset))
+    if not fallback or len(fallback) != len(learned):
+        raise ValueError("Unexpected number of navigation solutions")
+    for ns1, ns2 in zip(fallback, learned):
+        if (ns1.datetime() - ns2.datetime()).total_seconds() != 18 - gps_utc_offset:
+            raise ValueError("GPS-UTC offset not applied: {} {}".format(ns1, ns2))
+    logging.info("Leap seconds: %d solutions with fallback offset %g s and learned offset 18 s",
+                 len(fallback), gps_utc_offset)
+
+def nvt_obs_gen(stream, nmax=None):
+    """ Generate raw GNSS observations from the RANGECMP messages in a stream of
+    novatel messages, as (gnssweek, gnsssec, obs) where obs is an array
+    of nvt.RANGECMP_DTYPE with one record per tracked signal """
+    for i, rec in enumerate(nvt.NovatelParser(stream, msgids=(140,))):
+        yield rec.header.gnssweek, rec.header.gnssmsec / 1000., nvt.decode_msg140(rec.header, rec.msgbytes)
+        if nmax is not None and i >= nmax:
+            break
+
+def utc_msec(gnssweek, gnsssec, gps_utc_offset_sec=0.):
+    """ UTC milliseconds since the GPS epoch (truncated). Also works on numpy arrays
+    of week (integer) and seconds """
+    t = (gnssweek * 604800 + gnsssec - gps_utc_offset_sec) * 1000
+    return t.astype(np.int64) if isinstance(t, np.ndarray) else int(t)
+
+
+class UtcConverter:
+    """ Convert GPS week and seconds to UTC time fields for nav.NavState.
+    The UTC date of the most recent day is cached, so that each conversion
+    takes only integer arithmetic until the day changes. """
+    def __init__(self):
+        # (day number since the GPS epoch, (year, month, day))
+        self.cache_ = (None, None)
+
+    def __call__(self, gnssweek, gnsssec, gps_utc_offset_sec=0.):
+        day, tod = divmod(utc_msec(gnssweek, gnsssec, gps_utc_offset_sec), MS_PER_DAY)
+        cday, date = self.cache_
+        if day != cday:
+            tm = gm_from_gps(day * 86400)
+            date = (tm.tm_year, tm.tm_mon, tm.tm_mday)
+            self.cache_ = (day, date)
+        hour, tod = divmod(tod, 3600000)
+        return {
+            'utc_year': date[0],
+            'utc_month': date[1],
+            'utc_day': date[2],
+            'utc_hour': hour,
+            'utc_min': tod // 60000,
+            'utc_ms': tod % 60000,
+        }
+
+# Convert GPS week and seconds to a dict of UTC time fields
+utc_time = UtcConverter()
+
+
+def utc_time_gm(gnssweek, gnsssec, gps_utc_offset_sec=0.):
+    """ Reference version of utc_time, using time.gmtime for every conversion """
+    t = utc_msec(gnssweek, gnsssec, gps_utc_offset_sec)
+    gpstime = gm_from_gps(t // 1000)
     data = {}
-    gpstime = gm_from_gps(sec_from_weeksec(gnssweek, gnsssec) - gps_utc_offset_sec)
     for k1, k2 in (
         ('tm_year', 'utc_year'),
         ('tm_mon', 'utc_month'),
@@ -83,19 +213,88 @@ def utc_time(gnssweek, gnsssec, gps_utc_offset_sec=0.):
         ('tm_min', 'utc_min')):
 
         data[k2] = getattr(gpstime, k1)
-
-        data['utc_ms'] = int((gnsssec % 60.) * 1000)
+    data['utc_ms'] = t % 60000
     return data
 
 
+def utc_time_array(gnssweek, gnsssec, gps_utc_offset_sec=0.):
+    """ Convert arrays of GPS week and seconds to a dict of arrays of
+    the UTC time fields returned by utc_time """
+    t = utc_msec(np.asarray(gnssweek, dtype=np.int64), np.asarray(gnsssec, dtype=np.float64),
+                 gps_utc_offset_sec)
+    days, tod = np.divmod(t, MS_PER_DAY)
+    dates = (days + GPS_EPOCH // 86400).astype('M8[D]')
+    months = dates.astype('M8[M]')
+    years = dates.astype('M8[Y]')
+    return {
+        'utc_year': years.astype(np.int64) + 1970,
+        'utc_month': (months - years).astype(np.int64) + 1,
+        'utc_day': (dates - months).astype(np.int64) + 1,
+        'utc_hour': tod // 3600000,
+        'utc_min': tod // 60000 % 60,
+        'utc_ms': tod % 60000,
+    }
+
+
+def check_utc_time(n=100000, seed=0):
+    """ Check utc_time and utc_time_array against utc_time_gm around week
+    and day boundaries, and log their speeds """
+    rng = np.random.default_rng(seed)
+    weeks = rng.integers(1000, 2500, n)
+    secs = rng.uniform(0., 604800., n)
+    # Put a third of the times around week rollovers and day boundaries
+    k = n // 3
+    secs[:k] = rng.choice([0., 86400., 604800. - 1.], k) + rng.uniform(-20., 20., k)
+    offsets = rng.choice([0., 18., 17.5], n)
+
+    converter = UtcConverter()
+    expected = [utc_time_gm(w, s, o) for w, s, o in zip(weeks.tolist(), secs.tolist(), offsets.tolist())]
+    actual = [converter(w, s, o) for w, s, o in zip(weeks.tolist(), secs.tolist(), offsets.tolist())]
+    if actual != expected:
+        raise ValueError("utc_time differs from utc_time_gm")
+    for offset in (0., 18., 17.5):
+        sel = offsets == offset
+        arrays = utc_time_array(weeks[sel], secs[sel], offset)
+        expected_sel = [expected[i] for i in np.flatnonzero(sel)]
+        if [dict(zip(arrays, v)) for v in zip(*[a.tolist() for a in arrays.values()])] != expected_sel:
+            raise ValueError("utc_time_array differs from utc_time_gm")
+
+    # Speed on a 10 Hz stream of times
+    weeks = np.full(n, 1982)
+    secs = 21929.7125 + 0.1 * np.arange(n)
+    wlist, slist = weeks.tolist(), secs.tolist()
+    t0 = time.time()
+    for w, s in zip(wlist, slist):
+        utc_time_gm(w, s, 18.)
+    t1 = time.time()
+    for w, s in zip(wlist, slist):
+        converter(w, s, 18.)
+    t2 = time.time()
+    utc_time_array(weeks, secs, 18.)
+    t3 = time.time()
+    logging.info("utc_time: %d conversions match. gmtime %0.0f/s, cached %0.0f/s, array %0.0f/s",
+                 n, n / max(t1 - t0, 1e-6), n / max(t2 - t1, 1e-6), n / max(t3 - t2, 1e-6))
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Print navigation messages from a Novatel file")
+    parser.add_argument('--checktime', action="store_true",
+                        help="Check the UTC time conversions and report their speed")
+    args = parser.parse_args()
+
     infile = "/disk/kea/WAIS/orig/xped/ICP9/acqn/NVT/F01/SPAN_1.LOG"
     #infile = "/disk/kea/WAIS/targ/xped/ICP9/breakout/ELSA/F03/TOT3/JKB2s/X07a/AVNnp1/bxds"
     # A sample from the above file
     infile = os.path.join(os.path.dirname(__file__), 'tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds')
 
+    if args.checktime:
+        logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+        check_utc_time()
+        check_leap_seconds(infile)
+        return
+
 
-    with open(infile, "rb") as fin:
+    with nvt.open_input(infile) as fin:
         for mynav in nvt_nav_gen(fin, gps_utc_offset=18, nmax=1000):
             print(mynav.nav_message().strip())
 
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Several navigation inputs at once, with priority selection and failover.
+
+Each input's handler updates its own NavSource. On every output tick the
+server asks the NavSelector for a message, and it answers from the
+highest priority input that has updated within its staleness timeout
+(the freshest, among equal priorities). When an input drops out, the
+next healthy one takes over on the first tick after the timeout.
+
+Inputs are given as FORMAT:PORT[:PRIORITY[:STALE]], e.g.
+    ./server.py --input nvt:/dev/ttyUSB0:0:1 --input jvd:/dev/ttyUSB1:1:1
+Lower numbers are higher priority. The port may contain colons, as in
+/dev/serial/by-path names; one that ends in :NUMBER, such as the URL
+socket://host:4000, is given with commas: nvt,socket://host:4000,0,1
+
+Usage:
+
+./navselect.py --test
+
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import nav
+
+# Default seconds without an update before an input is considered failed
+STALE_TIMEOUT = 2.0
+
+InputSpec = namedtuple('InputSpec', 'format port priority stale')
+
+def is_number(field):
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+def parse_input_spec(spec):
+    """ Parse FORMAT:PORT[:PRIORITY[:STALE]] into an InputSpec. The
+    format is the first field and the priority and staleness timeout are
+    up to two numeric (or empty) fields at the end, so the port keeps any
+    colons of its own. If the spec has commas, it is split on them
+    instead: FORMAT,PORT[,PRIORITY[,STALE]]. """
+    sep = ',' if ',' in spec else ':'
+    fmt, _, rest = spec.partition(sep)
+    if sep == ',':
+        parts = rest.split(sep)
+    else:
+        parts = rest.rsplit(sep, 2)
+        nport = len(parts)
+        while nport > 1 and (parts[nport - 1] == '' or is_number(parts[nport - 1])):
+            nport -= 1
+        parts = [sep.join(parts[:nport])] + parts[nport:]
+    if not fmt or not parts[0] or len(parts) > 3:
+        raise ValueError("Expected FORMAT:PORT[:PRIORITY[:STALE]], got %r" % spec)
+    priority = int(parts[1]) if len(parts) > 1 and parts[1] else 0
+    stale = float(parts[2]) if len(parts) > 2 and parts[2] else STALE_TIMEOUT
+    return InputSpec(fmt, parts[0], priority, stale)
+
+
+class NavSource:
+    """ Navigation state from one input. Has NavState's update(), so it
+    can be handed to a serial handler, and records when it was last
+    updated. """
+    def __init__(self, name, priority=0, stale=STALE_TIMEOUT):
+        self.name = name
+        self.priority = priority
+        self.stale = stale
+        self.state = nav.NavState()
+        self.t_update = None
+        self.nupdates = 0
+
+    def update(self, other):
+        self.state.update(other)
+        self.t_update = time.monotonic()
+        self.nupdates += 1
+
+    def age(self, now=None):
+        if self.t_update is None:
+            return float('inf')
+        return (time.monotonic() if now is None else now) - self.t_update
+
+    def healthy(self, now=None):
+        return self.age(now) <= self.stale
+
+
+class NavSelector:
+    """ Chooses which NavSource to send from, once per output tick.
+    Has nav_message() and snapshot() like a NavState, for server(). """
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self.current = None
+        self.switches = []  # (time, source name)
+
+    def select(self, now=None):
+        """ The highest priority healthy source (freshest among equals).
+        If none is healthy, the most recently updated one, or None. """
+        if now is None:
+            now = time.monotonic()
+        healthy = [s for s in self.sources if s.healthy(now)]
+        if healthy:
+            best = min(healthy, key=lambda s: (s.priority, s.age(now)))
+        else:
+            updated = [s for s in self.sources if s.t_update is not None]
+            best = min(updated, key=lambda s: s.age(now)) if updated else None
+        if best is not self.current and best is not None:
+            logging.info("Navigation input: %s (was %s)", best.name,
+                         self.current.name if self.current else None)
+            self.switches.append((now, best.name))
+            self.current = best
+        return best
+
+    def update_time(self):
+        """ time.monotonic() of the last update of the source selected now.
+        The server calls this before nav_message() on each tick, so it
+        selects too: otherwise, on the tick of a failover, it would report
+        the source that just went stale. """
+        source = self.select()
+        return None if source is None else source.t_update
+
+    def snapshot(self):
+        source = self.select()
+        return nav.NavState().snapshot() if source is None else source.state.snapshot()
+
+    def nav_message(self):
+        return self.snapshot().nav_message()
+
+
+def failover_test(duration=6., fail_after=2., interval=0.2, stale=0.5):
+    """ Replay the bundled Novatel (priority 0) and Javad (priority 1)
+    files of the same flight, stop the Novatel input part way through,
+    and check that the selector moves to Javad within one output
+    interval of the staleness timeout. """
+    import replay
+    datadir = os.path.join(os.path.dirname(__file__), 'tests/data')
+    nvtfile = os.path.join(datadir, 'ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds')
+    jvdfile = os.path.join(datadir, 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds')
+    sources = [NavSource('nvt', 0, stale), NavSource('jvd', 1, stale)]
+    gens = [replay.Replayer('nvt', nvtfile, utcoffset=18.),
+            replay.Replayer('jvd', jvdfile, utcoffset=18., weekoffset=1024)]
+
+    t0 = time.monotonic()
+    def feed(source, gen, stop_after):
+        for ns2 in gen:
+            if stop_after is not None and time.monotonic() - t0 > stop_after:
+                break
+            source.update(ns2)
+            if time.monotonic() - t0 > duration:
+                break
+
+    threads = [threading.Thread(target=feed, args=(sources[0], gens[0], fail_after), daemon=True),
+               threading.Thread(target=feed, args=(sources[1], gens[1], None), daemon=True)]
+    for t in threads:
+        t.start()
+
+    selector = NavSelector(sources)
+    ticks = []
+    same_source = True # update_time and nav_message agree, as the server calls them
+    while time.monotonic() - t0 < duration:
+        time.sleep(interval)
+        t_update = selector.update_time()
+        source = selector.current
+        selector.nav_message()
+        same_source &= selector.current is source and (source is None or t_update <= source.t_update)
+        ticks.append((time.monotonic() - t0, selector.current.name if selector.current else None))
+
+    t_fail = sources[0].t_update - t0
+    switch = [t - t0 for t, name in selector.switches if name == 'jvd']
+    ok = (bool(switch) and ticks[-1][1] == 'jvd' and
+          switch[-1] - t_fail <= stale + interval + 0.05 and
+          any(name == 'nvt' for _, name in ticks) and same_source)
+    print("nvt stopped at %.2f s; switched to jvd at %s s (stale %.2f s, interval %.2f s): %s" %
+          (t_fail, ', '.join('%.2f' % t for t in switch), stale, interval, 'ok' if ok else 'FAILED'))
+    return ok
+
+def spec_test():
+    """ Check parse_input_spec on ports with and without colons """
+    cases = [
+        ('nvt:/dev/ttyUSB0', ('nvt', '/dev/ttyUSB0', 0, STALE_TIMEOUT)),
+        ('nvt:/dev/ttyUSB0:1:0.5', ('nvt', '/dev/ttyUSB0', 1, 0.5)),
+        ('jvd:/dev/ttyUSB1::3', ('jvd', '/dev/ttyUSB1', 0, 3.)),
+        ('nvt:/dev/serial/by-path/pci-0000:00:14.0-usb-0:1:1.0-port0:2',
+         ('nvt', '/dev/serial/by-path/pci-0000:00:14.0-usb-0:1:1.0-port0', 2, STALE_TIMEOUT)),
+        ('nmea,socket://host:4000,1,2', ('nmea', 'socket://host:4000', 1, 2.)),
+        ('nmea,socket://host:4000', ('nmea', 'socket://host:4000', 0, STALE_TIMEOUT)),
+    ]
+    ok = all(parse_input_spec(spec) == expected for spec, expected in cases)
+    for spec in ('nvt', 'nvt:', ':/dev/ttyUSB0', 'nvt:/dev/ttyUSB0:1.5', 'nvt,port,1,2,3'):
+        try:
+            parse_input_spec(spec)
+            ok = False
+        except ValueError:
+            pass
+    print("parse_input_spec: %s" % ('ok' if ok else 'FAILED'))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Navigation input selection")
+    parser.add_argument('--test', action='store_true',
+                        help="Replay the sample data, failing one input part way through")
+    parser.add_argument('--duration', default=6., type=float)
+    parser.add_argument('--fail-after', default=2., type=float)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    if args.test and not (spec_test() & failover_test(args.duration, args.fail_after)):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
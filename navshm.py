@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Shared-memory handoff of navigation state from a decoder process.
+
+Decoding Novatel or GREIS in Python holds the GIL, which delays the
+server's send loop when it runs on a thread in the same process.
+Running the serial handler in its own process avoids that: it publishes
+each NavSnapshot into a small shared memory block, and the server reads
+the latest one when it sends.
+
+The block is guarded by a sequence counter (a seqlock). The writer makes
+the counter odd while it writes and even when it is done; a reader
+copies the block and retries if the counter was odd or changed.
+
+Usage:
+
+./navshm.py --bench
+
+"""
+
+import argparse
+import logging
+import multiprocessing
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import nav
+
+# seq, publish time, then the NavSnapshot fields (6 ints, 6 floats)
+S_SEQ = struct.Struct('<Q')
+S_NAVSHM = struct.Struct('<Qd6q6d')
+
+
+class NavShmWriter:
+    """ Publishes navigation state into shared memory. Has an update()
+    like NavState's, so it can be handed to the serial handlers. Creates
+    a new block, or attaches to an existing one given its name. """
+    def __init__(self, shm=None):
+        if shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=S_NAVSHM.size)
+            S_NAVSHM.pack_into(shm.buf, 0, 0, 0., *nav.NavSnapshot())
+        elif isinstance(shm, str):
+            shm = shared_memory.SharedMemory(name=shm)
+        self.shm = shm
+        self.seq = S_SEQ.unpack_from(shm.buf, 0)[0]
+        self.state = nav.NavState()
+
+    def publish(self, snapshot, t=None):
+        buf = self.shm.buf
+        self.seq += 1
+        S_SEQ.pack_into(buf, 0, self.seq) # odd: write in progress
+        S_NAVSHM.pack_into(buf, 0, self.seq, time.time() if t is None else t, *snapshot)
+        self.seq += 1
+        S_SEQ.pack_into(buf, 0, self.seq)
+
+    def update(self, other):
+        """ Update from a dict, NavState or NavSnapshot and publish """
+        self.state.update(other)
+        self.publish(self.state.snapshot())
+
+    def close(self, unlink=True):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class NavShmReader:
+    """ Reads navigation state published by a NavShmWriter. Has the
+    nav_message() and snapshot() of a NavState, so the server can send
+    from it directly. """
+    def __init__(self, shm):
+        if isinstance(shm, str):
+            shm = shared_memory.SharedMemory(name=shm)
+        self.shm = shm
+        self.retries = 0
+
+    def read(self):
+        """ Return (seq, publish time, NavSnapshot) """
+        buf = self.shm.buf
+        while True:
+            seq1 = S_SEQ.unpack_from(buf, 0)[0]
+            if not seq1 & 1:
+                values = S_NAVSHM.unpack_from(buf, 0)
+                if values[0] == seq1 and S_SEQ.unpack_from(buf, 0)[0] == seq1:
+                    return seq1, values[1], nav.NavSnapshot._make(values[2:])
+            self.retries += 1
+            time.sleep(0) # let the writer finish
+
+    def snapshot(self):
+        return self.read()[2]
+
+    def update_time(self):
+        """ time.monotonic() of the last publish, or None """
+        seq, tpub = self.read()[:2]
+        return time.monotonic() - (time.time() - tpub) if seq else None
+
+    def nav_message(self):
+        return self.snapshot().nav_message()
+
+    def datetime(self):
+        return self.snapshot().datetime()
+
+
+def run_decoder(target, name, size, *args):
+    """ Process entry point: attach a writer to the shared memory block
+    called name and run target(writer, *args). The writer is made here
+    rather than passed in, as its lock and shared memory handle can't be
+    pickled for a spawned process. """
+    writer = NavShmWriter(name)
+    try:
+        if writer.shm.size < size:
+            raise ValueError("Shared memory %s is %d bytes, expected %d" % (name, writer.shm.size, size))
+        return target(writer, *args)
+    finally:
+        writer.close(unlink=False)
+
+def start_decoder(handler, args):
+    """ Run a serial handler (see server.py) in its own process,
+    publishing to shared memory. Returns the writer and the process. """
+    writer = NavShmWriter()
+    proc = multiprocessing.Process(target=run_decoder, daemon=True,
+                                   args=(handler, writer.shm.name, S_NAVSHM.size) + tuple(args))
+    proc.start()
+    return writer, proc
+
+
+#-------------------------------------------------------------------------
+# Benchmark
+
+def decode_loop(writer, infile, duration):
+    """ Decode infile over and over for duration seconds, publishing
+    every snapshot, as a stand-in for a saturated high-rate stream """
+    import nav_nvt
+    with open(infile, 'rb') as fin:
+        data = fin.read()
+    t0 = time.time()
+    n = 0
+    while time.time() - t0 < duration:
+        for ns2 in nav_nvt.nvt_nav_gen(data, 18.):
+            writer.publish(ns2)
+            n += 1
+    return n
+
+def send_loop(reader, duration, interval):
+    """ Stand-in for the server's send loop: wake every interval and
+    format a message from the latest state. Returns the send jitter
+    (actual minus nominal period) and the age of the state sent. """
+    periods, ages = [], []
+    t0 = tlast = time.perf_counter()
+    while tlast - t0 < duration:
+        time.sleep(interval)
+        now = time.perf_counter()
+        periods.append(now - tlast)
+        tlast = now
+        seq, tpub, snapshot = reader.read()
+        snapshot.nav_message()
+        if seq:
+            ages.append(time.time() - tpub)
+    return np.array(periods) - interval, np.array(ages)
+
+def bench_decoder(infile, duration=3., interval=0.01):
+    """ Server send jitter and state age with the decoder on a thread
+    and in a separate process """
+    result = {}
+    for mode in ('thread', 'process'):
+        writer = NavShmWriter()
+        reader = NavShmReader(writer.shm)
+        if mode == 'thread':
+            worker = threading.Thread(target=decode_loop, args=(writer, infile, duration + 0.5))
+        else:
+            worker = multiprocessing.Process(target=run_decoder,
+                                             args=(decode_loop, writer.shm.name, S_NAVSHM.size, infile, duration + 0.5))
+        worker.start()
+        time.sleep(0.2)
+        jitter, ages = send_loop(reader, duration, interval)
+        worker.join()
+        writer.close()
+        ms = lambda a, p: 1000. * np.percentile(a, p) if len(a) else float('nan')
+        print("%-8s send jitter ms: median %.3f p99 %.3f max %.3f; "
+              "state age ms: median %.3f p99 %.3f; seqlock retries %d" %
+              (mode, ms(jitter, 50), ms(jitter, 99), 1000. * jitter.max(),
+               ms(ages, 50), ms(ages, 99), reader.retries))
+        result[mode] = (jitter, ages)
+    return result
+
+def main():
+    import os
+    parser = argparse.ArgumentParser(description="Shared-memory NavState handoff")
+    parser.add_argument('--bench', action='store_true',
+                        help="Benchmark send jitter with the decoder on a thread vs a process")
+    parser.add_argument('-i', '--input', default=os.path.join(os.path.dirname(__file__),
+                        'tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds'),
+                        help="Novatel input file for the decoder")
+    parser.add_argument('--duration', default=3., type=float)
+    parser.add_argument('--interval', default=0.01, type=float, help="Send interval (s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    if args.bench:
+        bench_decoder(args.input, args.duration, args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""
+Per-stage timers and profilers for the server and the command line tools.
+
+Three modes, any of which can be combined:
+
+stages   - time each pass through the stages of the input pipeline
+           (read, sync, unpack, nav, update, encode, send) into log2
+           histograms. Time is exclusive: a parser's time doesn't
+           include the reads it makes.
+cprofile - run cProfile on the server and handler threads.
+sample   - a thread samples the stacks of the other threads every few
+           milliseconds and counts where they are.
+
+Instrumentation is installed by wrapping the functions at each stage
+boundary, and nothing is wrapped (or imported) unless a mode is
+enabled, so the cost when profiling is off is nil. A summary is logged
+on exit, and on SIGUSR1 while running.
+
+Usage:
+
+./server.py --format nvtsim --profile stages --profile sample
+kill -USR1 <pid>
+./profiling.py --check
+
+"""
+
+import argparse
+import atexit
+import collections
+import functools
+import io
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import nav
+
+PROFILE_MODES = ('stages', 'cprofile', 'sample')
+STAGES = ('read', 'sync', 'unpack', 'nav', 'update', 'encode', 'send')
+SAMPLE_INTERVAL = 0.005
+SUMMARY_TOP = 15
+
+# Histogram buckets are powers of two nanoseconds
+HIST_BUCKETS = 48
+
+perf_ns = time.perf_counter_ns
+
+# The summary is logged at INFO even if other logging is quieter
+logger = logging.getLogger('profiling')
+logger.setLevel(logging.INFO)
+
+
+class StageTimer:
+    """ Count, total and a log2 histogram of the time spent in a stage.
+    Not locked: each stage normally runs on one thread, and a count
+    lost to a race between two would only make the summary a little
+    short. """
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.hist = [0] * HIST_BUCKETS
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        self.hist[min(ns.bit_length(), HIST_BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        """ Upper edge (ns) of the bucket holding the pth percentile """
+        target = self.count * p / 100.
+        seen = 0
+        for i, n in enumerate(self.hist):
+            seen += n
+            if n and seen >= target:
+                return min(1 << i, self.max)
+        return self.max
+
+    def summary(self, elapsed_ns):
+        if not self.count:
+            return "%-7s %9d" % (self.name, 0)
+        return ("%-7s %9d %10.3f %5.1f%% %10.2f %10.2f %10.2f %10.2f" %
+                (self.name, self.count, self.total / 1e9, 100. * self.total / max(elapsed_ns, 1),
+                 self.total / self.count / 1e3, self.percentile(50) / 1e3,
+                 self.percentile(99) / 1e3, self.max / 1e3))
+
+
+class StageProfiler:
+    """ Exclusive per-stage timing. Each thread keeps a stack of the
+    stages it is in, so that time in an inner stage is taken out of the
+    outer one. """
+    def __init__(self):
+        self.timers = {name: StageTimer(name) for name in STAGES}
+        self.local = threading.local()
+        self.originals = []
+        self.t0 = perf_ns()
+
+    def begin(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append([perf_ns(), 0])
+
+    def end(self, timer):
+        t1 = perf_ns()
+        stack = self.local.stack
+        t0, child = stack.pop()
+        elapsed = t1 - t0
+        if stack:
+            stack[-1][1] += elapsed
+        timer.add(elapsed - child)
+
+    def timed_call(self, fn, stage):
+        """ fn, timing each call in stage """
+        timer = self.timers[stage]
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.begin()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.end(timer)
+        return wrapper
+
+    def timed_gen(self, fn, stage):
+        """ Generator function fn, timing each item it yields in stage """
+        timer = self.timers[stage]
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            it = fn(*args, **kwargs)
+            while True:
+                self.begin()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    self.end(timer)
+                yield item
+        return wrapper
+
+    def wrap(self, owner, name, stage, gen=False):
+        original = getattr(owner, name)
+        self.originals.append((owner, name, original))
+        setattr(owner, name, (self.timed_gen if gen else self.timed_call)(original, stage))
+
+    def install(self):
+        """ Wrap the stage boundaries of the input pipeline """
+        import bognss.NVT.nvt as nvt
+        import bognss.JVD.greis as greis
+        import capture
+        import nav_jvd
+        import nav_nmea
+        import nav_nvt
+        self.wrap(capture.RingReader, 'read', 'read')
+        self.wrap(nvt, 'make_reader', 'sync', gen=True)
+        self.wrap(greis, 'make_reader', 'sync', gen=True)
+        self.wrap(nvt, 'NovatelParser', 'unpack', gen=True)
+        self.wrap(greis, 'GREISParser', 'unpack', gen=True)
+        self.wrap(greis, 'GREISEpochAssembler', 'unpack', gen=True)
+        self.wrap(nav_nmea.NmeaNavState, 'update_nmea', 'unpack')
+        self.wrap(nav_nvt, 'nvt_nav_gen', 'nav', gen=True)
+        self.wrap(nav_jvd, 'greis_nav_gen', 'nav', gen=True)
+        self.wrap(nav.NavState, 'update', 'update')
+        self.wrap(nav.NavState, 'nav_message', 'encode')
+        self.wrap(nav.NavSnapshot, 'nav_message', 'encode')
+
+    def uninstall(self):
+        while self.originals:
+            owner, name, original = self.originals.pop()
+            setattr(owner, name, original)
+
+    def summary(self):
+        elapsed = perf_ns() - self.t0
+        lines = ["Stage timers over %.2f s (times exclusive; us):" % (elapsed / 1e9),
+                 "%-7s %9s %10s %6s %10s %10s %10s %10s" %
+                 ('stage', 'count', 'total s', 'share', 'mean', 'p50', 'p99', 'max')]
+        lines += [timer.summary(elapsed) for timer in self.timers.values()]
+        return '\n'.join(lines)
+
+
+class Sampler(threading.Thread):
+    """ Samples the stacks of the other threads every interval seconds,
+    counting the function each is in (self) and every function on its
+    stack (total). """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.nsamples = 0
+        self.stopping = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.nsamples += 1
+                seen = set()
+                self.self_counts[frame_key(frame)] += 1
+                while frame is not None:
+                    key = frame_key(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        self.total_counts[key] += 1
+                    frame = frame.f_back
+
+    def stop(self):
+        self.stopping.set()
+
+    def summary(self, top=SUMMARY_TOP):
+        n = max(self.nsamples, 1)
+        lines = ["Sampled %d thread stacks every %g ms:" % (self.nsamples, 1000. * self.interval),
+                 "%6s %6s  %s" % ('self', 'total', 'function')]
+        for key, count in self.self_counts.most_common(top):
+            lines.append("%5.1f%% %5.1f%%  %s" % (100. * count / n, 100. * self.total_counts[key] / n, key))
+        return '\n'.join(lines)
+
+def frame_key(frame):
+    code = frame.f_code
+    return "%s:%d(%s)" % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class Profiling:
+    """ The enabled profiling modes, and their summary """
+    def __init__(self, modes=(), interval=SAMPLE_INTERVAL):
+        self.modes = frozenset(modes)
+        self.stages = StageProfiler() if 'stages' in self.modes else None
+        self.sampler = Sampler(interval) if 'sample' in self.modes else None
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.stages is not None:
+            self.stages.install()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def stop(self):
+        if self.stages is not None:
+            self.stages.uninstall()
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def timed_call(self, fn, stage):
+        """ fn, timed in stage if stage timers are on, otherwise fn itself """
+        return fn if self.stages is None else self.stages.timed_call(fn, stage)
+
+    def thread_target(self, fn):
+        """ fn, run under cProfile if that is on, otherwise fn itself """
+        if 'cprofile' not in self.modes:
+            return fn
+        import cProfile
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+        return wrapper
+
+    def summary(self, top=SUMMARY_TOP):
+        parts = []
+        if self.stages is not None:
+            parts.append(self.stages.summary())
+        if self.profiles:
+            import pstats
+            out = io.StringIO()
+            with self.lock:
+                stats = pstats.Stats(*self.profiles, stream=out)
+            stats.sort_stats('cumulative').print_stats(top)
+            parts.append("cProfile:\n" + out.getvalue().strip())
+        if self.sampler is not None:
+            parts.append(self.sampler.summary(top))
+        return '\n\n'.join(parts)
+
+    def log_summary(self, *_):
+        if self.modes:
+            logger.info("Profile summary\n%s", self.summary())
+
+
+# Profiling is off until start_profiling is called
+PROFILING = Profiling()
+
+def start_profiling(modes, interval=SAMPLE_INTERVAL):
+    """ Enable the given modes, logging a summary at exit and on SIGUSR1 """
+    global PROFILING
+    PROFILING = Profiling(modes, interval)
+    PROFILING.start()
+    if PROFILING.modes:
+        atexit.register(PROFILING.log_summary)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, PROFILING.log_summary)
+    return PROFILING
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', action='append', choices=PROFILE_MODES, default=[],
+                        help="Profile with stage timers, cProfile or stack sampling "
+                        "(repeat for several); the summary is logged on exit and on SIGUSR1")
+    parser.add_argument('--sample-interval', default=SAMPLE_INTERVAL, type=float,
+                        help="Seconds between stack samples (default %(default)g)")
+
+
+def overhead_check(repeat=20):
+    """ nvt_nav_gen and greis_nav_gen throughput on the sample files,
+    before, during and after stage timing """
+    import bognss.NVT.nvt as nvt
+    import nav_jvd
+    import nav_nvt
+    datadir = os.path.join(os.path.dirname(__file__), 'tests/data')
+    with open(os.path.join(datadir, 'ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds'), 'rb') as fin:
+        nvtdata = fin.read()
+    with open(os.path.join(datadir, 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds'), 'rb') as fin:
+        jvddata = fin.read()
+    originals = (nav_nvt.nvt_nav_gen, nvt.NovatelParser, nav.NavState.update)
+
+    def rate():
+        ns = nav.NavState()
+        n = 0
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            for ns2 in nav_nvt.nvt_nav_gen(nvtdata, 18.):
+                ns.update(ns2)
+                ns.nav_message()
+                n += 1
+            for ns2 in nav_jvd.greis_nav_gen(jvddata, 18., 1024):
+                ns.update(ns2)
+                n += 1
+        return n / (time.perf_counter() - t0)
+
+    r_off = rate()
+    prof = Profiling(('stages',))
+    prof.start()
+    r_on = rate()
+    prof.stop()
+    r_after = rate()
+    restored = originals == (nav_nvt.nvt_nav_gen, nvt.NovatelParser, nav.NavState.update)
+    print(prof.summary())
+    print("Snapshots/s: off %.0f, stage timers on %.0f (%+.1f%%), off again %.0f (%+.1f%%); "
+          "functions restored: %s" %
+          (r_off, r_on, 100. * (r_on / r_off - 1), r_after, 100. * (r_after / r_off - 1),
+           'ok' if restored else 'FAILED'))
+    return restored
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage timers and profiling")
+    parser.add_argument('--check', action='store_true',
+                        help="Measure the stage timer overhead on the sample data")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    if args.check and not overhead_check():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Replay a recorded Novatel, Javad or NMEA file as navigation messages,
+timed by their timestamps.
+
+A start/end window into an uncompressed Novatel or Javad file is found
+with the decoder's sidecar time index (built on first use and saved
+next to the file), so replay seeks to the start of the window rather
+than decoding everything before it. NMEA and compressed files are
+decoded from the start, skipping the messages before the window.
+
+Messages are scheduled against the monotonic clock from a fixed anchor
+(the first message of each pass), rather than by sleeping for the gap
+since the previous message, so a long replay does not drift. The speed
+factor scales the recorded time, and a speed of 0 replays as fast as
+the messages can be decoded.
+
+Usage:
+
+./replay.py -i tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --format nvt --speed 10
+./replay.py -i nmea.log.gz --format nmea --start 60 --end 120 --loop --duration 30
+./server.py --format nvtsim -s nvt.bxds.xz --speed 4 --loop
+
+"""
+
+import argparse
+import datetime
+import logging
+import math
+import os
+import sys
+import time
+from array import array
+
+import profiling
+
+REPLAY_FORMATS = ('nvt', 'jvd', 'nmea')
+# Formats with a sidecar time index, for uncompressed files
+INDEXED_FORMATS = ('nvt', 'jvd')
+MIN_SPEED, MAX_SPEED = 0.1, 100.
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def snapshot_time(ns):
+    """ UTC time of a NavState or NavSnapshot, in seconds since 1970 """
+    return (ns.datetime() - EPOCH).total_seconds()
+
+
+def nmea_nav_gen(fin, stats=None, parser_stats=None):
+    """ Generate nav.NavSnapshot values from a binary stream of NMEA
+    sentences, one per change of the navigation state. Sentence counts
+    by type are kept in stats, and the count of sentences that didn't
+    parse in parser_stats['unparseable'], if they are given as dicts. """
+    import pynmea2
+    import nav_nmea
+    ns2 = nav_nmea.NmeaNavState()
+    last = None
+    for line in fin:
+        line = line.decode('ascii', 'replace')
+        if stats is not None:
+            nav_nmea.count_sentence(stats, line)
+        try:
+            ns2.update_nmea(line)
+        except (pynmea2.ParseError, ValueError) as e:
+            logging.debug("Parse error: %s", e)
+            if parser_stats is not None:
+                parser_stats['unparseable'] = parser_stats.get('unparseable', 0) + 1
+            continue
+        snapshot = ns2.snapshot()
+        if snapshot != last:
+            last = snapshot
+            yield snapshot
+
+def load_index(fmt, infile):
+    """ The sidecar time index of infile (see bognss/fileio.py), or None
+    if fmt has none or infile is compressed """
+    from bognss import fileio
+    if fmt not in INDEXED_FORMATS or fileio.compression_type(infile) is not None:
+        return None
+    if fmt == 'nvt':
+        import bognss.NVT.nvt as decoder
+    else:
+        import bognss.JVD.greis as decoder
+    return decoder.load_index(infile)
+
+def nav_file_gen(fmt, infile, utcoffset=18., weekoffset=1024, stats=None, parser_stats=None,
+                 index=None, t0=-float('inf'), t1=float('inf')):
+    """ Generate nav.NavSnapshot values from a recorded file, which may be
+    compressed. Messages without a time (year 1980) are skipped. Message
+    counts by type are kept in stats and parser error counts in
+    parser_stats, if they are given as dicts. Only the adapter for fmt
+    is imported (nav_jvd takes its time conversions from nav_nvt, so it
+    brings in the Novatel decoder too). If index is the file's sidecar
+    index (see load_index), only its packets with index times
+    t0 <= t < t1 are decoded. """
+    kw = {'stats': stats, 'parser_stats': parser_stats}
+    if fmt not in REPLAY_FORMATS:
+        raise ValueError("Unknown replay format %r" % fmt)
+    from bognss import fileio
+    if fmt == 'nvt':
+        import nav_nvt
+        opener, navgen = fileio.open_mmap, lambda fin: nav_nvt.nvt_nav_gen(fin, utcoffset, **kw)
+    elif fmt == 'jvd':
+        import nav_jvd
+        opener, navgen = fileio.open_mmap, lambda fin: nav_jvd.greis_nav_gen(fin, utcoffset, weekoffset, **kw)
+    else:
+        opener, navgen = fileio.open_input, lambda fin: nmea_nav_gen(fin, **kw)
+    if index is not None:
+        opener = lambda infile: open(infile, 'rb')
+        navgen = lambda fin, navgen=navgen: fileio.iter_range(fin, t0, t1, index, navgen)
+    with opener(infile) as fin:
+        for ns2 in navgen(fin):
+            if ns2.utc_year != 1980:
+                yield ns2
+
+
+def check_speed(speed):
+    if speed and not MIN_SPEED <= speed <= MAX_SPEED:
+        raise ValueError("Replay speed must be 0 or from %g to %g, got %g" % (MIN_SPEED, MAX_SPEED, speed))
+
+
+class ReplayClock:
+    """ Releases messages at their recorded times, scaled by speed, on
+    the monotonic clock. A speed of 0 (or None) doesn't wait at all.
+    Keeps the lateness of each message (actual minus scheduled time). """
+    def __init__(self, speed=1.):
+        self.speed = speed
+        self.anchor = None # (monotonic time, message time)
+        self.late = array('d')
+
+    def rebase(self):
+        """ Schedule the next message for now, as at the start of a pass """
+        self.anchor = None
+
+    def wait(self, msgtime):
+        """ Sleep until msgtime (seconds) is due; return the lateness """
+        now = time.monotonic()
+        if not self.speed:
+            return 0.
+        if self.anchor is None:
+            self.anchor = (now, msgtime)
+        target = self.anchor[0] + (msgtime - self.anchor[1]) / self.speed
+        if target > now:
+            time.sleep(target - now)
+            now = time.monotonic()
+        late = now - target
+        self.late.append(late)
+        return late
+
+
+class Replayer:
+    """ Iterates over the navigation messages of a file at replay speed.
+
+    start and end select a window in seconds from the first message of
+    the file. For uncompressed Novatel and Javad files, the window is
+    found with the sidecar index, measured from the first timed packet,
+    and the file is entered at its start; otherwise the messages before
+    it are decoded and skipped. With loop, the window repeats until the
+    iteration is abandoned; each pass starts on time again, so the first
+    message of the next pass is sent as soon as the last one of the
+    previous. """
+    def __init__(self, fmt, infile, speed=1., start=None, end=None, loop=False,
+                 utcoffset=18., weekoffset=1024, metrics=None):
+        check_speed(speed)
+        self.fmt = fmt
+        self.infile = infile
+        self.start = start
+        self.end = end
+        self.loop = loop
+        self.utcoffset = utcoffset
+        self.weekoffset = weekoffset
+        self.metrics = metrics
+        self.index = load_index(fmt, infile) if start is not None or end is not None else None
+        self.clock = ReplayClock(speed)
+        self.nmsgs = 0
+        self.passes = 0
+        self.t_start = None
+
+    def window(self):
+        """ Messages of one pass over the file, within start and end """
+        stats, parser_stats = (None, None) if self.metrics is None else (self.metrics.messages, self.metrics.parser)
+        if self.index is not None:
+            from bognss import fileio
+            t_first = fileio.first_time(self.index)
+            t0 = -float('inf') if self.start is None else t_first + self.start
+            # end is included, as when skipping
+            t1 = float('inf') if self.end is None else math.nextafter(t_first + self.end, float('inf'))
+            for ns2 in nav_file_gen(self.fmt, self.infile, self.utcoffset, self.weekoffset,
+                                    stats, parser_stats, self.index, t0, t1):
+                yield snapshot_time(ns2), ns2
+            return
+        t_first = None
+        for ns2 in nav_file_gen(self.fmt, self.infile, self.utcoffset, self.weekoffset, stats, parser_stats):
+            msgtime = snapshot_time(ns2)
+            if t_first is None:
+                t_first = msgtime
+            if self.start is not None and msgtime - t_first < self.start:
+                continue
+            if self.end is not None and msgtime - t_first > self.end:
+                break
+            yield msgtime, ns2
+
+    def __iter__(self):
+        self.t_start = time.monotonic()
+        while True:
+            self.clock.rebase()
+            nmsgs = self.nmsgs
+            for msgtime, ns2 in self.window():
+                self.clock.wait(msgtime)
+                self.nmsgs += 1
+                yield ns2
+            self.passes += 1
+            if not self.loop or self.nmsgs == nmsgs:
+                break
+
+    def stats(self):
+        """ Messages sent, passes, elapsed seconds, message rate and
+        lateness percentiles in milliseconds """
+        import numpy as np
+        elapsed = time.monotonic() - self.t_start if self.t_start is not None else 0.
+        late = np.frombuffer(self.clock.late, dtype=float) * 1000. if self.clock.late else np.zeros(1)
+        return {
+            'messages': self.nmsgs,
+            'passes': self.passes,
+            'elapsed': elapsed,
+            'rate': self.nmsgs / elapsed if elapsed > 0 else 0.,
+            'late_median_ms': np.median(late),
+            'late_p99_ms': np.percentile(late, 99),
+            'late_max_ms': late.max(),
+        }
+
+    def report(self):
+        s = self.stats()
+        return ("%s: %d messages in %d passes over %.2f s (%.1f msgs/s at speed %s); "
+                "lateness ms median %.3f p99 %.3f max %.3f" %
+                (os.path.basename(self.infile), s['messages'], s['passes'], s['elapsed'], s['rate'],
+                 '%g' % self.clock.speed if self.clock.speed else 'unthrottled',
+                 s['late_median_ms'], s['late_p99_ms'], s['late_max_ms']))
+
+
+def add_replay_arguments(parser):
+    """ Replay options, shared with server.py """
+    parser.add_argument('--speed', default=1., type=float,
+                        help="Replay speed factor, %g to %g (default %%(default)g)" % (MIN_SPEED, MAX_SPEED))
+    parser.add_argument('--unthrottled', action='store_true',
+                        help="Replay as fast as possible")
+    parser.add_argument('--start', default=None, type=float,
+                        help="Start replaying this many seconds after the first message")
+    parser.add_argument('--end', default=None, type=float,
+                        help="Stop replaying this many seconds after the first message")
+    parser.add_argument('--loop', action='store_true',
+                        help="Replay the file (or window) over and over")
+
+def replay_options(args):
+    """ Replayer keyword arguments from parsed add_replay_arguments options """
+    check_speed(args.speed)
+    return {'speed': 0. if args.unthrottled else args.speed,
+            'start': args.start, 'end': args.end, 'loop': args.loop}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded navigation file")
+    parser.add_argument('-i', '--input', required=True, help="Input file (may be gzip, xz or zstd compressed)")
+    parser.add_argument('--format', default='nvt', choices=REPLAY_FORMATS)
+    parser.add_argument('--gpsutcoffset', default=18., type=float)
+    parser.add_argument('--gpsweekoffset', default=1024, type=int)
+    parser.add_argument('--duration', default=None, type=float,
+                        help="Stop after this many seconds")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print each message")
+    add_replay_arguments(parser)
+    profiling.add_profile_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+    profiling.start_profiling(args.profile, args.sample_interval)
+
+    try:
+        replayer = Replayer(args.format, args.input, utcoffset=args.gpsutcoffset,
+                            weekoffset=args.gpsweekoffset, **replay_options(args))
+    except ValueError as e:
+        parser.error(str(e))
+    def run():
+        t0 = time.monotonic()
+        for ns2 in replayer:
+            if args.verbose:
+                print(ns2.nav_message().strip())
+            if args.duration is not None and time.monotonic() - t0 > args.duration:
+                break
+    profiling.PROFILING.thread_target(run)()
+    print(replayer.report())
+
+if __name__ == "__main__":
+    main()
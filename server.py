@@ -10,22 +10,23 @@ import sys
 import os
 import logging
 import argparse
+import functools
 import socket
 import time
 import threading
 
-# For serial
-import io
-import pynmea2
-import serial
-
-import possim
+# The input formats' modules (pynmea2, serial, possim, replay and the
+# decoders) are imported by their handlers, so only the selected formats
+# are loaded
+import profiling
+import capture
+import logqueue
+from logqueue import Lazy
+from metrics import METRICS, METRICS_PORT, start_metrics_server
 import nav
-import nav_nmea
-import nav_nvt
-import nav_jvd
+import navselect
 
-def server(ns, host, port, interval=1.0, timeout=None):
+def server(ns, host, port, interval=1.0, timeout=None, metrics=METRICS):
     """ interval - Message output interval
 
     This routine currently only accepts one connection at a time,
@@ -33,6 +34,8 @@ def server(ns, host, port, interval=1.0, timeout=None):
 
     timeout specifies the number of seconds to run the server before
     quitting.
+
+    metrics is the metrics.Metrics to count connections and sends into.
     """
 
     t0 = time.time()
@@ -50,11 +53,16 @@ def server(ns, host, port, interval=1.0, timeout=None):
             except socket.timeout:
                 continue
             with conn:
-                logging.info(f"Connected by {addr}")
+                logging.info("Connected by %s", addr)
+                send = profiling.PROFILING.timed_call(conn.sendall, 'send')
+                stats = metrics.server
+                stats.connected(addr)
                 try:
                     while True:
-                        data = ns.nav_message()
-                        conn.sendall(data.encode('UTF-8'))
+                        t_update = ns.update_time()
+                        data = ns.nav_message().encode('UTF-8')
+                        send(data)
+                        stats.sent(conn, addr, len(data), t_update)
                         time.sleep(interval)
                         if timeout is not None and time.time() - t0 > timeout:
                             do_listen = False
@@ -63,175 +71,216 @@ def server(ns, host, port, interval=1.0, timeout=None):
                 except BrokenPipeError:
                     logging.info("Client disconnected. Waiting for connection")
                     do_listen = True
-
-class StreamDelayer:
-    """ When reading messages from a stream, delay them until appropriate time
-    for their internal timestamps """
-    def __init__(self):
-        self.t0 = None
-
-    def update(self, msgtime, delay=True, now=None):
-        if now is None:
-            now = time.time()
-
-        if self.t0 is None:
-            self.t0 = (now, msgtime) # Initial message
-            return 0.
-
-        rtime = now - self.t0[0]
-        rtime_msg = (msgtime - self.t0[1]).total_seconds()
-        dt = max(0., rtime_msg - rtime)
-        if delay:
-            time.sleep(dt)
-        return dt
+                finally:
+                    stats.disconnected(addr)
 
 def simulator_handler(ns, *args):
     """ Placeholder for serial handler thread, just simulates movement """
 
-    _, _, _, timeout = args
+    import possim
+    _, _, _, timeout = args[:4]
     t0 = time.time()
 
     psim = possim.PosSimulator()
+    m = METRICS.input('sim', '-')
     while True:
         time.sleep(0.2)
         psim.move(0.2)
         ns1 = psim.navstate()
         ns.update(ns1)
+        m.updated()
         if timeout is not None and time.time() - t0 > timeout:
             break
 
-def nmea_stdin_handler(ns, *args):
+def nmea_stdin_handler(ns, serialport_name=None, *args, replay=None):
     """ To use this one with a simulator, run:
-    ./utils/gen_nmea.py | ./server.py
+    ./utils/gen_nmea.py | ./server.py --format nmeasim
+    or give a recorded NMEA file to replay with --serial.
     """
+    if serialport_name and os.path.isfile(serialport_name):
+        replay_handler(ns, 'nmea', serialport_name, args[0], args[1], args[2], replay)
+        return
+    import nav_nmea
     ns2 = nav_nmea.NmeaNavState()
+    m = METRICS.input('nmea', 'stdin')
     for line in sys.stdin:
+        nav_nmea.count_sentence(m.messages, line)
         ns2.update_nmea(line)
         ns.update(ns2)
+        m.updated()
+
+
+def open_capture(serialport_name, baud, timeout=None, record=None, fmt='raw'):
+    """ Start a capture thread on the serial port. If timeout is given,
+    stop it after that many seconds, which ends the decoder too.
+    record is None, or a dict of capture.RawRecorder arguments (outdir,
+    max_bytes, max_seconds) to also record the raw input. """
+    import serial
+    ser = serial.Serial(serialport_name, baud, timeout=0.1)
+    recorder = None
+    if record is not None:
+        prefix = '%s_%s' % (fmt, os.path.basename(serialport_name))
+        recorder = capture.RawRecorder(prefix=prefix, suffix='.nmea' if fmt == 'nmea' else '.bxds',
+                                       **record)
+    cap = capture.SerialCapture(ser, recorder=recorder)
+    cap.start()
+    if timeout is not None:
+        timer = threading.Timer(timeout, cap.stop)
+        timer.daemon = True
+        timer.start()
+    return cap
+
+def close_capture(cap):
+    cap.stop()
+    cap.join()
+    cap.ser.close()
+    logging.info("Serial capture: %s", ' '.join('%s=%d' % kv for kv in cap.stats().items()))
+
+def nvt_serial_handler(ns, serialport_name, utcoffset, gpsweekoffset, timeout, baud=None, record=None):
+    import nav_nvt
+    cap = open_capture(serialport_name, baud or 38400, timeout, record, 'nvt')
+    m = METRICS.input('nvt', serialport_name)
+    m.extra = cap.stats
+    reader = cap.reader()
+    m.arrival = reader.arrival_time
+    try:
+        navgen = nav_nvt.nvt_nav_gen(reader, utcoffset, stats=m.messages, parser_stats=m.parser)
+        nvt_handler(ns, navgen, timeout, m)
+    finally:
+        close_capture(cap)
 
-
-def nvt_serial_handler(ns, serialport_name, utcoffset, *args):
-    ser = serial.Serial(serialport_name, 38400, timeout=1.)
-    navgen = nav_nvt.nvt_nav_gen(ser, utcoffset)
-    nvt_handler(ns, navgen, timeout)
-
-def nvt_handler(ns, navgen, timeout):
+def nvt_handler(ns, navgen, timeout, metrics=None):
     # Even though we don't need the 1980 check,
     # the javad handler is close enough.
-    jvd_handler(ns, navgen, timeout)
+    jvd_handler(ns, navgen, timeout, metrics)
 
-def jvd_handler(ns, navgen, timeout):
+def jvd_handler(ns, navgen, timeout, metrics=None):
+    """ metrics is None or a metrics.InputMetrics to count updates in """
     t0 = time.time()
     try:
         for ns2 in navgen:
             if ns2.datetime().year == 1980:
                 continue
             ns.update(ns2)
+            if metrics is not None:
+                metrics.updated()
             if timeout is not None and time.time() - t0 > timeout:
                 break
     except KeyboardInterrupt:
         pass
 
 
-def jvd_serial_handler(ns, serialport_name, utcoffset, gpsweekoffset, *args):
-    ser = serial.Serial(serialport_name, 38400, timeout=1.)
-    navgen = nav_jvd.greis_nav_gen(ser, utcoffset, gpsweekoffset)
-    jvd_handler(ns, navgen)
-
-
-def nvt_sim_generator(infile, utcoffset, timeout):
-    """ Reads novatel messages, converts them to nav messages, and
-    delays them to an appropriate time """
-    sdelay = StreamDelayer()
-    with open(infile, "rb") as fin:
-        for ns2 in nav_nvt.nvt_nav_gen(fin, utcoffset):
-            # Delay until appropriate time to issue message
-            dtobj = ns2.datetime()
-            sdelay.update(msgtime=dtobj, delay=True)
-            logging.info(ns2.nav_message().strip())
+def jvd_serial_handler(ns, serialport_name, utcoffset, gpsweekoffset, timeout, baud=None, record=None):
+    import nav_jvd
+    cap = open_capture(serialport_name, baud or 38400, timeout, record, 'jvd')
+    m = METRICS.input('jvd', serialport_name)
+    m.extra = cap.stats
+    reader = cap.reader()
+    m.arrival = reader.arrival_time
+    try:
+        navgen = nav_jvd.greis_nav_gen(reader, utcoffset, gpsweekoffset, stats=m.messages, parser_stats=m.parser)
+        jvd_handler(ns, navgen, timeout, m)
+    finally:
+        close_capture(cap)
+
+
+def sim_input(serialport_name, sample):
+    """ The file for a sim handler to replay: the --serial argument if it
+    names a file (which may be compressed), otherwise the bundled sample """
+    if serialport_name and os.path.isfile(serialport_name):
+        return serialport_name
+    return os.path.join(os.path.dirname(__file__), 'tests/data', sample)
+
+def replay_handler(ns, fmt, infile, utcoffset, weekoffset, timeout, replay=None):
+    """ Replay a recorded file into ns. replay is None (real time, once)
+    or a dict of replay.Replayer options. """
+    from replay import Replayer
+    m = METRICS.input(fmt, infile)
+    replayer = Replayer(fmt, infile, utcoffset=utcoffset, weekoffset=weekoffset, metrics=m, **(replay or {}))
+    def navgen():
+        for ns2 in replayer:
+            # Formatted on the logging thread, and only if not rate limited
+            logging.info("%s", Lazy(logqueue.nav_line, ns2))
             yield ns2
+    jvd_handler(ns, navgen(), timeout, m)
+    logging.info("Replay: %s", replayer.report())
 
-
-def nvt_sim_handler(ns, _, utcoffset, *args):
-    _, timeout = args
-    t0 = time.time()
+def nvt_sim_handler(ns, serialport_name, utcoffset, *args, replay=None):
+    _, timeout = args[:2]
     #infile = "/disk/kea/WAIS/targ/xped/ICP9/breakout/ELSA/F03/TOT3/JKB2s/X07a/AVNnp1/bxds"
     #if not os.path.exists(infile):
     logging.info("nvt sim handler")
-    infile = os.path.join(os.path.dirname(__file__), 'tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds')
-    navgen = nvt_sim_generator(infile, utcoffset, timeout)
-    nvt_handler(ns, navgen, timeout)
-
-def jvd_sim_generator(infile, utcoffset, weekoffset):
-    """ Generates jvd messages delayed to the appropriate time """
-    sdelay = StreamDelayer()
-    with open(infile, "rb") as fin:
-        for ns2 in nav_jvd.greis_nav_gen(fin, utcoffset, weekoffset):
-            # Delay until appropriate time to issue message
-            dtobj = ns2.datetime()
-            if dtobj.year == 1980:
-                continue
-            sdelay.update(msgtime=dtobj, delay=True)
-            logging.info(ns2.nav_message().strip())
-            yield ns2
+    infile = sim_input(serialport_name, 'ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds')
+    replay_handler(ns, 'nvt', infile, utcoffset, 0, timeout, replay)
 
-
-def jvd_sim_handler(ns, _, utcoffset, weekoffset, *args):
-    (timeout,) = args
-    t0 = time.time()
+def jvd_sim_handler(ns, serialport_name, utcoffset, weekoffset, *args, replay=None):
+    timeout = args[0]
     #infile = "/disk/kea/WAIS/targ/xped/ICP9/breakout/ELSA/F03/TOT3/JKB2s/X07a/AVNjp1/bxds"
     #if not os.path.exists(infile):
-    infile = os.path.join(os.path.dirname(__file__), 'tests/data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds')
-    navgen = jvd_sim_generator(infile, utcoffset, weekoffset)
-    jvd_handler(ns, navgen, timeout)
+    infile = sim_input(serialport_name, 'ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds')
+    replay_handler(ns, 'jvd', infile, utcoffset, weekoffset, timeout, replay)
 
 
-def nmea_serial_handler(ns, serialport_name, *args):
+def nmea_serial_handler(ns, serialport_name, utcoffset, gpsweekoffset, timeout, baud=None, record=None):
     """ To use this one with a simulator, run:
     ./utils/gen_nmea.py | ./server.py
     """
-
+    import pynmea2
+    import nav_nmea
     ns2 = nav_nmea.NmeaNavState()
 
-    ser = serial.Serial(serialport_name, 9600, timeout=1.)
-    sio = io.TextIOWrapper(io.BufferedRWPair(ser, ser))
+    cap = open_capture(serialport_name, baud or 9600, timeout, record, 'nmea')
+    m = METRICS.input('nmea', serialport_name)
+    m.extra = cap.stats
+    reader = cap.reader()
+    m.arrival = reader.arrival_time
 
-    while True:
-        try:
-            line = sio.readline()
-            ns2.update_nmea(line)
+    try:
+        for line in nav_nmea.NmeaSerialReader(reader):
+            nav_nmea.count_sentence(m.messages, line)
+            try:
+                ns2.update_nmea(line)
+            except (pynmea2.ParseError, ValueError) as e:
+                logging.warning('Parse error: %s', e)
+                m.parser['unparseable'] = m.parser.get('unparseable', 0) + 1
+                continue
+            except Exception as e:
+                logging.warning('Unhandled exception: %r', e)
+                m.parser['unhandled'] = m.parser.get('unhandled', 0) + 1
+                continue
             ns.update(ns2)
-        except serial.SerialException as e:
-            logging.error('Device error: %r', e)
-            break
-        except (pynmea2.ParseError, UnicodeDecodeError) as e:
-            logging.warning('Parse error: %s', e)
-            continue
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            logging.warning('Unhandled exception: %r', e)
-            time.sleep(0.1) # prevent lockup and continue
+            m.updated()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_capture(cap)
 
     logging.info("nmea_serial_handler stopped.")
 
 
-def main():
-    handlers = {
-        'nmea': nmea_serial_handler,
-        'nvt': nvt_serial_handler,
-        'jvd': jvd_serial_handler,
-        'sim': simulator_handler,
-        'nmeasim': nmea_stdin_handler,
-        'nvtsim': nvt_sim_handler,
-        'jvdsim': jvd_sim_handler,
-    }
+# Input handlers by format. Each imports its format's modules when it
+# starts, so selecting a format loads only what that format needs.
+HANDLERS = {
+    'nmea': nmea_serial_handler,
+    'nvt': nvt_serial_handler,
+    'jvd': jvd_serial_handler,
+    'sim': simulator_handler,
+    'nmeasim': nmea_stdin_handler,
+    'nvtsim': nvt_sim_handler,
+    'jvdsim': jvd_sim_handler,
+}
 
 
+def main():
+    import replay
+    handlers = dict(HANDLERS)
+
     parser = argparse.ArgumentParser(description="Serial-to-TCP server for GNSS receivers")
 
     parser.add_argument('-s', '--serial', default="/dev/ttyUSB0",
-                        help="Input serial port")
+                        help="Input serial port (or, for the sim formats, a possibly compressed file to replay)")
+    parser.add_argument('--baud', default=None, type=int,
+                        help="Serial baud rate (default: 9600 for nmea, 38400 for nvt and jvd)")
     parser.add_argument('--format', default='nmea', choices=list(handlers.keys()),
                         help="Serial input data format (default: nmea)")
     # HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
@@ -240,18 +289,87 @@ def main():
     parser.add_argument('--port', default=4063, type=int, help="TCP server listen port")
     parser.add_argument('--interval', default=1.0, type=float, help="Output position update interval (seconds)")
 
-    parser.add_argument('--gpsutcoffset', default=18., type=float, help="Default GPS-UTC offset in seconds")
+    parser.add_argument('--gpsutcoffset', default=18., type=float, help="GPS-UTC offset in seconds, until the receiver reports leap seconds (Novatel and Javad input)")
     parser.add_argument('--gpsweekoffset', default=1024, type=int, help="GPS week offset (GPS WNRO, for Javad input only)")
     parser.add_argument('--timeout', default=None, type=float, help="Time to run server before quitting")
+    parser.add_argument('--input', action='append', metavar='FORMAT:PORT[:PRIORITY[:STALE]]',
+                        help="Read several inputs at once, sending from the highest priority "
+                        "(lowest number) one that has updated within STALE seconds "
+                        "(default %g). Separate the fields with commas if PORT ends in :NUMBER, as a URL can. "
+                        "Repeat for each input; overrides --format and --serial." % navselect.STALE_TIMEOUT)
+    parser.add_argument('--record', metavar='DIR',
+                        help="Record raw serial input to timestamped files in this directory")
+    parser.add_argument('--record-size', default=capture.RECORD_MAX_BYTES >> 20, type=float,
+                        help="Start a new recording file after this many MB (default %(default)g)")
+    parser.add_argument('--record-time', default=capture.RECORD_MAX_SECONDS, type=float,
+                        help="Start a new recording file after this many seconds (default %(default)g)")
+    parser.add_argument('--decoder-process', action='store_true',
+                        help="Decode input in a separate process, handing off through shared memory (not for nmeasim)")
+    parser.add_argument('--metrics-port', default=None, type=int, metavar='PORT',
+                        help="Serve counters in the Prometheus text format at http://HOST:PORT/metrics "
+                        "(conventionally %d; off by default)" % METRICS_PORT)
+    parser.add_argument('--metrics-host', default="localhost", help="Metrics listen hostname")
+    replay_group = parser.add_argument_group('replay', "Options for the sim formats when replaying a file")
+    replay.add_replay_arguments(replay_group)
+    profiling.add_profile_arguments(parser)
+    logqueue.add_log_arguments(parser)
     # parser.add_argument('-v','--verbose', action="store_true", help="Display verbose output")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    logqueue.start_logging(args.log_rate, args.log_burst, queued=not args.log_sync)
+    prof = profiling.start_profiling(args.profile, args.sample_interval)
+    serve = prof.thread_target(server)
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_host, args.metrics_port)
+
+    try:
+        replay_opts = replay.replay_options(args)
+    except ValueError as e:
+        parser.error(str(e))
+    for name in ('nmeasim', 'nvtsim', 'jvdsim'):
+        handlers[name] = functools.partial(handlers[name], replay=replay_opts)
+
+    record = None
+    if args.record:
+        record = {'outdir': args.record, 'max_bytes': int(args.record_size * (1 << 20)),
+                  'max_seconds': args.record_time}
+
+    if args.input:
+        if args.decoder_process:
+            parser.error("--decoder-process can't be used with --input")
+        try:
+            specs = [navselect.parse_input_spec(spec) for spec in args.input]
+        except ValueError as e:
+            parser.error(str(e))
+        sources = []
+        for i, spec in enumerate(specs):
+            if spec.format not in handlers:
+                parser.error("Unknown input format %r" % spec.format)
+            source = navselect.NavSource('%d:%s:%s' % (i, spec.format, spec.port), spec.priority, spec.stale)
+            sources.append(source)
+            threading.Thread(target=prof.thread_target(handlers[spec.format]), daemon=True,
+                             args=(source, spec.port, args.gpsutcoffset, args.gpsweekoffset,
+                                   args.timeout, args.baud, record)).start()
+        serve(navselect.NavSelector(sources), args.host, args.port, args.interval, timeout=args.timeout)
+        return
+
+    handler_args = (args.serial, args.gpsutcoffset, args.gpsweekoffset, args.timeout, args.baud, record)
+    if args.decoder_process:
+        import navshm
+        writer, proc = navshm.start_decoder(handlers[args.format], handler_args)
+        try:
+            serve(navshm.NavShmReader(writer.shm), args.host, args.port, args.interval, timeout=args.timeout)
+        finally:
+            proc.terminate()
+            proc.join()
+            writer.close()
+        return
 
     ns = nav.NavState()
-    t_serial = threading.Thread(target=handlers[args.format], args=(ns, args.serial, args.gpsutcoffset, args.gpsweekoffset, args.timeout))
+    t_serial = threading.Thread(target=prof.thread_target(handlers[args.format]), args=(ns,) + handler_args)
     t_serial.start()
-    server(ns, args.host, args.port, args.interval, timeout=args.timeout)
+    serve(ns, args.host, args.port, args.interval, timeout=args.timeout)
 
 if __name__ == "__main__":
     main()
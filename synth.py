@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic Novatel and Javad GREIS binary streams for load testing.
+
+A possim.PosSimulator flies a constant speed and climb, optionally
+turning, or a precomputed survey pattern is flown, and each epoch of
+the trajectory is encoded as Novatel BESTPOS, BESTVEL, INSPVA and
+RAWIMU packets (with their CRC32), or as GREIS ~~, GT, PG and VG
+messages (with their checksums), at up to 200 epochs per second. The
+stream goes to a file, stdout or a pty, as fast as it can be generated
+or paced in real time.
+
+Usage:
+
+./synth.py --format nvt --rate 200 --duration 600 -o /tmp/nvt_200hz.bxds
+./synth.py --format jvd --rate 20 --turn-rate 3 -o /tmp/jvd.jps
+./synth.py --format nvt --rate 100 --survey 6 --line-length 10000 --duration 3600 -o /tmp/survey.bxds
+./synth.py --format nvt --pty --duration 60 &   # prints the pty name, then:
+./server.py --format nvt -s /dev/pts/N
+./synth.py --check
+
+"""
+
+import argparse
+import datetime
+import logging
+import math
+import os
+import sys
+import time
+import tty
+
+import bognss.NVT.nvt as nvt
+import bognss.JVD.greis as greis
+import possim
+from replay import ReplayClock
+
+MAX_RATE = 200.
+NVT_MESSAGES = ('BESTPOS', 'BESTVEL', 'INSPVA', 'RAWIMU')
+JVD_MESSAGES = ('GT', 'PG', 'VG')
+NVT_MSGIDS = {'BESTPOS': 42, 'BESTVEL': 99, 'INSPVA': 507, 'RAWIMU': 268}
+
+GPS_EPOCH = datetime.datetime(1980, 1, 6, tzinfo=datetime.timezone.utc)
+GPS_WEEK_SECS = 604800
+GPS_UTC_OFFSET = 18
+DEFAULT_START = '2022-01-01T12:34:56'
+
+GRAVITY = 9.80665
+# RAWIMU counts, as for a Honeywell HG1700 (velocity and angle increments)
+RAWIMU_ACCEL_SCALE = 0.05 / 2 ** 15 # m/s per count
+RAWIMU_GYRO_SCALE = 2. ** -33 # rad per count
+
+# Solution status and types
+SOL_COMPUTED = 0
+POS_SINGLE = 16
+DATUM_WGS84 = 61
+INS_SOLUTION_GOOD = 3
+GREIS_STANDALONE = 1
+
+
+def gps_time(utc):
+    """ GPS seconds since the GPS epoch of a UTC datetime """
+    return (utc - GPS_EPOCH).total_seconds() + GPS_UTC_OFFSET
+
+def week_msec(gpssec):
+    """ GPS week and millisecond of week """
+    week, sow = divmod(gpssec, GPS_WEEK_SECS)
+    return int(week), int(round(sow * 1000.))
+
+
+def nvt_epoch(psim, week, msec, msgnames, rate):
+    """ Novatel packets for the current state of psim """
+    lat, lon, hgt = psim.lat, psim.lon, psim.alt
+    heading = math.radians(psim.heading)
+    vn, ve, vu = psim.hspeed * math.cos(heading), psim.hspeed * math.sin(heading), psim.vspeed
+    out = []
+    for name in msgnames:
+        if name == 'BESTPOS':
+            fields = (SOL_COMPUTED, POS_SINGLE, lat, lon, hgt, 0., DATUM_WGS84, 1., 1., 2.,
+                      b'0\0\0\0', 0., 0., 12, 12, 12, 12, 0, 0, 0, 0)
+        elif name == 'BESTVEL':
+            fields = (SOL_COMPUTED, POS_SINGLE, 0., 0., psim.hspeed, psim.heading, vu, 0.)
+        elif name == 'INSPVA':
+            pitch = math.degrees(math.atan2(vu, psim.hspeed))
+            fields = (week, msec / 1000., lat, lon, hgt, vn, ve, vu, 0., pitch, psim.heading,
+                      INS_SOLUTION_GOOD)
+        elif name == 'RAWIMU':
+            # Level flight: gravity on z, and the turn rate about it,
+            # as increments over the sample interval
+            dv = GRAVITY / rate / RAWIMU_ACCEL_SCALE
+            dtheta = math.radians(getattr(psim, 'turn_rate', 0.)) / rate / RAWIMU_GYRO_SCALE
+            fields = (week, msec / 1000., 0, int(dv), 0, 0, int(dtheta), 0, 0)
+        else:
+            raise ValueError("Unknown Novatel message %r" % name)
+        out.append(nvt.encode_message(NVT_MSGIDS[name], week, msec, fields))
+    return b''.join(out)
+
+def jvd_epoch(psim, week, msec, msgnames, weekoffset=1024):
+    """ GREIS messages for the current state of psim, starting with the
+    receiver time (~~), each ending with a newline as from a receiver """
+    heading = math.radians(psim.heading)
+    vn, ve, vu = psim.hspeed * math.cos(heading), psim.hspeed * math.sin(heading), psim.vspeed
+    out = [greis.encode_message(b'~~', ((msec % (86400 * 1000)),))]
+    for name in msgnames:
+        if name == 'GT':
+            fields = (msec, week - weekoffset)
+        elif name == 'PG':
+            fields = (math.radians(psim.lat), math.radians(psim.lon), psim.alt, 1., GREIS_STANDALONE)
+        elif name == 'VG':
+            fields = (vn, ve, vu, 0.1, GREIS_STANDALONE)
+        else:
+            raise ValueError("Unknown GREIS message %r" % name)
+        out.append(greis.encode_message(name.encode('ascii'), fields))
+    return b'\n'.join(out) + b'\n'
+
+
+def check_rate(rate):
+    if not 0 < rate <= MAX_RATE:
+        raise ValueError("Rate must be more than 0 and at most %g Hz, got %g" % (MAX_RATE, rate))
+
+def synth_stream(fmt, psim, rate, duration, start=None, msgnames=None, turn_rate=0., weekoffset=1024):
+    """ Generate (GPS seconds, bytes) for each epoch of duration seconds
+    of psim's trajectory at rate Hz, from the UTC datetime start """
+    check_rate(rate)
+    if start is None:
+        start = datetime.datetime.fromisoformat(DEFAULT_START).replace(tzinfo=datetime.timezone.utc)
+    if fmt == 'nvt':
+        msgnames = NVT_MESSAGES if msgnames is None else msgnames
+        encode = lambda week, msec: nvt_epoch(psim, week, msec, msgnames, rate)
+    elif fmt == 'jvd':
+        msgnames = JVD_MESSAGES if msgnames is None else msgnames
+        encode = lambda week, msec: jvd_epoch(psim, week, msec, msgnames, weekoffset)
+    else:
+        raise ValueError("Unknown format %r" % fmt)
+    psim.turn_rate = turn_rate
+    dt = 1. / rate
+    t0 = gps_time(start)
+    for i in range(int(round(duration * rate))):
+        gpssec = t0 + i * dt
+        yield gpssec, encode(*week_msec(gpssec))
+        psim.heading = (psim.heading + turn_rate * dt) % 360.
+        psim.move(dt)
+
+
+class PtyWriter:
+    """ A pseudo-terminal in raw mode, so that binary data passes through
+    unchanged. Like a serial port, it drops what doesn't fit in its buffer
+    when nothing is reading the other end, rather than blocking. """
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self.slave)
+        self.dropped = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.master, view):]
+            except BlockingIOError:
+                self.dropped += len(view)
+                break
+
+    def flush(self):
+        pass
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+def write_stream(stream, fout, speed=0.):
+    """ Write each epoch of stream to the binary file fout, paced by its
+    time at speed (0 to write as fast as possible). Returns the number
+    of epochs and bytes. """
+    clock = ReplayClock(speed)
+    nepochs = nbytes = 0
+    for gpssec, data in stream:
+        clock.wait(gpssec)
+        fout.write(data)
+        if speed:
+            fout.flush()
+        nepochs += 1
+        nbytes += len(data)
+    fout.flush()
+    return nepochs, nbytes
+
+
+def make_simulator(args):
+    if args.survey:
+        segments = possim.survey_pattern(args.survey, args.line_length, args.spacing, args.speed_mps,
+                                         vspeed=args.climb)
+        track = possim.fly(segments, args.rate, args.lat, args.lon, args.alt, args.heading)
+        return possim.TrackSimulator(possim.vehicle(track, 0), args.rate)
+    return possim.PosSimulator(lat0=args.lat, lon0=args.lon, alt0=args.alt, heading=args.heading,
+                               hspeed=args.speed_mps, vspeed=args.climb)
+
+def synth_check(rate=MAX_RATE, duration=10.):
+    """ Generate both formats, check that the parsers find every message
+    with a good checksum and no resynchronisation, and that the nav
+    generators follow the trajectory; report the generation rate """
+    import nav_jvd
+    import nav_nvt
+    ok = True
+    for fmt in ('nvt', 'jvd'):
+        psim = possim.PosSimulator(lat0=-77., lon0=165., alt0=2500., heading=30., hspeed=85., vspeed=1.)
+        t0 = time.perf_counter()
+        chunks = [data for _, data in synth_stream(fmt, psim, rate, duration, turn_rate=2.)]
+        dt = time.perf_counter() - t0
+        data = b''.join(chunks)
+        nepochs = len(chunks)
+        stats, parser_stats = {}, {}
+        if fmt == 'nvt':
+            nmsgs = len(NVT_MESSAGES) * nepochs
+            parsed = [rec for rec in nvt.NovatelParser(data, b_calc_crc=True, stats=parser_stats)
+                      if rec.parsed is not None]
+            snapshots = list(nav_nvt.nvt_nav_gen(data, GPS_UTC_OFFSET, stats=stats))
+            good = len(parsed) == nmsgs and parser_stats['badcrc'] == 0
+        else:
+            nmsgs = (len(JVD_MESSAGES) + 1) * nepochs
+            msgs = list(greis.make_reader(data, skip_crlf=True))
+            badcs = sum(1 for m in msgs if m.id == b'??' or greis.crc8(m.id + m.len + m.body[:-1]) != m.body[-1])
+            snapshots = list(nav_jvd.greis_nav_gen(data, GPS_UTC_OFFSET, stats=stats, parser_stats=parser_stats))
+            good = len(msgs) == nmsgs and badcs == 0
+        last = snapshots[-1] if snapshots else None
+        # The last epoch was encoded before the final move
+        good = (good and parser_stats['resync_bytes'] == 0 and len(snapshots) >= nepochs and
+                abs(last.latitude - psim.lat) < 1e-3 and abs(last.longitude - psim.lon) < 1e-3)
+        print("%s: %d epochs at %g Hz, %d messages, %d bytes; generated at %.0f epochs/s (%.1f MB/s); %s" %
+              (fmt, nepochs, rate, nmsgs, len(data), nepochs / dt, len(data) / dt / 1e6,
+               'ok' if good else 'FAILED'))
+        ok = ok and good
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Novatel or GREIS binary data")
+    parser.add_argument('--format', default='nvt', choices=('nvt', 'jvd'))
+    parser.add_argument('--messages', default=None,
+                        help="Comma-separated messages to send each epoch (default: nvt %s; jvd %s)" %
+                        (','.join(NVT_MESSAGES), ','.join(JVD_MESSAGES)))
+    parser.add_argument('--rate', default=10., type=float, help="Epochs per second, up to %g" % MAX_RATE)
+    parser.add_argument('--duration', default=60., type=float, help="Seconds of data to generate")
+    parser.add_argument('--start', default=DEFAULT_START,
+                        help="UTC start time, ISO 8601 (default %(default)s)")
+    parser.add_argument('--lat', default=-77., type=float)
+    parser.add_argument('--lon', default=165., type=float)
+    parser.add_argument('--alt', default=2500., type=float)
+    parser.add_argument('--heading', default=0., type=float, help="Initial heading (degrees)")
+    parser.add_argument('--speed-mps', default=85., type=float, help="Ground speed (m/s)")
+    parser.add_argument('--climb', default=0., type=float, help="Vertical speed (m/s)")
+    parser.add_argument('--turn-rate', default=0., type=float, help="Turn rate (degrees/s)")
+    parser.add_argument('--survey', default=None, type=int, metavar='LINES',
+                        help="Fly a survey of this many lines instead, joined by semicircular turns")
+    parser.add_argument('--line-length', default=30e3, type=float, help="Survey line length (m)")
+    parser.add_argument('--spacing', default=2e3, type=float, help="Survey line spacing (m)")
+    parser.add_argument('--gpsweekoffset', default=1024, type=int, help="GPS week offset of GT messages")
+    parser.add_argument('-o', '--output', default='-', help="Output file, or - for stdout")
+    parser.add_argument('--pty', action='store_true',
+                        help="Write to a new pseudo-terminal instead, in real time; its name is printed")
+    parser.add_argument('--speed', default=None, type=float,
+                        help="Pace the output at this multiple of real time "
+                        "(default: 1 with --pty, otherwise as fast as possible)")
+    parser.add_argument('--check', action='store_true',
+                        help="Check that the parsers decode generated data, and report the generation rate")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    if args.check:
+        sys.exit(0 if synth_check() else 1)
+
+    try:
+        check_rate(args.rate)
+        start = datetime.datetime.fromisoformat(args.start)
+    except ValueError as e:
+        parser.error(str(e))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=datetime.timezone.utc)
+    msgnames = None if args.messages is None else tuple(args.messages.split(','))
+    known = NVT_MESSAGES if args.format == 'nvt' else JVD_MESSAGES
+    if msgnames is not None and not set(msgnames) <= set(known):
+        parser.error("--messages for %s must be from %s" % (args.format, ','.join(known)))
+    speed = args.speed if args.speed is not None else (1. if args.pty else 0.)
+
+    stream = synth_stream(args.format, make_simulator(args), args.rate, args.duration, start,
+                          msgnames, args.turn_rate, args.gpsweekoffset)
+    t0 = time.time()
+    if args.pty:
+        pty = PtyWriter()
+        print(pty.name, flush=True)
+        try:
+            nepochs, nbytes = write_stream(stream, pty, speed)
+        finally:
+            pty.close()
+        if pty.dropped:
+            logging.warning("Dropped %d bytes with nothing reading %s", pty.dropped, pty.name)
+    elif args.output == '-':
+        nepochs, nbytes = write_stream(stream, sys.stdout.buffer, speed)
+    else:
+        with open(args.output, 'wb') as fout:
+            nepochs, nbytes = write_stream(stream, fout, speed)
+    dt = time.time() - t0
+    logging.info("%d %s epochs, %d bytes in %.2f s (%.0f epochs/s)",
+                 nepochs, args.format, nbytes, dt, nepochs / dt if dt > 0 else 0.)
+
+if __name__ == "__main__":
+    main()
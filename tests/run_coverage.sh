@@ -7,13 +7,15 @@ DATADIR=$D0/out_cov
 mkdir -p $DATADIR
 
 rm -f $DATADIR/*.txt
+rm -rf $DATADIR/raw
 
 $COV run ../server.py -h > /dev/null
 $COV run -a ../nav.py -h > /dev/null
 
 # ../nav_nmea
 for FILE in ../bognss/JVD/greis.py ../bognss/NVT/nvt.py \
-    ../nav_nvt.py ../nav_jvd.py
+    ../nav_nvt.py ../nav_jvd.py ../capture.py ../navshm.py \
+    ../navselect.py ../replay.py ../bench.py ../profiling.py ../metrics.py ../logqueue.py ../synth.py ../corrupt.py ../batch.py
 do
     $COV run -a $FILE -h > /dev/null
 done
@@ -22,24 +24,152 @@ done
 $COV run -a ../bognss/NVT/nvt.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds > /dev/null
 $COV run -a ../bognss/NVT/nvt.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --limit 20 --crc > /dev/null
 $COV run -a ../bognss/NVT/nvt.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds --crc > /dev/null
+$COV run -a ../bognss/NVT/nvt.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds --crc --mmap > /dev/null
 $COV run -a ../bognss/NVT/nvt.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds -o $DATADIR > /dev/null
+# Cross-check the scalar and vectorized RANGECMP decoders
+$COV run -a ../bognss/NVT/nvt.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds --bench140 > /dev/null
+# Build the sidecar index, then read time ranges using it
+cp data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds $DATADIR/np1_bxds
+$COV run -a ../bognss/NVT/nvt.py -i $DATADIR/np1_bxds --index > /dev/null
+$COV run -a ../bognss/NVT/nvt.py -i $DATADIR/np1_bxds --start 21940 --end 21941 > /dev/null
+$COV run -a ../bognss/NVT/nvt.py -i $DATADIR/np1_bxds --start 21970 > /dev/null
 
 tail -c 50k data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds | head -c 40k > $DATADIR/jps
 $COV run -a ../bognss/JVD/greis.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds -v > /dev/null
 $COV run -a ../bognss/JVD/greis.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds --nmax 100 > /dev/null
 $COV run -a ../bognss/JVD/greis.py -i $DATADIR/jps > /dev/null
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/jps --mmap > /dev/null
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/jps --index > /dev/null
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/jps --start 21990 --end 21991 > /dev/null
 
+# Compressed copies of the sample files, read directly
+for FILE in ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds
+do
+    gzip -c data/$FILE > $DATADIR/$FILE.gz
+    xz -c data/$FILE > $DATADIR/$FILE.xz
+    zstd -qc data/$FILE > $DATADIR/$FILE.zst
+done
+$COV run -a ../bognss/NVT/nvt.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --throughput > $DATADIR/throughput.txt
+$COV run -a ../bognss/JVD/greis.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds --throughput >> $DATADIR/throughput.txt
+for EXT in gz xz zst
+do
+    $COV run -a ../bognss/NVT/nvt.py -i $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds.$EXT --mmap > $DATADIR/np1_$EXT.txt
+    $COV run -a ../bognss/NVT/nvt.py -i $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds.$EXT --throughput >> $DATADIR/throughput.txt
+    $COV run -a ../bognss/JVD/greis.py -i $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds.$EXT > $DATADIR/jp1_$EXT.txt
+    $COV run -a ../bognss/JVD/greis.py -i $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds.$EXT --throughput >> $DATADIR/throughput.txt
+done
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds.gz --index 2> /dev/null
+
+
+$COV run -a ../nav_nvt.py > /dev/null
+$COV run -a ../nav_nvt.py --checktime > /dev/null
+$COV run -a ../nav_jvd.py > /dev/null
 
 $COV run -a ../possim.py > /dev/null
+$COV run -a ../possim.py --check --vehicles 20 > $DATADIR/possim_check.txt
+
+# Feed the sample files through a pty into the serial capture thread
+$COV run -a ../capture.py --pty data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --format nvt --baud 921600 --stall 0.2 --record $DATADIR/raw --bench > $DATADIR/capture_nvt.txt
+$COV run -a ../capture.py --pty data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds --format jvd --baud 921600 --stall 0.2 > $DATADIR/capture_jvd.txt
 
 # Generate some NMEA
 $COV run -a ../utils/gen_nmea.py --time 5. > $DATADIR/nmea.txt
 # Parse it
 cat $DATADIR/nmea.txt | $COV run -a  ../nav_nmea.py > $DATADIR/parsed.txt
+cat $DATADIR/nmea.txt | $COV run -a  ../nav_nmea.py --check --bench > $DATADIR/nmea_check.txt
+cat $DATADIR/nmea.txt | $COV run -a  ../nav_nmea.py --pty > $DATADIR/nmea_pty.txt
+$COV run -a  ../nav_nmea.py --track $DATADIR/nmea.txt -o $DATADIR/nmea_track.npy > /dev/null
 cat $DATADIR/nmea.txt | $COV run -a  ../server.py --format nmeasim --timeout 3 > $DATADIR/parsed_nmea.txt
 $COV run -a ../server.py --format sim --timeout 3
 $COV run -a  ../server.py --format jvdsim --timeout 3 > $DATADIR/parsed_jvd.txt
 $COV run -a  ../server.py --format nvtsim --timeout 3 > $DATADIR/parsed_nvt.txt
+$COV run -a  ../server.py --format nvtsim --timeout 3 -s $DATADIR/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds.xz > $DATADIR/parsed_nvt_xz.txt
+$COV run -a  ../server.py --format jvdsim --timeout 3 --decoder-process > $DATADIR/parsed_jvd_proc.txt
+# Two inputs at once, and failover when one stops
+$COV run -a  ../server.py --input nvtsim:-:0:0.5 --input jvdsim:-:1 --timeout 3 > $DATADIR/parsed_multi.txt
+$COV run -a ../navselect.py --test --duration 4 > $DATADIR/failover.txt
+# Replay at other speeds, in a window, looped, and from a compressed file
+$COV run -a ../replay.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNnp1_bxds --unthrottled > $DATADIR/replay_nvt.txt
+$COV run -a ../replay.py -i data/ICP9_F03_TOT3_JKB2s_X07a_AVNjp1_bxds --format jvd --speed 20 --start 5 --end 10 --loop --duration 2 > $DATADIR/replay_jvd.txt
+gzip -c $DATADIR/nmea.txt > $DATADIR/nmea.txt.gz
+$COV run -a ../replay.py -i $DATADIR/nmea.txt.gz --format nmea --speed 10 -v > $DATADIR/replay_nmea.txt
+$COV run -a ../replay.py -i $DATADIR/nmea.txt --speed 1000 2> /dev/null
+$COV run -a  ../server.py --format nmeasim -s $DATADIR/nmea.txt --speed 2 --timeout 3 > $DATADIR/parsed_nmea_replay.txt
+$COV run -a  ../server.py --format jvdsim --speed 4 --loop --timeout 3 > $DATADIR/parsed_jvd_loop.txt
+# Server send jitter with the decoder on a thread vs in its own process
+$COV run -a ../navshm.py --bench --duration 1 > $DATADIR/navshm_bench.txt
+
+
+# Quick benchmark run, compared with itself and a filtered rerun
+$COV run -a ../bench.py --min-time 0.02 --repeat 1 --server-duration 1 -o $DATADIR/bench.json > $DATADIR/bench.txt
+$COV run -a ../bench.py --compare $DATADIR/bench.json $DATADIR/bench.json > $DATADIR/bench_compare.txt
+$COV run -a ../bench.py -k NavState --min-time 0.02 --repeat 1 --compare $DATADIR/bench.json --threshold 0.5 >> $DATADIR/bench_compare.txt
+
+
+# Profiling: overhead check, the CLIs, and a server summary on SIGUSR1 and at exit
+$COV run -a ../profiling.py --check > $DATADIR/profiling_check.txt
+$COV run -a ../bognss/NVT/nvt.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds --profile > /dev/null 2> $DATADIR/profile_nvt.txt
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/jps --profile > /dev/null 2> $DATADIR/profile_jvd.txt
+$COV run -a ../replay.py -i data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds --unthrottled --loop --duration 1 --profile stages --profile cprofile > $DATADIR/profile_replay.txt
+$COV run -a ../server.py --format nvtsim --speed 10 --timeout 3 --profile stages --profile sample --profile cprofile > $DATADIR/profile_server.txt &
+PID="$!"
+sleep 2
+kill -USR1 $PID
+wait $PID
+
+
+# Metrics: self-check, and a scrape of a running server
+$COV run -a ../metrics.py --check > $DATADIR/metrics_check.txt
+$COV run -a ../server.py --format nvtsim --speed 10 --timeout 3 --metrics-port 9463 > /dev/null &
+PID="$!"
+sleep 2
+python3 -c "import urllib.request; print(urllib.request.urlopen('http://localhost:9463/metrics').read().decode())" > $DATADIR/metrics.txt
+wait $PID
+$COV run -a ../server.py --format nmeasim -s $DATADIR/nmea.txt --timeout 2 --metrics-port 9463 > /dev/null
+
+
+# Logging: queued output and rate limit check with timings, and a fast
+# replay with the echo rate limited, then unlimited on the calling thread
+$COV run -a ../logqueue.py --check > $DATADIR/logqueue_check.txt
+$COV run -a ../server.py --format nvtsim --speed 100 --timeout 2 --log-rate 5 --log-burst 10 > $DATADIR/log_limited.txt
+$COV run -a ../server.py --format nvtsim --speed 100 --timeout 2 --log-rate 0 --log-sync > $DATADIR/log_sync.txt
+
+
+# Synthetic data: self-check, files for the parsers, and a pty into the server
+$COV run -a ../synth.py --check > $DATADIR/synth_check.txt
+$COV run -a ../synth.py --format nvt --rate 200 --duration 5 --turn-rate 3 -o $DATADIR/synth_nvt.bxds 2> /dev/null
+$COV run -a ../synth.py --format jvd --rate 50 --duration 5 --messages GT,PG,VG --climb 2 -o $DATADIR/synth_jvd.jps 2> /dev/null
+$COV run -a ../synth.py --format jvd --rate 10 --duration 1 2> /dev/null > $DATADIR/synth_jvd_stdout.jps
+$COV run -a ../synth.py --format nvt --rate 100 --survey 3 --line-length 5000 --duration 300 -o $DATADIR/synth_survey.bxds 2> /dev/null
+$COV run -a ../replay.py -i $DATADIR/synth_survey.bxds --unthrottled > $DATADIR/replay_survey.txt
+$COV run -a ../synth.py --format nvt --messages BESTPOS,GT 2> /dev/null
+$COV run -a ../bognss/NVT/nvt.py -i $DATADIR/synth_nvt.bxds --crc > $DATADIR/synth_nvt.txt
+$COV run -a ../bognss/JVD/greis.py -i $DATADIR/synth_jvd.jps > $DATADIR/synth_jvd.txt
+$COV run -a ../synth.py --format jvd --pty --rate 100 --duration 4 > $DATADIR/synth_pty.txt &
+PID="$!"
+sleep 1
+$COV run -a ../server.py --format jvd -s `grep ^/dev/ $DATADIR/synth_pty.txt` --timeout 2 > $DATADIR/synth_server.txt
+wait $PID
+
+
+# Reader resilience to corrupted input, and a custom profile
+$COV run -a ../corrupt.py --check --size 0.2 --min-time 0.02 -o $DATADIR/corrupt.json > $DATADIR/corrupt.txt
+$COV run -a ../corrupt.py -k jvd --size 0.1 --profile ber=1e-4,drop=1e-4,run=8 --profile truncate=0.05 > $DATADIR/corrupt_custom.txt
+$COV run -a ../corrupt.py --profile bogus=1 2> /dev/null
+
+
+# Batch processing of a tree of files; the second run should all be cached
+rm -rf $DATADIR/batch_in $DATADIR/batch_out
+mkdir -p $DATADIR/batch_in/sub
+cp data/*_bxds $DATADIR/batch_in/
+gzip -c data/KRT2_F21_NIS2_IBH0g_X23a_AVNnp4_bxds > $DATADIR/batch_in/sub/KRT2.gz
+cp $DATADIR/nmea.txt $DATADIR/batch_in/sub/
+$COV run -a ../batch.py $DATADIR/batch_in -o $DATADIR/batch_out -j 2 -v > $DATADIR/batch.txt
+$COV run -a ../batch.py $DATADIR/batch_in -o $DATADIR/batch_out --summary $DATADIR/batch_out/summary.json > $DATADIR/batch_cached.txt
+touch $DATADIR/batch_in/sub/nmea.txt
+$COV run -a ../batch.py $DATADIR/batch_in -o $DATADIR/batch_out --mode breakout >> $DATADIR/batch_cached.txt
+$COV run -a ../batch.py $DATADIR/batch_in -o $DATADIR/batch_out --force >> $DATADIR/batch_cached.txt
+$COV run -a ../batch.py $DATADIR/nonexistent -o $DATADIR/batch_out 2> /dev/null
 
 
 # Cause a parse error with a partial packet (like might happen on startup)